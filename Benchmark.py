@@ -0,0 +1,423 @@
+from __future__ import annotations
+from argparse import ArgumentParser, Namespace
+from collections.abc import Callable
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from GCodeModel import Model, FlowModel, _GCodeParser
+
+# Measures the performance of the editor on a synthetic print in the layout Cura writes, or on a real file:
+#
+#     python Benchmark.py --layers 200 --output before.json
+#     python Benchmark.py --compare before.json
+#     python Benchmark.py parse export --input print.gcode
+#
+# Every benchmark is timed over a number of runs and the median is reported, then run once more while
+# tracemalloc records its peak memory and the blocks still allocated at its end. Startup is timed in fresh
+# processes so imports are cold. The editor needs a display, the canvas is rendered offscreen without one.
+
+DIRECTORY: str = os.path.dirname(os.path.abspath(__file__))
+
+# Measurements ending in one of these are better when lower, the others (throughput) when higher
+LOWER_IS_BETTER: tuple[str, ...] = ("seconds", "_mb", "_blocks")
+
+
+def generate_gcode(file_name: str, layers: int, features: int, commands: int, comment_density: float, seed: int = 0) -> None:
+    # Writes a print of layers with features extrusion moves each, every feature is reached by a travel move.
+    # Comments are placed between the moves with probability comment_density. The same parameters and seed always
+    # give the same file.
+    generator = random.Random(seed)
+    feature_types = _GCodeParser.FEATURE_TYPES
+    extruded = 0.0
+    elapsed = 0.0
+
+    with open(file_name, "w", newline="\n") as file:
+        file.write(";FLAVOR:Marlin\n;TIME:0\n;Filament used: 0m\n;Layer height: 0.2\n;Generated with Benchmark.py\n"
+                   "M140 S60\nM105\nM190 S60\nM104 S200\nM105\nM109 S200\nM82 ;absolute extrusion mode\n"
+                   "G28 ;Home\nG92 E0\nG1 Z2.0 F3000\n")
+        file.write(f";LAYER_COUNT:{layers}\n")
+
+        for layer in range(layers):
+            lines = [f";LAYER:{layer}\n"]
+            if layer == 1:
+                lines.append("M106 S255\n")
+
+            for feature in range(features):
+                x, y = generator.uniform(10, 200), generator.uniform(10, 200)
+                if feature == 0:
+                    lines.append(f"G0 F6000 X{x:.3f} Y{y:.3f} Z{0.2 * (layer + 1):.1f}\n;MESH:model.stl\n")
+                else:
+                    lines.append(f"G0 F6000 X{x:.3f} Y{y:.3f}\n")
+                lines.append(f";TYPE:{feature_types[(layer + feature) % len(feature_types)]}\n")
+
+                for command in range(commands):
+                    x = min(max(x + generator.uniform(-5, 5), 0), 210)
+                    y = min(max(y + generator.uniform(-5, 5), 0), 210)
+                    extruded += generator.uniform(0.01, 0.3)
+                    if command == 0:
+                        lines.append(f"G1 F1500 X{x:.3f} Y{y:.3f} E{extruded:.5f}\n")
+                    else:
+                        lines.append(f"G1 X{x:.3f} Y{y:.3f} E{extruded:.5f}\n")
+                    if generator.random() < comment_density:
+                        lines.append(f";segment {command}\n")
+
+            elapsed += generator.uniform(10, 60)
+            lines.append(f";TIME_ELAPSED:{elapsed:.6f}\n")
+            file.writelines(lines)
+
+        file.write("M140 S0\nM107\nG91\nG1 E-2 F2700\nG1 E-2 Z0.2 F2400\nG1 X5 Y5 F3000\nG1 Z10\nG90\nG1 X0 Y235\n"
+                   "M106 S0\nM104 S0\nM82 ;absolute extrusion mode\nM104 S0\n;End of Gcode\n")
+
+
+def measure(run: Callable[[object], object], runs: int, setup: Callable[[], object] = lambda: None) -> dict[str, float]:
+    # The setup prepares what a run works on and is not timed, every run gets a fresh one
+    times = []
+    for _ in range(runs):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+        del state
+
+    state = setup()
+    tracemalloc.start()
+    result = run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    blocks = sum(statistic.count for statistic in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+    del result, state
+
+    return {"seconds": statistics.median(times), "peak_memory_mb": peak / (1 << 20), "allocated_blocks": blocks}
+
+
+def add_throughput(results: dict[str, float], commands: int, size: int = None) -> dict[str, float]:
+    results["commands_per_second"] = commands / results["seconds"]
+    if size != None:
+        results["mb_per_second"] = size / (1 << 20) / results["seconds"]
+    return results
+
+
+def parse_file(file_name: str) -> Model:
+    with open(file_name, "r") as file:
+        return Model.parse_gcode(file)
+
+
+def count_commands(model: Model) -> int:
+    return sum(feature.command_count() for layer in model.get_layers() for feature in layer.get_features())
+
+
+def benchmark_parse(options: Namespace) -> dict[str, float]:
+    # Parsing the whole file up front, as opening a file that is not laid out in layers does
+    results = measure(lambda _: parse_file(options.input), options.runs)
+    return add_throughput(results, options.commands, os.path.getsize(options.input))
+
+
+def export_model(model: Model) -> None:
+    with open(os.devnull, "w", buffering=1 << 24) as file:
+        model.export(file)
+
+
+def benchmark_export(options: Namespace) -> dict[str, float]:
+    # Features that weren't edited are copied straight from the source
+    model = parse_file(options.input)
+    return add_throughput(measure(lambda _: export_model(model), options.runs), options.commands, os.path.getsize(options.input))
+
+
+def benchmark_export_modified(options: Namespace) -> dict[str, float]:
+    # After recalculating the extrusion every command is written from its values
+    model = parse_file(options.input)
+    model.recalculate_extrusion(model.get_layers(), FlowModel(0.2, 0.4))
+    return add_throughput(measure(lambda _: export_model(model), options.runs), options.commands, os.path.getsize(options.input))
+
+
+def benchmark_render(options: Namespace) -> dict[str, float]:
+    # Every layer is drawn once on a canvas without cached geometry, through Agg like on screen
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5 import QtWidgets
+    application = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+
+    import numpy as np
+    from MplCanvas import MplCanvas
+
+    model = parse_file(options.input)
+    selected_rows = np.empty(0, np.int64)
+
+    def render(canvas: MplCanvas) -> None:
+        for index in range(model.layer_count()):
+            canvas.render_layer(model, index, selected_rows)
+
+    results = measure(render, options.runs, lambda: MplCanvas(None, width=5, height=5, dpi=100))
+    results["layers_per_second"] = model.layer_count() / results["seconds"]
+    return add_throughput(results, options.commands)
+
+
+def benchmark_preview(options: Namespace) -> dict[str, float]:
+    # The stacked preview of the whole print, first on a canvas without cached layers, then drawn again from the cache
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5 import QtWidgets
+    application = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+
+    from MplCanvas import MplCanvas
+
+    model = parse_file(options.input)
+    top = model.layer_count() - 1
+
+    def create_canvas() -> MplCanvas:
+        canvas = MplCanvas(None, width=5, height=5, dpi=100)
+        canvas.set_preview(0)
+        return canvas
+
+    def render(canvas: MplCanvas) -> None:
+        canvas.render_layer(model, top, None)
+
+    results = measure(render, options.runs, create_canvas)
+
+    cached_canvas = create_canvas()
+    render(cached_canvas)
+    results["cached_seconds"] = measure(render, options.runs, lambda: cached_canvas)["seconds"]
+    results["layers_per_second"] = model.layer_count() / results["seconds"]
+    return add_throughput(results, options.commands)
+
+
+def benchmark_navigate(options: Namespace) -> dict[str, float]:
+    # Drags the layer slider of the editor from the bottom to the top of the print at 60 steps per second and lets
+    # go. Reports the seconds until the top layer is shown, the stages of showing a layer and how many layers were drawn.
+    # Skipped layers were requested but replaced by a later request before they were drawn.
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5 import QtWidgets
+    application = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+
+    from GCodeEditor import MainWindow
+
+    def process_events(seconds: float) -> None:
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            application.processEvents()
+
+    def create_window() -> MainWindow:
+        window = MainWindow()
+        window.setup_ui()
+        while window.gcode_render == None:
+            process_events(0.01)
+        window.on_load_model_opened(parse_file(options.input))
+        process_events(window.layer_scheduler.SETTLE_TIME * 2 / 1000.0)
+        return window
+
+    def drag(window: MainWindow) -> None:
+        # The slider follows the clock like it follows the mouse, layers it passes while a layer is drawn are skipped
+        scheduler = window.layer_scheduler
+        top = window.model.layer_count() - 1
+        scheduler.hold()
+        start = time.perf_counter()
+        while window.slider_layer.value() < top:
+            window.slider_layer.setValue(min(top, int((time.perf_counter() - start) * 60.0) + 1))
+            application.processEvents()
+        scheduler.release()
+
+        # Done once the top layer is drawn and open in the tree
+        while scheduler.settle_index != None or scheduler.requested_index != None:
+            application.processEvents()
+
+    windows = []
+
+    def setup() -> MainWindow:
+        windows.append(create_window())
+        return windows[-1]
+
+    results = measure(drag, options.runs, setup)
+
+    # From the first run, the one measuring memory is slowed down by tracemalloc
+    scheduler = windows[0].layer_scheduler
+    for name, stage in scheduler.stage_times.items():
+        results[f"{name}_mean_seconds"] = stage.get_mean()
+        results[f"{name}_longest_seconds"] = stage.longest
+    results["drawn_layers"] = scheduler.stage_times["render"].count
+    results["skipped_layers"] = scheduler.skipped
+
+    for window in windows:
+        window.gcode_render.stop_prefetch()
+    return results
+
+
+# Queries timed on a complete search index, one of every kind
+SEARCH_QUERIES: dict[str, str] = {
+    "code": "M106",
+    "range": "Z>10 F<=1500",
+    "comment": ";TYPE:SKIRT",
+    "regex": r"/^G1 X1\d\d\.\d+ Y/",
+    }
+
+
+def benchmark_search(options: Namespace) -> dict[str, float]:
+    # Indexing every layer of a lazily opened file, as the editor does in the background, then the queries
+    from GCodeSearch import SearchIndex, SearchQuery
+
+    model = Model.parse_gcode_lazy(options.input)
+    results = add_throughput(measure(lambda search_index: search_index.index_model(model), options.runs, SearchIndex), options.commands)
+
+    search_index = SearchIndex()
+    search_index.index_model(model)
+    for name, text in SEARCH_QUERIES.items():
+        query = SearchQuery(text)
+        results[f"{name}_query_seconds"] = measure(lambda _: sum(map(len, search_index.search(model, query))), options.runs)["seconds"]
+    return results
+
+
+def benchmark_recalculate_extrusion(options: Namespace) -> dict[str, float]:
+    flow_model = FlowModel(0.2, 0.4)
+
+    def recalculate(model: Model) -> None:
+        model.recalculate_extrusion(model.get_layers(), flow_model)
+
+    return add_throughput(measure(recalculate, options.runs, lambda: parse_file(options.input)), options.commands)
+
+
+def benchmark_estimate(options: Namespace) -> dict[str, float]:
+    # Every layer is estimated, a fresh estimator has none of them cached
+    from GCodeEstimator import PrintEstimator, MotionModel
+
+    model = parse_file(options.input)
+    results = measure(lambda estimator: estimator.estimate_model(model), options.runs, lambda: PrintEstimator(MotionModel()))
+    return add_throughput(results, options.commands)
+
+
+def benchmark_delete(options: Namespace) -> dict[str, float]:
+    # Removes every other command of every feature, the most scattered selection there is
+    def delete(model: Model) -> None:
+        for layer in model.get_layers():
+            for feature in layer.get_features():
+                feature.remove_children([range(0, feature.command_count(), 2)])
+
+    return add_throughput(measure(delete, options.runs, lambda: parse_file(options.input)), options.commands)
+
+
+def time_process(arguments: list[str]) -> dict[str, float]:
+    # Seconds from launching the process to every line it prints and to its exit
+    times = {}
+    start = time.perf_counter()
+    with subprocess.Popen([sys.executable] + arguments, cwd=DIRECTORY, stdout=subprocess.PIPE, text=True) as process:
+        for line in process.stdout:
+            times[line.strip()] = time.perf_counter() - start
+    times["exit"] = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(arguments)} exited with {process.returncode}")
+    return times
+
+
+def benchmark_startup(options: Namespace) -> dict[str, float]:
+    # Cold start of the interpreter alone, of importing the model for scripting and of the editor until its window
+    # is first painted and until the canvas exists
+    samples = {}
+    for _ in range(options.runs):
+        for name, arguments in (("interpreter_seconds", ["-c", "pass"]),
+                                ("import_model_seconds", ["-c", "import GCodeModel"]),
+                                ("import_cli_seconds", ["-c", "import GCodeCli"])):
+            samples.setdefault(name, []).append(time_process(arguments)["exit"])
+
+        times = time_process(["GCodeEditor.py", "--startup-benchmark"])
+        samples.setdefault("first_paint_seconds", []).append(times["first-paint"])
+        samples.setdefault("render_created_seconds", []).append(times["render-created"])
+
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+
+# Benchmarks that work on the input file, startup doesn't need one
+BENCHMARKS: dict[str, Callable[[Namespace], dict[str, float]]] = {
+    "parse": benchmark_parse,
+    "export": benchmark_export,
+    "export-modified": benchmark_export_modified,
+    "render": benchmark_render,
+    "preview": benchmark_preview,
+    "navigate": benchmark_navigate,
+    "recalculate-extrusion": benchmark_recalculate_extrusion,
+    "estimate": benchmark_estimate,
+    "search": benchmark_search,
+    "delete": benchmark_delete,
+    "startup": benchmark_startup,
+    }
+
+
+def compare_results(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], tolerance: float) -> bool:
+    # Prints the change of every measurement against the baseline, returns whether any got worse by more than tolerance
+    regressed = False
+    for name, measurements in results.items():
+        for measurement, value in measurements.items():
+            before = baseline.get(name, {}).get(measurement)
+            if before == None or before == 0:
+                continue
+
+            change = value / before - 1
+            worse = change if measurement.endswith(LOWER_IS_BETTER) else -change
+            verdict = "worse" if worse > tolerance else "better" if worse < -tolerance else ""
+            regressed = regressed or verdict == "worse"
+            print(f"{name:22} {measurement:24} {before:12.4g} {value:12.4g} {change * 100:+8.1f}% {verdict}")
+    return regressed
+
+
+def main(arguments: list[str] = None) -> int:
+    parser = ArgumentParser(prog="python Benchmark.py", description="Measures the performance of the editor.")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK", help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--runs", type=int, default=5, help="number of timed runs, the median is reported")
+    parser.add_argument("--input", help="G-code file to benchmark instead of a generated one")
+    parser.add_argument("--layers", type=int, default=100, help="layers of the generated file")
+    parser.add_argument("--features", type=int, default=6, help="features per layer of the generated file")
+    parser.add_argument("--commands", type=int, default=400, help="commands per feature of the generated file")
+    parser.add_argument("--comment-density", type=float, default=0.05, help="comments per command of the generated file")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated file")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change that counts as a regression when comparing")
+    options = parser.parse_args(arguments)
+
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}, expected one of {', '.join(BENCHMARKS)}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        parameters = {"runs": options.runs}
+        if options.input == None:
+            options.input = os.path.join(directory, "benchmark.gcode")
+            generate_gcode(options.input, options.layers, options.features, options.commands, options.comment_density, options.seed)
+            parameters.update(layers=options.layers, features=options.features, commands=options.commands,
+                              comment_density=options.comment_density, seed=options.seed)
+        else:
+            parameters.update(input=os.path.abspath(options.input))
+        parameters["size"] = os.path.getsize(options.input)
+
+        # Generated commands only count the moves, the throughput is based on everything that was parsed
+        options.commands = count_commands(parse_file(options.input))
+        parameters["command_count"] = options.commands
+
+        results = {}
+        for name in options.benchmarks or BENCHMARKS:
+            results[name] = BENCHMARKS[name](options)
+            for measurement, value in results[name].items():
+                print(f"{name:22} {measurement:24} {value:12.4g}")
+
+    if options.output != None:
+        environment = {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor(),
+                       "cpu_count": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        with open(options.output, "w") as file:
+            json.dump({"environment": environment, "parameters": parameters, "results": results}, file, indent=4)
+
+    if options.compare != None:
+        with open(options.compare, "r") as file:
+            baseline = json.load(file)
+        if baseline["parameters"] != parameters:
+            print("Warning: the baseline was measured with different parameters", file=sys.stderr)
+        if compare_results(results, baseline["results"], options.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
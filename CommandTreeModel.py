@@ -0,0 +1,477 @@
+from __future__ import annotations
+
+from array import array
+from collections.abc import Callable
+
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import QModelIndex, Qt
+
+from GCodeModel import Model, Layer, Feature, Command, Child, Parent, FlowModel
+from GCodeJournal import Journal, JournalEntry
+
+
+class CommandTreeModel(QtCore.QAbstractItemModel):
+    # Item model over the Model hierarchy: Post-Print, the layers from the top down and Pre-Print at the top level,
+    # features below the layers and commands below the features. Nothing is created per row, the text and
+    # color of a row are computed when the view asks for them, so only the visible rows cost anything.
+    #
+    # The commands of a feature are handed to the view in batches as it scrolls down through fetchMore, an
+    # expanded feature only ever has as many rows in the view as were shown.
+    #
+    # The internal id of an index is the key of its parent in nodes, 0 for the top level. Ids are used instead of
+    # internal pointers so an index that outlives its parent can never point at a collected object.
+    model: Model = None
+    # Undo history of the model, every edit made through the item model is recorded in it
+    journal: Journal
+    nodes: dict[int, Parent]
+    # Index of every layer in the model by id, the top level row of a layer is derived from it
+    layer_indexes: dict[int, int]
+    # Index of every parent that was asked for, by the key of the parent
+    parent_indexes: dict[int, QModelIndex]
+    # Number of commands of a feature that were fetched into the view, by id of the feature
+    fetched: dict[int, int]
+    saved_indexes: list[tuple[QModelIndex, Feature, int]]
+    saved_complete: set[int]
+
+    item_edited = QtCore.pyqtSignal(QModelIndex)
+
+    EDITABLE_FLAGS = Qt.ItemIsSelectable | Qt.ItemIsEditable | Qt.ItemIsEnabled
+    FIXED_FLAGS = Qt.ItemIsSelectable | Qt.ItemIsEnabled
+    FETCH_BATCH_SIZE: int = 500
+
+    COLORS = {
+        "WHITE"  : QtGui.QBrush(QtGui.QColor("white")),
+        "RED"    : QtGui.QBrush(QtGui.QColor(255, 100, 100)),
+        "GREEN"  : QtGui.QBrush(QtGui.QColor("green")),
+        "BLUE"   : QtGui.QBrush(QtGui.QColor(100, 100, 255)),
+        "MAGENTA": QtGui.QBrush(QtGui.QColor("magenta")),
+        }
+
+    def __init__(self, parent: QtCore.QObject = None) -> None:
+        super().__init__(parent)
+        self.journal = Journal()
+        self.nodes = {}
+        self.layer_indexes = {}
+        self.parent_indexes = {}
+        self.fetched = {}
+        self.saved_indexes = []
+        self.saved_complete = set()
+
+    def set_model(self, model: Model) -> None:
+        self.beginResetModel()
+        self.model = model
+        self.journal = Journal()
+        self.nodes = {}
+        self.fetched = {}
+        self.update_layer_indexes()
+        self.endResetModel()
+
+    def add_layers(self, layers: list[Layer]) -> None:
+        # New layers go on top, right below Post-Print
+        if len(layers) == 0:
+            return
+
+        self.beginInsertRows(QModelIndex(), 1, len(layers))
+        for layer in layers:
+            self.model.add_layer(layer)
+        self.update_layer_indexes()
+        self.endInsertRows()
+
+    def update_layer_indexes(self) -> None:
+        # Called whenever layers or features moved, the rows of parents change with them
+        self.parent_indexes = {}
+        self.layer_indexes = {} if self.model == None else {id(layer): index for index, layer in enumerate(self.model.get_layers())}
+
+    ### ================ I T E M   M O D E L ================ ###
+
+    # The view calls index and flags for every child of an expanded row, so both are kept as short as possible
+    def index(self, row: int, column: int, parent: QModelIndex = QModelIndex()) -> QModelIndex:
+        if self.model == None or column != 0 or row < 0:
+            return QModelIndex()
+
+        if not parent.isValid():
+            if row >= self.model.layer_count() + 2:
+                return QModelIndex()
+            return self.createIndex(row, 0, 0)
+
+        reference = self.get_reference(parent)
+        if isinstance(reference, Feature):
+            if row >= self.fetched.get(id(reference), 0):
+                return QModelIndex()
+        elif not isinstance(reference, Layer) or row >= reference.feature_count():
+            return QModelIndex()
+        return self.createIndex(row, 0, self.add_node(reference))
+
+    def parent(self, index: QModelIndex) -> QModelIndex:
+        # Selections ask for the parent of their ranges over and over, the index of every parent is kept
+        key = index.internalId() if index.isValid() else 0
+        parent_index = self.parent_indexes.get(key)
+        if parent_index != None:
+            return parent_index
+
+        node = self.nodes.get(key)
+        if node == None:
+            return QModelIndex()
+
+        if isinstance(node, Layer):
+            parent_index = self.createIndex(self.get_layer_row(node), 0, 0)
+        elif isinstance(node.parent, Model):
+            # Features of the model itself are top level rows
+            parent_index = self.createIndex(self.get_feature_row(node), 0, 0)
+        else:
+            parent_index = self.createIndex(node.parent.children.index(node), 0, self.add_node(node.parent))
+
+        self.parent_indexes[key] = parent_index
+        return parent_index
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if self.model == None:
+            return 0
+        if not parent.isValid():
+            return self.model.layer_count() + 2
+
+        reference = self.get_reference(parent)
+        if isinstance(reference, Layer):
+            return reference.feature_count()
+        if isinstance(reference, Feature):
+            return self.fetched.get(id(reference), 0)
+        return 0
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 1
+
+    def hasChildren(self, parent: QModelIndex = QModelIndex()) -> bool:
+        # Layers show an expand button without being loaded, they are only parsed once they are opened
+        if not parent.isValid():
+            return self.model != None
+        return not self.is_command_index(parent)
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:
+        if not parent.isValid() or self.is_command_index(parent):
+            return False
+        reference = self.get_reference(parent)
+        return isinstance(reference, Feature) and self.fetched.get(id(reference), 0) < reference.command_count()
+
+    def fetchMore(self, parent: QModelIndex) -> None:
+        self.fetch_to(parent, self.rowCount(parent) + self.FETCH_BATCH_SIZE - 1)
+
+    def flags(self, index: QModelIndex) -> Qt.ItemFlags:
+        # Commands and features are editable, the names of the top level rows are fixed
+        if self.nodes.get(index.internalId()) != None:
+            return self.EDITABLE_FLAGS
+        return self.FIXED_FLAGS if index.isValid() else Qt.NoItemFlags
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            return self.get_text(index)
+        if role == Qt.ForegroundRole:
+            return self.get_color(self.get_text(index))
+        return None
+
+    def setData(self, index: QModelIndex, value, role: int = Qt.EditRole) -> bool:
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+
+        if self.is_command_index(index):
+            feature: Feature = self.nodes[index.internalId()]
+            row = feature.rows[index.row()]
+            # The editor commits unchanged text too, only actual edits should mark the layer as modified
+            if value == feature.store.get_command(row):
+                return False
+            self.journal.begin("Edit command")
+            self.journal.watch_rows(feature, (row,))
+            Command(feature, row).parse_command(value)
+            self.journal.end()
+        else:
+            feature: Feature = self.get_reference(index)
+            if value == feature.name:
+                return False
+            self.journal.begin("Rename feature")
+            self.journal.watch_name(feature)
+            feature.name = value
+            feature.modified()
+            self.journal.end()
+
+        self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.EditRole, Qt.ForegroundRole])
+        self.item_edited.emit(index)
+        return True
+
+    ### ================ P U B L I C   F U N C T I O N S ================ ###
+
+    def fetch_to(self, parent: QModelIndex, row: int) -> None:
+        # Makes sure the view has the commands of a feature up to the given row
+        feature = self.get_reference(parent)
+        if not isinstance(feature, Feature):
+            return
+
+        fetched = self.fetched.get(id(feature), 0)
+        row = min(row, feature.command_count() - 1)
+        if row < fetched:
+            return
+
+        self.add_node(feature)
+        self.beginInsertRows(parent, fetched, row)
+        self.fetched[id(feature)] = row + 1
+        self.endInsertRows()
+
+    def add_node(self, node: Parent) -> int:
+        key = id(node)
+        if key not in self.nodes:
+            self.nodes[key] = node
+        return key
+
+    def is_command_index(self, index: QModelIndex) -> bool:
+        return isinstance(self.nodes.get(index.internalId()), Feature)
+
+    def get_layer_row(self, layer: Layer) -> int:
+        return self.model.layer_count() - self.layer_indexes[id(layer)]
+
+    def get_feature_row(self, feature: Feature) -> int:
+        return 0 if feature is self.model.feature_post_print else self.model.layer_count() + 1
+
+    def get_layer_index(self, index: QModelIndex) -> int:
+        # Index of the layer of a top level row, None for the pre-print and post-print rows
+        layer_index = self.model.layer_count() - index.row()
+        if index.parent().isValid() or layer_index < 0 or layer_index >= self.model.layer_count():
+            return None
+        return layer_index
+
+    def get_layer_model_index(self, layer_index: int) -> QModelIndex:
+        return self.index(self.model.layer_count() - layer_index, 0)
+
+    def get_reference(self, index: QModelIndex) -> Child:
+        parent = self.nodes.get(index.internalId())
+        if parent == None:
+            if index.row() == 0:
+                return self.model.feature_post_print
+            if index.row() == self.model.layer_count() + 1:
+                return self.model.feature_pre_print
+            return self.model.get_layers()[self.model.layer_count() - index.row()]
+        if isinstance(parent, Layer):
+            return parent.get_feature(index.row())
+        return parent.get_command(index.row())
+
+    def get_rows(self, index: QModelIndex) -> tuple[Feature, list[int]]:
+        # Store rows below an index of a feature or a command, without creating a view per command
+        parent = self.nodes.get(index.internalId())
+        if isinstance(parent, Feature):
+            return parent, (parent.rows[index.row()],)
+
+        reference = self.get_reference(index)
+        if isinstance(reference, Feature):
+            return reference, reference.rows
+        return None, ()
+
+    def get_selection_rows(self, selection: QtCore.QItemSelection) -> list[tuple[Feature, array]]:
+        # Same as get_rows for every selected index, a range of selected commands is sliced at once
+        selected_rows = []
+        for selection_range in selection:
+            first, last = selection_range.top(), selection_range.bottom() + 1
+            if not selection_range.parent().isValid():
+                references = [self.get_reference(self.index(row, 0)) for row in range(first, last)]
+                selected_rows += [(feature, feature.rows) for feature in references if isinstance(feature, Feature)]
+                continue
+
+            parent = self.get_reference(selection_range.parent())
+            if isinstance(parent, Feature):
+                selected_rows.append((parent, parent.rows[first:last]))
+            else:
+                selected_rows += [(feature, feature.rows) for feature in parent.get_features()[first:last]]
+        return selected_rows
+
+    def get_text(self, index: QModelIndex) -> str:
+        parent = self.nodes.get(index.internalId())
+        if isinstance(parent, Feature):
+            return parent.store.get_command(parent.rows[index.row()])
+        if isinstance(parent, Layer):
+            return parent.get_feature(index.row()).name
+
+        if index.row() == 0:
+            return "Post-Print"
+        if index.row() == self.model.layer_count() + 1:
+            return "Pre-Print"
+        return "Layer " + str(self.model.layer_count() - index.row())
+
+    def get_color(self, text: str) -> QtGui.QBrush:
+        if text.startswith("G0"):
+            return self.COLORS["MAGENTA"]
+        elif text.startswith("G1"):
+            return self.COLORS["BLUE"]
+        elif text.startswith(";"):
+            return self.COLORS["GREEN"]
+        elif text.startswith("M"):
+            return self.COLORS["RED"]
+        return self.COLORS["WHITE"]
+
+    def begin_layout_change(self) -> None:
+        # The model is about to be changed directly, not through this item model. Persistent indexes, like the selection,
+        # are remembered by what they show (the layer, the feature or the store row of the command) so they can follow it.
+        self.layoutAboutToBeChanged.emit()
+        # Features that were fetched completely stay that way
+        self.saved_complete = {key for key, count in self.fetched.items() if count == self.nodes[key].command_count()}
+        self.saved_indexes = []
+        for index in self.persistentIndexList():
+            node = self.nodes.get(index.internalId())
+            if isinstance(node, Feature):
+                self.saved_indexes.append((index, node, node.rows[index.row()]))
+            else:
+                self.saved_indexes.append((index, node, self.get_reference(index)))
+
+    def end_layout_change(self, changed_parents: list[Parent]) -> None:
+        # changed_parents are the features, layers or the model whose children changed.
+        # Indexes of anything that is no longer part of the model become invalid.
+        self.update_layer_indexes()
+        for parent in changed_parents:
+            if isinstance(parent, Feature) and id(parent) in self.fetched:
+                count = parent.command_count()
+                self.fetched[id(parent)] = count if id(parent) in self.saved_complete else min(self.fetched[id(parent)], count)
+
+        changed_parents = {id(parent) for parent in changed_parents}
+        positions: dict[int, dict[int, int]] = {}
+
+        old_indexes = []
+        new_indexes = []
+        for index, node, key in self.saved_indexes:
+            if node == None:
+                if isinstance(key, Layer):
+                    position = self.get_layer_row(key) if id(key) in self.layer_indexes else None
+                else:
+                    position = self.get_feature_row(key)
+            elif not self.is_attached(node):
+                position = None
+            elif isinstance(node, Layer):
+                position = node.children.index(key) if key in node.children else None
+            elif id(node) in changed_parents:
+                if id(node) not in positions:
+                    positions[id(node)] = {row: position for position, row in enumerate(node.rows)}
+                position = positions[id(node)].get(key)
+                if position != None:
+                    self.fetched[id(node)] = max(self.fetched.get(id(node), 0), position + 1)
+            else:
+                position = index.row()
+
+            if position == index.row():
+                continue
+            old_indexes.append(index)
+            new_indexes.append(QModelIndex() if position == None else self.createIndex(position, 0, index.internalId()))
+
+        self.changePersistentIndexList(old_indexes, new_indexes)
+        self.saved_indexes = []
+        self.saved_complete = set()
+        self.remove_detached_nodes()
+        self.layoutChanged.emit()
+
+    def remove_detached_nodes(self) -> None:
+        # Layers and features that were removed are no longer kept alive by nodes, their persistent indexes were
+        # invalidated above. If an undo brings them back they are added again once the view asks for them.
+        children: dict[int, set[int]] = {}
+
+        def is_attached(node: Parent) -> bool:
+            if isinstance(node, Layer):
+                return id(node) in self.layer_indexes
+            if isinstance(node.parent, Model):
+                return True
+            if id(node.parent) not in children:
+                children[id(node.parent)] = {id(feature) for feature in node.parent.children} if is_attached(node.parent) else set()
+            return id(node) in children[id(node.parent)]
+
+        for key in [key for key, node in self.nodes.items() if not is_attached(node)]:
+            del self.nodes[key]
+            self.fetched.pop(key, None)
+
+    def is_attached(self, node: Parent) -> bool:
+        # Whether a layer or feature is still part of the model
+        if isinstance(node, Layer):
+            return id(node) in self.layer_indexes
+        if isinstance(node.parent, Model):
+            return True
+        return any(feature is node for feature in node.parent.children) and self.is_attached(node.parent)
+
+    def recalculate_extrusion(self, indexes: list[QModelIndex], flow_model: FlowModel) -> None:
+        # Only the selected moves change, but G92 commands can be added anywhere in their layers
+        references = [self.get_reference(index) for index in indexes]
+
+        self.journal.begin("Recalculate extrusion")
+        for index in indexes:
+            feature, rows = self.get_rows(index)
+            if feature != None:
+                self.journal.watch_rows(feature, rows)
+            else:
+                for feature in self.get_reference(index).get_features():
+                    self.journal.watch_rows(feature, feature.rows)
+
+        for layer in {id(reference): reference for reference in map(self.get_layer_of, references) if reference != None}.values():
+            for feature in layer.get_features():
+                self.journal.watch_children(feature)
+
+        self.begin_layout_change()
+        extended_features = self.model.recalculate_extrusion(references, flow_model)
+        self.end_layout_change(extended_features)
+        self.journal.end()
+
+    def get_layer_of(self, reference: Child) -> Layer:
+        while reference != None and not isinstance(reference, Layer):
+            reference = reference.parent if isinstance(reference, (Command, Feature)) else None
+        return reference
+
+    def undo(self) -> JournalEntry:
+        return self.apply_journal(self.journal.undo)
+
+    def redo(self) -> JournalEntry:
+        return self.apply_journal(self.journal.redo)
+
+    def apply_journal(self, step: Callable[[], JournalEntry]) -> JournalEntry:
+        self.begin_layout_change()
+        entry = step()
+        self.end_layout_change(entry.get_parents() if entry != None else [])
+        return entry
+
+    def insert_row(self, parent: QModelIndex, row: int) -> QModelIndex:
+        # Inserts an empty command into a feature, or an empty feature into a layer
+        reference = self.get_reference(parent)
+        if not isinstance(reference, (Layer, Feature)):
+            return QModelIndex()
+
+        self.journal.begin("Insert")
+        self.journal.watch_children(reference)
+        self.beginInsertRows(parent, row, row)
+        if isinstance(reference, Feature):
+            reference.insert_command("", row)
+            self.fetched[self.add_node(reference)] = self.fetched.get(id(reference), 0) + 1
+        else:
+            reference.insert_feature(Feature(reference, ""), row)
+            self.parent_indexes = {}
+        self.endInsertRows()
+        self.journal.end()
+        return self.index(row, 0, parent)
+
+    def remove_rows(self, selection: QtCore.QItemSelection) -> None:
+        # The selected rows are grouped by their parent, every parent removes all of its rows at once.
+        # The pre-print and post-print features are part of the model and are never removed.
+        removed: dict[int, tuple[Parent, list[range]]] = {}
+        for selection_range in selection:
+            first, last = selection_range.top(), selection_range.bottom() + 1
+            if selection_range.parent().isValid():
+                parent = self.get_reference(selection_range.parent())
+                removed.setdefault(id(parent), (parent, []))[1].append(range(first, last))
+                continue
+
+            for row in range(first, last):
+                layer = self.get_reference(self.index(row, 0))
+                if isinstance(layer, Layer):
+                    position = self.layer_indexes[id(layer)]
+                    removed.setdefault(id(self.model), (self.model, []))[1].append(range(position, position + 1))
+
+        if len(removed) == 0:
+            return
+
+        self.journal.begin("Remove")
+        self.begin_layout_change()
+        for parent, ranges in removed.values():
+            self.journal.watch_children(parent)
+            parent.remove_children(ranges)
+        self.end_layout_change([parent for parent, _ in removed.values()])
+        self.journal.end()
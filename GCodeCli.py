@@ -0,0 +1,216 @@
+from __future__ import annotations
+from argparse import ArgumentParser, Namespace
+from collections.abc import Callable
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from GCodeModel import Model, Layer, FlowModel
+
+# Command line processing of G-code files without the editor window, nothing here imports PyQt5 or matplotlib:
+#
+#     python -m GCodeCli process in.gcode -o out.gcode --op recalculate-extrusion --op remove-features=SKIRT
+#     python -m GCodeCli estimate in.gcode --acceleration 1000 --jerk 8
+#     python -m GCodeCli search in.gcode "G0 Z>10"
+#
+# The input file is memory mapped and every layer is parsed, processed, written and dropped again in turn,
+# so files larger than the available memory can be processed. Layers that no operation touches are copied as they are.
+
+WRITE_BUFFER_SIZE: int = 1 << 24
+
+
+def recalculate_extrusion(model: Model, layer: Layer, argument: str, options: Namespace) -> None:
+    model.recalculate_extrusion([layer], options.flow_model)
+
+
+def remove_features(model: Model, layer: Layer, argument: str, options: Namespace) -> None:
+    names = set(argument.split(","))
+    layer.remove_children([feature for feature in layer.get_features() if feature.name in names])
+
+
+# Operation name: function and whether it takes an argument
+OPERATIONS: dict[str, tuple[Callable[[Model, Layer, str, Namespace], None], bool]] = {
+    "recalculate-extrusion": (recalculate_extrusion, False),
+    "remove-features": (remove_features, True),
+    }
+
+
+def parse_operations(parser: ArgumentParser, operations: list[str]) -> list[tuple[Callable, str]]:
+    parsed = []
+    for operation in operations:
+        name, _, argument = operation.partition("=")
+        if name not in OPERATIONS:
+            parser.error(f"unknown operation {name}, expected one of {', '.join(OPERATIONS)}")
+
+        function, takes_argument = OPERATIONS[name]
+        if takes_argument != (argument != ""):
+            parser.error(f"operation {name} {'needs' if takes_argument else 'takes no'} argument")
+        parsed.append((function, argument))
+    return parsed
+
+
+def parse_layers(parser: ArgumentParser, layers: str) -> range:
+    # FIRST-LAST, both included, either can be left out
+    if layers == None:
+        return None
+
+    first, _, last = layers.partition("-")
+    try:
+        return range(int(first or 0), int(last) + 1 if last else sys.maxsize)
+    except ValueError:
+        parser.error(f"invalid layer range {layers}, expected FIRST-LAST")
+
+
+def process_file(options: Namespace) -> None:
+    model = Model.parse_gcode_lazy(options.input)
+
+    layer_height = options.layer_height or model.layer_height or 0.2
+    options.flow_model = FlowModel(layer_height, options.line_width, options.filament_diameter, options.flow_multiplier)
+
+    layer_indexes = {id(layer): index for index, layer in enumerate(model.get_layers())}
+
+    def process_layer(layer: Layer) -> None:
+        if options.layers != None and layer_indexes[id(layer)] not in options.layers:
+            return
+        for function, argument in options.operations:
+            function(model, layer, argument, options)
+
+    if options.output == "-":
+        model.export(sys.stdout, process_layer=process_layer)
+        return
+
+    # On Windows a file can't be replaced while it is mapped, so the remaining layers are loaded first
+    if os.name == "nt" and model.source_file != None and os.path.exists(options.output) and os.path.samefile(options.input, options.output):
+        model.release_source()
+
+    # Same as saving in the editor: the output only replaces the target once it is complete
+    directory = os.path.dirname(os.path.abspath(options.output))
+    handle, temp_filename = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+
+    try:
+        with open(handle, "w", buffering=WRITE_BUFFER_SIZE) as file:
+            model.export(file, process_layer=process_layer)
+
+        if os.path.exists(options.output):
+            shutil.copymode(options.output, temp_filename)
+        else:
+            os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, options.output)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def format_time(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02}m {seconds:02}s"
+
+
+def estimate_file(options: Namespace) -> None:
+    # Needs NumPy, which processing files doesn't
+    from GCodeEstimator import PrintEstimator, MotionModel
+
+    model = Model.parse_gcode_lazy(options.input)
+    motion_model = MotionModel(options.acceleration, options.jerk, options.travel_acceleration, options.retract_acceleration)
+    estimate = PrintEstimator(motion_model).estimate_model(model)
+
+    print(f"Print time  {format_time(estimate.time)} ({estimate.time:.1f} s)")
+    print(f"Filament    {estimate.filament / 1000.0:.2f} m")
+
+    # Totals per feature type
+    totals = {}
+    for layer_estimate in [estimate.pre_print, *estimate.layers, estimate.post_print]:
+        for name, time, filament in zip(layer_estimate.feature_names, layer_estimate.feature_times, layer_estimate.feature_filament):
+            total_time, total_filament = totals.get(name, (0.0, 0.0))
+            totals[name] = (total_time + time, total_filament + filament)
+
+    print()
+    for name, (time, filament) in totals.items():
+        print(f"{name:20} {format_time(time):>14} {filament / 1000.0:10.2f} m")
+
+    if options.per_layer:
+        print()
+        for index, layer_estimate in enumerate(estimate.layers):
+            print(f"Layer {index:<14} {format_time(layer_estimate.time):>14} {layer_estimate.total_filament / 1000.0:10.2f} m")
+
+
+def search_file(options: Namespace) -> None:
+    # Needs NumPy as well, the query syntax is described in GCodeSearch.SearchQuery
+    from GCodeSearch import SearchIndex, SearchQuery
+
+    try:
+        query = SearchQuery(options.query)
+    except re.error as error:
+        raise ValueError(f"invalid regular expression: {error}") from error
+
+    model = Model.parse_gcode_lazy(options.input)
+    total = 0
+    for matches in SearchIndex().search(model, query):
+        total += len(matches)
+        if options.count or len(matches) == 0:
+            continue
+
+        if matches.layer != None:
+            name = f"Layer {matches.layer}"
+        else:
+            name = "Pre-Print" if matches.parent is model.feature_pre_print else "Post-Print"
+        for feature, command, text in zip(matches.features.tolist(), matches.commands.tolist(), matches.texts):
+            print(f"{name}, feature {feature}, command {command}: {text}")
+
+    if options.count:
+        print(total)
+
+
+def main(arguments: list[str] = None) -> int:
+    parser = ArgumentParser(prog="python -m GCodeCli", description="Processes G-code files without the editor window.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    process = commands.add_parser("process", help="apply operations to a file and write the result")
+    process.add_argument("input", help="G-code file to read")
+    process.add_argument("-o", "--output", required=True, help="file to write, - for standard output")
+    process.add_argument("--op", dest="operations", action="append", default=[], metavar="NAME[=ARGUMENT]",
+                         help="operation to apply to every layer, in the order given: " + ", ".join(
+                             name + ("=ARGUMENT" if takes_argument else "") for name, (_, takes_argument) in OPERATIONS.items()))
+    process.add_argument("--layers", metavar="FIRST-LAST", help="only apply the operations to these layers")
+    process.add_argument("--layer-height", type=float, help="layer height for recalculate-extrusion, read from the file by default")
+    process.add_argument("--line-width", type=float, default=0.4, help="line width for recalculate-extrusion")
+    process.add_argument("--filament-diameter", type=float, default=1.75, help="filament diameter for recalculate-extrusion")
+    process.add_argument("--flow-multiplier", type=float, default=1.0, help="flow multiplier for recalculate-extrusion")
+
+    estimate = commands.add_parser("estimate", help="estimate the print time and filament use of a file")
+    estimate.add_argument("input", help="G-code file to read")
+    estimate.add_argument("--acceleration", type=float, default=500.0, help="acceleration of printing moves in mm/s²")
+    estimate.add_argument("--travel-acceleration", type=float, help="acceleration of travel moves, same as printing by default")
+    estimate.add_argument("--retract-acceleration", type=float, help="acceleration of retractions, same as printing by default")
+    estimate.add_argument("--jerk", type=float, default=10.0, help="speed change in mm/s the printer makes without accelerating")
+    estimate.add_argument("--per-layer", action="store_true", help="also list the time and filament of every layer")
+
+    search = commands.add_parser("search", help="list the commands that match a query")
+    search.add_argument("input", help="G-code file to read")
+    search.add_argument("query", help="terms that must all match, like M106, Z>10, F<=1200, E, ;TYPE:SKIRT or /regex/")
+    search.add_argument("--count", action="store_true", help="only print the number of matching commands")
+
+    options = parser.parse_args(arguments)
+
+    try:
+        if options.command == "estimate":
+            estimate_file(options)
+            return 0
+        if options.command == "search":
+            search_file(options)
+            return 0
+
+        options.operations = parse_operations(parser, options.operations)
+        options.layers = parse_layers(parser, options.layers)
+        process_file(options)
+    except (OSError, ValueError) as error:
+        print(f"{parser.prog}: {options.input}: {error}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,40 +1,280 @@
+from __future__ import annotations
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
+
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
 import os.path
+import shutil
+import tempfile
+import time
+
+from GCodeModel import Model, Layer, FlowModel
+
+# Matplotlib and NumPy take longer to import than everything else together, the canvas imports them
+# once the window is on screen (see create_render)
+if TYPE_CHECKING:
+    import numpy as np
+    from MplCanvas import MplCanvas
+    from GCodeEstimator import PrintEstimator, PrintEstimate
+    from GCodeSearch import SearchIndex, SearchMatches
+
+from CommandTreeModel import CommandTreeModel
+
+class SaveWorker(QtCore.QThread):
+    # Writes the model to a temporary file next to the target and moves it over the target once it is complete,
+    # so a failed save never leaves a truncated file behind
+    WRITE_BUFFER_SIZE: int = 1 << 24
+
+    progress_changed = QtCore.pyqtSignal(int)
+    save_failed = QtCore.pyqtSignal(str)
+
+    model: Model
+    filename: str
+    percent: int = -1
+
+    def __init__(self, model: Model, filename: str) -> None:
+        super().__init__()
+        self.model = model
+        self.filename = filename
+
+    def on_progress(self, fraction: float) -> None:
+        percent = int(fraction * 100)
+        if percent != self.percent:
+            self.percent = percent
+            self.progress_changed.emit(percent)
+
+    def run(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        handle, temp_filename = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+
+        try:
+            with open(handle, "w", buffering=self.WRITE_BUFFER_SIZE) as file:
+                self.model.export(file, self.on_progress)
+
+            if os.path.exists(self.filename):
+                shutil.copymode(self.filename, temp_filename)
+            else:
+                os.chmod(temp_filename, 0o644)
+            os.replace(temp_filename, self.filename)
+        except Exception as error:
+            # Anything going wrong while writing must still end the save, or the editor stays disabled
+            self.save_failed.emit(str(error))
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+
+class LoadWorker(QtCore.QThread):
+    # Opens a file while the window stays responsive. The model is handed over as soon as the parts outside
+    # of the layers are parsed, the layers follow in batches as the file is scanned, the main thread adds them.
+    model_opened = QtCore.pyqtSignal(object)
+    layers_found = QtCore.pyqtSignal(object)
+    progress_changed = QtCore.pyqtSignal(int)
+    load_failed = QtCore.pyqtSignal(str)
+
+    filename: str
+    percent: int = -1
+    failed: bool = False
+    cancelled: bool = False
+
+    def __init__(self, filename: str) -> None:
+        super().__init__()
+        self.filename = filename
+
+    def on_progress(self, fraction: float) -> None:
+        percent = int(fraction * 100)
+        if percent != self.percent:
+            self.percent = percent
+            self.progress_changed.emit(percent)
+
+    def run(self) -> None:
+        model = None
+
+        try:
+            for step_model, layers, fraction in Model.parse_gcode_progressive(self.filename):
+                if self.isInterruptionRequested():
+                    self.cancelled = True
+                    return
+
+                if step_model != None and step_model is not model:
+                    model = step_model
+                    self.model_opened.emit(model)
+                if len(layers) > 0:
+                    self.layers_found.emit(layers)
+                self.on_progress(fraction)
+        except (OSError, ValueError) as error:
+            self.failed = True
+            self.load_failed.emit(str(error))
+
+
+class EstimateWorker(QtCore.QThread):
+    # Estimates the print time of a whole file, parsing the layers that aren't loaded yet takes a while
+    progress_changed = QtCore.pyqtSignal(int)
+
+    model: Model
+    estimator: PrintEstimator
+    estimate: PrintEstimate = None
+    percent: int = -1
+
+    def __init__(self, model: Model, estimator: PrintEstimator) -> None:
+        super().__init__()
+        self.model = model
+        self.estimator = estimator
+
+    def on_progress(self, fraction: float) -> None:
+        percent = int(fraction * 100)
+        if percent != self.percent:
+            self.percent = percent
+            self.progress_changed.emit(percent)
+
+    def run(self) -> None:
+        self.estimate = self.estimator.estimate_model(self.model, self.on_progress)
+
+
+class SearchWorker(QtCore.QThread):
+    # Indexes the layers that aren't loaded for searching, so the first search doesn't have to parse them
+    model: Model
+    search_index: SearchIndex
+
+    def __init__(self, model: Model, search_index: SearchIndex) -> None:
+        super().__init__()
+        self.model = model
+        self.search_index = search_index
 
-from GCodeModel import Model, Layer, Feature, Command, Child
-from io import TextIOWrapper
+    def run(self) -> None:
+        self.search_index.index_model(self.model, is_cancelled=self.isInterruptionRequested)
 
-from MplCanvas import MplCanvas
 
-class ReferenceTreeWidgetItem(QtWidgets.QTreeWidgetItem):
-    model_reference: Child
-    children_populated: bool = False
+class StageTimes:
+    # How often a stage of showing a layer ran, and its total and longest time in seconds
+    count: int = 0
+    total: float = 0.0
+    longest: float = 0.0
 
-    def __init__(self, parent, model_reference: Child) -> None:
-        super().__init__(parent)
-        self.model_reference = model_reference
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
 
+    def get_mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
 
-class TopLevelTreeItem(ReferenceTreeWidgetItem):
-    def __init__(self, parent, model_reference: Layer) -> None:
-        super().__init__(parent, model_reference)
+
+class LayerScheduler(QtCore.QObject):
+    # Decides when the layer picked with the slider or the buttons is shown. Requests are coalesced: the canvas is
+    # drawn for the latest requested layer once the pending input has been handled, the layers requested in between
+    # are skipped. The layer is only opened in the tree once no other layer was requested for SETTLE_TIME and the
+    # slider is let go, listing it loads the whole layer.
+    render_due = QtCore.pyqtSignal(int)
+    settled = QtCore.pyqtSignal(int)
+
+    SETTLE_TIME: int = 150
+
+    requested_index: int = None
+    request_time: float = None
+    settle_index: int = None
+    # Layer the canvas shows, it is not drawn again for a request of the same layer
+    rendered_index: int = None
+    is_held: bool = False
+    render_timer: QTimer
+    settle_timer: QTimer
+
+    # Timed stages: from the first request that isn't drawn yet until drawing starts, drawing the canvas and
+    # opening the layer in the tree. Skipped counts the requested layers that were never drawn.
+    stage_times: dict[str, StageTimes]
+    skipped: int = 0
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.stage_times = {"wait": StageTimes(), "render": StageTimes(), "tree": StageTimes()}
+
+        self.render_timer = QTimer()
+        self.render_timer.setSingleShot(True)
+        self.render_timer.timeout.connect(self.on_render_timeout)
+
+        self.settle_timer = QTimer()
+        self.settle_timer.setSingleShot(True)
+        self.settle_timer.timeout.connect(self.on_settle_timeout)
+
+    def request(self, index: int) -> None:
+        if self.requested_index == None:
+            self.request_time = time.perf_counter()
+        elif self.requested_index != index:
+            self.skipped += 1
+
+        self.requested_index = index
+        self.settle_index = index
+        self.render_timer.start(0)
+        self.settle_timer.start(self.SETTLE_TIME)
+
+    def mark_rendered(self, index: int) -> None:
+        self.rendered_index = index
+
+    def reset(self) -> None:
+        self.render_timer.stop()
+        self.settle_timer.stop()
+        self.requested_index = None
+        self.settle_index = None
+        self.rendered_index = None
+
+    def hold(self) -> None:
+        self.is_held = True
+
+    def release(self) -> None:
+        self.is_held = False
+        if self.settle_index != None:
+            self.settle_timer.start(self.SETTLE_TIME)
+
+    def on_render_timeout(self) -> None:
+        index = self.requested_index
+        self.requested_index = None
+        if index == None or index == self.rendered_index:
+            return
+
+        start = time.perf_counter()
+        self.stage_times["wait"].add(start - self.request_time)
+        self.render_due.emit(index)
+        self.stage_times["render"].add(time.perf_counter() - start)
+
+    def on_settle_timeout(self) -> None:
+        # Letting go of the slider starts the timer again
+        if self.is_held or self.settle_index == None:
+            return
+
+        index = self.settle_index
+        self.settle_index = None
+        start = time.perf_counter()
+        self.settled.emit(index)
+        self.stage_times["tree"].add(time.perf_counter() - start)
 
 
 class MainWindow(QtWidgets.QMainWindow):
     model: Model = None
     open_file: str = None
-    gcode_render: MplCanvas
+    gcode_render: MplCanvas = None
+    render_placeholder: QtWidgets.QWidget
+    first_paint_done: bool = False
+
+    first_painted = QtCore.pyqtSignal()
+    render_created = QtCore.pyqtSignal()
 
     extruder_width: float = 0.4
     layer_height: float = 0.2
+    filament_diameter: float = 1.75
+    flow_multiplier: float = 1.0
+
+    acceleration: float = 500.0
+    jerk: float = 10.0
+    estimator: PrintEstimator = None
 
     splitter: QtWidgets.QSplitter
     splitter_last_pos: int = 500
 
-    command_tree: QtWidgets.QTreeWidget
+    command_tree: QtWidgets.QTreeView
+    tree_model: CommandTreeModel
 
     slider_layer: QtWidgets.QSlider
     slider_start: QtWidgets.QSlider
@@ -46,135 +286,113 @@ class MainWindow(QtWidgets.QMainWindow):
     button_remove: QtWidgets.QPushButton
     button_up: QtWidgets.QPushButton
     button_down: QtWidgets.QPushButton
+    button_cancel: QtWidgets.QPushButton
 
     menu_file: QtWidgets.QMenu
+    menu_edit: QtWidgets.QMenu
+    menu_view: QtWidgets.QMenu
     action_file_open: QtWidgets.QAction
     action_file_save: QtWidgets.QAction
     action_file_saveas: QtWidgets.QAction
     action_recalculate_extrusion: QtWidgets.QAction
-
-    open_top_level_item: TopLevelTreeItem
+    action_estimate_print: QtWidgets.QAction
+    action_edit_undo: QtWidgets.QAction
+    action_edit_redo: QtWidgets.QAction
+    action_view_preview: QtWidgets.QAction
+    # Number of layers in the stacked preview, 0 for all of them
+    preview_depth_box: QtWidgets.QSpinBox
+
+    open_top_level_index: QtCore.QPersistentModelIndex
     layer_count: int
 
     selection_change_timer: QTimer
+    layer_scheduler: LayerScheduler
+
+    progress_bar: QtWidgets.QProgressBar
+    save_worker: SaveWorker = None
+    load_worker: LoadWorker = None
+    estimate_worker: EstimateWorker = None
+    estimate_label: QtWidgets.QLabel
+
+    action_edit_find: QtWidgets.QAction
+    search_box: QtWidgets.QLineEdit
+    # Layers with matches as top level items, their commands are only added once they are expanded
+    search_results: QtWidgets.QTreeWidget
+    search_index: SearchIndex = None
+    search_worker: SearchWorker = None
+    # Matches of the running search, taken a few layers at a time so the window stays responsive
+    search_matches: Iterator[SearchMatches] = None
+    search_timer: QTimer
+    search_delay_timer: QTimer
+    search_count: int = 0
+
+    SEARCH_DELAY: int = 250
+    SEARCH_STEP_TIME: float = 0.02
 
-    COLORS = {
-        "WHITE"  : QtGui.QBrush(QtGui.QColor("white")),
-        "BLACK"  : QtGui.QBrush(QtGui.QColor("black")),
-        "RED"    : QtGui.QBrush(QtGui.QColor(255, 100, 100)),
-        "GREEN"  : QtGui.QBrush(QtGui.QColor("green")),
-        "BLUE"   : QtGui.QBrush(QtGui.QColor(100, 100, 255)),
-        "CYAN"   : QtGui.QBrush(QtGui.QColor("cyan")),
-        "MAGENTA": QtGui.QBrush(QtGui.QColor("magenta")),
-        "YELLOW" : QtGui.QBrush(QtGui.QColor("yellow")),
-        "GRAY"   : QtGui.QBrush(QtGui.QColor("gray")),
-        }
-    
     ### ================ S I G N A L   F U N C T I O N S ================ ###
     
     def remove_selected_items(self) -> None:
-        selected_items: list[ReferenceTreeWidgetItem] = self.command_tree.selectedItems()
-        root = self.command_tree.invisibleRootItem()
+        if self.model == None:
+            return
+
+        # The selection is dropped first, it would otherwise have to follow every removed row through the change.
+        # Resetting it doesn't compare the old selection range by range like clearing it would.
+        selection = self.command_tree.selectionModel().selection()
+        self.command_tree.selectionModel().reset()
+        self.tree_model.remove_rows(selection)
+        self.on_selection_change()
+        if self.model.layer_count() != self.layer_count:
+            self.set_layer_count(self.model.layer_count(), self.slider_layer.value())
 
-        for item in selected_items:
-            item.model_reference.remove_from_parent()
-            (item.parent() or root).removeChild(item)
-        
         self.render_layer()
+        self.update_estimate()
+        self.update_search()
 
     
     def insert_new_item_under_selection(self) -> None:
-        if len(self.command_tree.selectedItems()) == 0:
+        if not self.command_tree.selectionModel().hasSelection():
             return
 
-        root = self.command_tree.invisibleRootItem()
-        
-        selected_item: ReferenceTreeWidgetItem = self.command_tree.selectedItems()[0]
-        parent: ReferenceTreeWidgetItem = (selected_item.parent() or root)
-        item_index = parent.indexOfChild(selected_item) + 1
-
-        new_item: ReferenceTreeWidgetItem
-
-        if isinstance(parent.model_reference, Feature):
-            command = parent.model_reference.insert_command("", item_index)
-            new_item = ReferenceTreeWidgetItem(None, command)
-        elif isinstance(parent.model_reference, Layer):
-            feature = Feature(parent.model_reference, "")
-            parent.model_reference.insert_feature(feature, item_index)
-            new_item = ReferenceTreeWidgetItem(None, feature)
-        elif isinstance(parent.model_reference, Model):
-            layer = Layer(parent.model_reference, "")
-            parent.model_reference.insert_layer(layer, item_index)
-            new_item = ReferenceTreeWidgetItem(None, layer)
-
-        new_item.setFlags(QtCore.Qt.ItemIsSelectable|QtCore.Qt.ItemIsEditable|QtCore.Qt.ItemIsEnabled)
-        parent.insertChild(item_index, new_item)
-        self.command_tree.editItem(new_item)
-
-    def update_item(self, item: ReferenceTreeWidgetItem, render: bool = True) -> None:
-        if self.model == None:
-            return
+        selected_index = self.command_tree.selectionModel().selectedIndexes()[0]
+        new_index = self.tree_model.insert_row(selected_index.parent(), selected_index.row() + 1)
 
-        if isinstance(item.model_reference, Command):
-            item.model_reference.parse_command(item.text(0))
-
-        if item.text(0).startswith("G0"):
-            item.setForeground(0, self.COLORS["MAGENTA"])
-        elif item.text(0).startswith("G1"):
-            item.setForeground(0, self.COLORS["BLUE"])
-        elif item.text(0).startswith(";"):
-            item.setForeground(0, self.COLORS["GREEN"])
-        elif item.text(0).startswith("M"):
-            item.setForeground(0, self.COLORS["RED"])
-        else:
-            item.setForeground(0, self.COLORS["WHITE"])
-        
-        if render:
-            self.render_layer()
+        if new_index.isValid():
+            self.command_tree.edit(new_index)
+
+    def on_item_edited(self, index: QtCore.QModelIndex) -> None:
+        self.render_layer()
+        self.update_estimate()
+        self.update_search()
     
-    def on_item_expanded(self, item: ReferenceTreeWidgetItem) -> None:
-        if not item.children_populated:
-            # Remove the placeholder
-            placeholder = item.child(0)
-            item.removeChild(placeholder)
-
-            if isinstance(item.model_reference, Layer):
-                layer = item.model_reference
-                for feature in layer.get_features():
-                    self.add_tree_item(item, feature, feature.name)
-            elif isinstance(item.model_reference, Feature):
-                feature = item.model_reference
-                for command in feature.get_commands():
-                    self.add_tree_item(item, command, command.command)
-            
-            item.children_populated = True
-
-        if not isinstance(item, TopLevelTreeItem):
+    def on_item_expanded(self, index: QtCore.QModelIndex) -> None:
+        if index.parent().isValid():
             return
         
-        if (item == self.open_top_level_item):
+        if index == self.open_top_level_index:
             return
         
-        if self.open_top_level_item != None:
-            self.open_top_level_item.setExpanded(False)
+        if self.open_top_level_index.isValid():
+            self.command_tree.collapse(QtCore.QModelIndex(self.open_top_level_index))
         
-        self.open_top_level_item = item
-        self.command_tree.scrollToItem(item, QtWidgets.QAbstractItemView.ScrollHint.PositionAtTop)
+        self.open_top_level_index = QtCore.QPersistentModelIndex(index)
+        self.command_tree.scrollTo(index, QtWidgets.QAbstractItemView.ScrollHint.PositionAtTop)
 
-        if not isinstance(item.model_reference, Layer):
+        current_layer = self.tree_model.get_layer_index(index)
+        if current_layer == None:
             return
 
-        current_layer = self.layer_count - self.command_tree.invisibleRootItem().indexOfChild(item)
+        # A layer opened in the tree is drawn like one picked with the slider
         self.slider_layer.setValue(current_layer)
-        self.render_layer(current_layer)
+        if current_layer != self.layer_scheduler.rendered_index:
+            self.layer_scheduler.request(current_layer)
     
-    def on_item_collapsed(self, item: ReferenceTreeWidgetItem) -> None:
-        if not isinstance(item, TopLevelTreeItem):
+    def on_item_collapsed(self, index: QtCore.QModelIndex) -> None:
+        if index.parent().isValid():
             return
         
-        if self.open_top_level_item != None:
-            self.open_top_level_item.setExpanded(False)
-            self.open_top_level_item = None
+        if self.open_top_level_index.isValid():
+            self.command_tree.collapse(QtCore.QModelIndex(self.open_top_level_index))
+            self.open_top_level_index = QtCore.QPersistentModelIndex()
 
     def on_button_down_pressed(self):
         self.slider_layer.setValue(self.slider_layer.value() - 1)
@@ -183,13 +401,29 @@ class MainWindow(QtWidgets.QMainWindow):
         self.slider_layer.setValue(self.slider_layer.value() + 1)
     
     def on_slider_value_changed(self, value):
-        self.command_tree.invisibleRootItem().child(self.layer_count - value).setExpanded(True)
+        self.layer_scheduler.request(value)
+
+    def on_layer_render_due(self, index: int) -> None:
+        self.render_layer(index)
+
+    def on_layer_settled(self, index: int) -> None:
+        self.command_tree.expand(self.tree_model.get_layer_model_index(index))
+        # The layer was drawn before it was open in the tree, so without its selection
+        self.on_selection_timer_timeout()
     
     def on_button_zoom_in_pressed(self):
-        self.gcode_render.set_zoom(0.1)
+        if self.gcode_render != None:
+            self.gcode_render.set_zoom(0.1)
     
     def on_button_zoom_out_pressed(self):
-        self.gcode_render.set_zoom(-0.1)
+        if self.gcode_render != None:
+            self.gcode_render.set_zoom(-0.1)
+
+    def on_preview_changed(self) -> None:
+        self.preview_depth_box.setVisible(self.action_view_preview.isChecked())
+        if self.gcode_render != None:
+            self.gcode_render.set_preview(self.preview_depth_box.value() if self.action_view_preview.isChecked() else None)
+            self.render_layer()
     
     def open_file_dialog(self):
         options = QtWidgets.QFileDialog.Options()
@@ -201,15 +435,13 @@ class MainWindow(QtWidgets.QMainWindow):
         self.open_file = filename
         self.setWindowTitle("GCode Editor - " + os.path.basename(filename))
         
-        with open(filename, "r") as file:
-            self.parse_and_fill_model(file)
+        self.start_load(filename)
     
     def save_file(self):
         if self.open_file == None:
             return
 
-        with open(self.open_file, "w") as file:
-            self.model.export(file)
+        self.start_save(self.open_file)
     
     def saveas_file_dialog(self):
         if self.open_file == None:
@@ -223,59 +455,236 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.open_file = filename
         self.setWindowTitle("GCode Editor - " + os.path.basename(filename))
-        
-        with open(filename, "w") as file:
-            self.model.export(file)
+
+        self.start_save(filename)
     
     def recalculate_extrusion(self):
-        if len(self.command_tree.selectedItems()) == 0:
+        if not self.command_tree.selectionModel().hasSelection():
             return # TODO: Show an error?
-        
-        item: ReferenceTreeWidgetItem
-        for item in self.command_tree.selectedItems():
-            if not isinstance(item.model_reference, Command):
-                # TODO: Add support for selecting features and layers
-                continue
-            
-            item_command : Command = item.model_reference
-            previous_command : Command = None
-            # Find previous move command to know the distance traveled
-            found : bool = False
-            for layer in self.model.get_layers()[self.model.get_layers().index(item_command.parent.parent) :: -1]:
-                feature_index_start = layer.get_features().index(item_command.parent) if item_command.parent in layer.get_features() else -1
-                for feature in layer.get_features()[feature_index_start :: -1]:
-                    command_index_start = (feature.get_commands().index(item_command) if item_command in feature.get_commands() else 0) - 1
-                    for command in feature.get_commands()[command_index_start :: -1]:
-                        if command.is_move_command:
-                            found = True
-                            previous_command = command
-                            break
-                    if found:
-                        break
-                if found:
-                    break
-            
-            if previous_command == None:
-                # TODO: Show an error?
-                continue
-
-            def get_e(dist_x, dist_y, layer_height, extruder_width):
-                dist = (dist_x**2 + dist_y**2)**0.5
-                volume_flow = layer_height * extruder_width
-                return volume_flow * dist * 0.8 # Not sure what formula cura uses, but this is closer to it's calculations
-                # TODO: Improve formula
-            
-            item_command.e = get_e(item_command.x - previous_command.x, item_command.y - previous_command.y, self.layer_height, self.extruder_width)
-            item_command.generate_command()
-            item.setText(0, item_command.command)
 
+        selected_indexes = self.command_tree.selectionModel().selectedIndexes()
+        flow_model = FlowModel(self.layer_height, self.extruder_width, self.filament_diameter, self.flow_multiplier)
+
+        self.tree_model.recalculate_extrusion(selected_indexes, flow_model)
+
+        self.render_layer()
+        self.update_estimate()
+        self.update_search()
+
+    def estimate_print(self):
+        if self.model == None:
+            return
+
+        # The first estimate parses every layer, after that only edited layers are estimated again
+        from GCodeEstimator import PrintEstimator, MotionModel
+        if self.estimator == None:
+            self.estimator = PrintEstimator(MotionModel(self.acceleration, self.jerk))
+
+        self.set_editing_enabled(False)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+
+        self.estimate_worker = EstimateWorker(self.model, self.estimator)
+        self.estimate_worker.progress_changed.connect(self.on_estimate_progress)
+        self.estimate_worker.finished.connect(self.on_estimate_finished)
+        self.estimate_worker.start()
+
+    def undo(self):
+        if self.model == None or self.tree_model.undo() == None:
+            return
+        self.on_journal_applied()
+
+    def redo(self):
+        if self.model == None or self.tree_model.redo() == None:
+            return
+        self.on_journal_applied()
+
+
+    def on_journal_applied(self) -> None:
+        if self.model.layer_count() != self.layer_count:
+            self.set_layer_count(self.model.layer_count(), self.slider_layer.value())
+
+        self.render_layer()
+        self.update_estimate()
+        self.update_search()
+
+    def on_find(self) -> None:
+        self.search_box.setFocus()
+        self.search_box.selectAll()
+
+    def on_search_text_changed(self) -> None:
+        # Searches as the query is typed, once typing pauses
+        self.search_delay_timer.start(self.SEARCH_DELAY)
+
+    def on_search_timer_timeout(self) -> None:
+        end = time.perf_counter() + self.SEARCH_STEP_TIME
+        for matches in self.search_matches:
+            self.add_search_matches(matches)
+            if time.perf_counter() > end:
+                return
+
+        self.search_timer.stop()
+        self.search_matches = None
+        self.search_results.setHeaderLabel(f"{self.search_count} matches in {self.search_results.topLevelItemCount()} layers")
+
+    def on_search_result_expanded(self, item: QtWidgets.QTreeWidgetItem) -> None:
+        # A query can match millions of commands, they are only listed per layer
+        if item.parent() != None or item.childCount() > 0:
+            return
+        matches = item.data(0, Qt.UserRole)
+        item.addChildren([QtWidgets.QTreeWidgetItem([text]) for text in matches.texts])
+
+    def on_search_result_activated(self, item: QtWidgets.QTreeWidgetItem, column: int) -> None:
+        if item.parent() == None:
+            self.show_search_match(item.data(0, Qt.UserRole), None)
+        else:
+            self.show_search_match(item.parent().data(0, Qt.UserRole), item.parent().indexOfChild(item))
+
+    def on_save_progress(self, percent: int) -> None:
+        self.progress_bar.setValue(percent)
+
+    def on_save_failed(self, message: str) -> None:
+        QtWidgets.QMessageBox.critical(self, "Save failed", message)
+
+    def on_save_finished(self) -> None:
+        self.save_worker = None
+        self.progress_bar.hide()
+        self.set_editing_enabled(True)
+
+    def on_estimate_progress(self, percent: int) -> None:
+        self.progress_bar.setValue(percent)
+
+    def on_estimate_finished(self) -> None:
+        self.show_estimate(self.estimate_worker.estimate)
+        self.estimate_worker = None
+        self.progress_bar.hide()
+        self.set_editing_enabled(True)
+
+    def on_load_model_opened(self, model: Model) -> None:
+        self.open_top_level_index = QtCore.QPersistentModelIndex()
+        self.layer_scheduler.reset()
+        self.stop_indexing()
+        self.search_index = None
+        self.search_timer.stop()
+        self.search_matches = None
+        self.search_results.clear()
+        self.estimator = None
+        self.estimate_label.clear()
+
+        # Layers are only parsed once they are shown
+        self.model = model
+        self.tree_model.set_model(self.model)
+        self.layer_height = self.model.layer_height
+
+        # Files that are parsed up front come with all of their layers
+        self.layer_count = 0
+        if self.model.layer_count() > 0:
+            self.on_load_layers_found([])
+
+    def on_load_layers_found(self, layers: list[Layer]) -> None:
+        first_layers = self.layer_count == 0
+
+        self.tree_model.add_layers(layers)
+        self.set_layer_count(self.model.layer_count(), self.slider_layer.value())
+
+        # The first layer can be looked at while the rest of the file is still being read
+        if first_layers:
+            self.on_slider_value_changed(0)
+
+    def on_load_progress(self, percent: int) -> None:
+        self.progress_bar.setValue(percent)
+
+    def on_load_failed(self, message: str) -> None:
+        QtWidgets.QMessageBox.critical(self, "Open failed", message)
+
+    def on_load_finished(self) -> None:
+        # A file that was only partly read is closed again, saving it would lose the rest
+        if self.load_worker.cancelled or self.load_worker.failed:
+            self.model = None
+            self.open_file = None
+            self.open_top_level_index = QtCore.QPersistentModelIndex()
+            self.layer_scheduler.reset()
+            self.tree_model.set_model(None)
+            self.setWindowTitle("GCode Editor")
+
+        self.load_worker = None
+        self.progress_bar.hide()
+        self.button_cancel.hide()
+        self.set_editing_enabled(True)
+
+        if self.model != None:
+            self.start_indexing()
+        self.update_search()
+
+    def on_button_cancel_pressed(self) -> None:
+        if self.load_worker != None:
+            self.load_worker.requestInterruption()
+
+    def closeEvent(self, e: QtGui.QCloseEvent):
+        # Don't leave a half written temporary file behind
+        if self.save_worker != None:
+            self.save_worker.wait()
+        if self.load_worker != None:
+            self.load_worker.requestInterruption()
+            self.load_worker.wait()
+        if self.estimate_worker != None:
+            self.estimate_worker.wait()
+        if self.gcode_render != None:
+            self.gcode_render.stop_prefetch()
+        self.stop_indexing()
+        super().closeEvent(e)
+
+    def on_commands_picked(self, positions: list[tuple[int, int]], extend: bool) -> None:
+        # Selects the commands picked on the canvas, given as feature and command indexes of the open layer
+        # Until the drawn layer is open in the tree the picked positions belong to no listed layer
+        open_layer = self.get_open_layer_index()
+        if open_layer == None or open_layer != self.layer_scheduler.rendered_index:
+            return
+        layer_index = QtCore.QModelIndex(self.open_top_level_index)
+
+        # Runs of neighbouring commands become a single range, there can be thousands of them
+        selection = QtCore.QItemSelection()
+        first_index = None
+        position = 0
+        while position < len(positions):
+            feature_index, command_index = positions[position]
+            last = command_index
+            position += 1
+            while position < len(positions) and positions[position] == (feature_index, last + 1):
+                position += 1
+                last += 1
+
+            feature_model_index = self.tree_model.index(feature_index, 0, layer_index)
+            self.command_tree.expand(feature_model_index)
+            self.tree_model.fetch_to(feature_model_index, last)
+            first = self.tree_model.index(command_index, 0, feature_model_index)
+            selection.select(first, self.tree_model.index(last, 0, feature_model_index))
+            first_index = first_index or first
+
+        flags = QtCore.QItemSelectionModel.Select if extend else QtCore.QItemSelectionModel.ClearAndSelect
+        self.command_tree.selectionModel().select(selection, flags)
+
+        if first_index != None:
+            self.command_tree.scrollTo(first_index)
 
     def on_selection_change(self):
         self.selection_change_timer.start(100)
 
     def on_selection_timer_timeout(self):
-        self.render_layer()
+        if self.model == None or self.gcode_render == None:
+            return
+
+        # Only the selection overlay is redrawn, the layer stays as it is
+        self.gcode_render.set_selection(self.get_selected_rows(self.layer_scheduler.rendered_index))
     
+    def paintEvent(self, e: QtGui.QPaintEvent):
+        super().paintEvent(e)
+
+        if not self.first_paint_done:
+            self.first_paint_done = True
+            self.first_painted.emit()
+            QTimer.singleShot(0, self.create_render)
+
     def resizeEvent(self, e: QtGui.QResizeEvent):
         self.splitter.setGeometry(self.centralWidget().rect())
         self.splitter.moveSplitter(self.splitter_last_pos, 1)
@@ -285,73 +694,224 @@ class MainWindow(QtWidgets.QMainWindow):
     
     ### ================ P U B L I C   F U N C T I O N S ================ ###
 
-    def add_tree_item(self, parent: QtWidgets.QTreeWidgetItem, model_item: Child, text: str) -> ReferenceTreeWidgetItem:
-        item: ReferenceTreeWidgetItem
-        if parent == self.command_tree.invisibleRootItem():
-            item = TopLevelTreeItem(None, model_item)
-        else: 
-            item = ReferenceTreeWidgetItem(None, model_item)
+    def set_editing_enabled(self, enabled: bool) -> None:
+        self.button_remove.setEnabled(enabled)
+        self.button_insert.setEnabled(enabled)
+        self.action_file_open.setEnabled(enabled)
+        self.action_file_save.setEnabled(enabled)
+        self.action_file_saveas.setEnabled(enabled)
+        self.action_recalculate_extrusion.setEnabled(enabled)
+        self.action_estimate_print.setEnabled(enabled)
+        self.action_edit_undo.setEnabled(enabled)
+        self.action_edit_redo.setEnabled(enabled)
+
+        if enabled:
+            self.command_tree.setEditTriggers(QtWidgets.QAbstractItemView.DoubleClicked | QtWidgets.QAbstractItemView.EditKeyPressed)
+        else:
+            self.command_tree.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+
+    def start_save(self, filename: str) -> None:
+        # On Windows a file can't be replaced while it is mapped, so the remaining layers are loaded first
+        if os.name == "nt" and self.model.source_file != None and os.path.exists(filename) and os.path.samefile(self.model.source_file.file_name, filename):
+            # Both workers parse layers from the mapped file
+            if self.gcode_render != None:
+                self.gcode_render.stop_prefetch()
+            self.stop_indexing()
+            self.model.release_source()
+
+        # The model must not change while it is being written
+        self.set_editing_enabled(False)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+
+        self.save_worker = SaveWorker(self.model, filename)
+        self.save_worker.progress_changed.connect(self.on_save_progress)
+        self.save_worker.save_failed.connect(self.on_save_failed)
+        self.save_worker.finished.connect(self.on_save_finished)
+        self.save_worker.start()
+
+    def start_load(self, filename: str) -> None:
+        # The file can be looked at while it loads, but not changed or saved before all of its layers are known
+        self.set_editing_enabled(False)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.button_cancel.show()
+
+        self.load_worker = LoadWorker(filename)
+        self.load_worker.model_opened.connect(self.on_load_model_opened)
+        self.load_worker.layers_found.connect(self.on_load_layers_found)
+        self.load_worker.progress_changed.connect(self.on_load_progress)
+        self.load_worker.load_failed.connect(self.on_load_failed)
+        self.load_worker.finished.connect(self.on_load_finished)
+        self.load_worker.start()
+
+    def update_estimate(self) -> None:
+        # Keeps an estimate that was asked for up to date with the edits
+        if self.estimator == None or self.estimate_worker != None or self.model == None:
+            return
+        self.show_estimate(self.estimator.estimate_model(self.model))
+
+    def start_indexing(self) -> None:
+        from GCodeSearch import SearchIndex
+
+        self.stop_indexing()
+        self.search_index = SearchIndex()
+        self.search_worker = SearchWorker(self.model, self.search_index)
+        self.search_worker.start(QtCore.QThread.LowPriority)
+
+    def stop_indexing(self) -> None:
+        if self.search_worker != None:
+            self.search_worker.requestInterruption()
+            self.search_worker.wait()
+            self.search_worker = None
+
+    def start_search(self) -> None:
+        # Matches are added to the results layer by layer as they are found, see on_search_timer_timeout
+        import re
+        from GCodeSearch import SearchIndex, SearchQuery
+
+        self.search_delay_timer.stop()
+        self.search_timer.stop()
+        self.search_matches = None
+        self.search_results.clear()
+        self.search_count = 0
+
+        text = self.search_box.text().strip()
+        if self.model == None or text == "":
+            self.search_results.hide()
+            return
+
+        self.search_results.show()
+        try:
+            query = SearchQuery(text)
+        except re.error as error:
+            self.search_results.setHeaderLabel(f"Invalid regular expression: {error}")
+            return
 
-        item.setFlags(QtCore.Qt.ItemIsSelectable|QtCore.Qt.ItemIsEditable|QtCore.Qt.ItemIsEnabled)
-        item.setText(0, text)
-        self.update_item(item, False)
+        if self.search_index == None:
+            self.search_index = SearchIndex()
+        self.search_matches = self.search_index.search(self.model, query)
+        self.search_results.setHeaderLabel("Searching...")
+        self.search_timer.start(0)
 
-        parent.addChild(item)
+    def update_search(self) -> None:
+        # Results point at commands by their position, after an edit they are searched for again
+        if self.search_box.text().strip() != "":
+            self.start_search()
 
-        if not isinstance(model_item, Command):
-            QtWidgets.QTreeWidgetItem(item) # Add placeholder to show an expand button
-        
-        return item
-    
-    def set_layer_count(self, count: int) -> None:
+    def add_search_matches(self, matches: SearchMatches) -> None:
+        if len(matches) == 0:
+            return
+
+        if matches.layer != None:
+            name = f"Layer {matches.layer}"
+        else:
+            name = "Pre-Print" if matches.parent is self.model.feature_pre_print else "Post-Print"
+
+        item = QtWidgets.QTreeWidgetItem([f"{name} ({len(matches)})"])
+        item.setChildIndicatorPolicy(QtWidgets.QTreeWidgetItem.ShowIndicator)
+        item.setData(0, Qt.UserRole, matches)
+        self.search_results.addTopLevelItem(item)
+
+        self.search_count += len(matches)
+        self.search_results.setHeaderLabel(f"Searching... {self.search_count} matches")
+
+    def show_search_match(self, matches: SearchMatches, match: int) -> None:
+        # Opens the layer of a match in the command tree and selects the command, just the layer if match is None
+        if matches.layer != None:
+            top_level_index = self.tree_model.get_layer_model_index(matches.layer)
+        else:
+            top_level_index = self.tree_model.index(self.tree_model.get_feature_row(matches.parent), 0)
+        self.command_tree.expand(top_level_index)
+        if match == None:
+            return
+
+        # The features of the model itself hold the commands directly
+        feature_index = top_level_index
+        if matches.layer != None:
+            feature_index = self.tree_model.index(int(matches.features[match]), 0, top_level_index)
+            self.command_tree.expand(feature_index)
+
+        command = int(matches.commands[match])
+        self.tree_model.fetch_to(feature_index, command)
+        command_index = self.tree_model.index(command, 0, feature_index)
+        if not command_index.isValid():
+            return
+
+        self.command_tree.selectionModel().setCurrentIndex(command_index, QtCore.QItemSelectionModel.ClearAndSelect)
+        self.command_tree.scrollTo(command_index, QtWidgets.QAbstractItemView.ScrollHint.PositionAtCenter)
+
+    def show_estimate(self, estimate: PrintEstimate) -> None:
+        minutes, seconds = divmod(round(estimate.time), 60)
+        hours, minutes = divmod(minutes, 60)
+        self.estimate_label.setText(f"Print time {hours}h {minutes:02}m {seconds:02}s, filament {estimate.filament / 1000.0:.2f} m")
+
+    def set_layer_count(self, count: int, value: int = 0) -> None:
         self.layer_count = count
         self.slider_layer.setMaximum(count - 1)
-        self.slider_layer.setValue(0)
+        self.slider_layer.setValue(value)
     
-    def parse_and_fill_model(self, gcode_file: TextIOWrapper) -> None:
-        self.command_tree.clear()
-        self.open_top_level_item = None
+    def create_render(self) -> None:
+        # Replaces the placeholder with the canvas once the window has been painted, so the window shows up
+        # without waiting for matplotlib. A file opened in the meantime is drawn as soon as the canvas exists.
+        from MplCanvas import MplCanvas
 
-        self.model = Model.parse_gcode(gcode_file)
+        self.gcode_render = MplCanvas(self, width=5, height=5, dpi=100)
+        self.gcode_render.setSizePolicy(self.render_placeholder.sizePolicy())
+        self.gcode_render.setMinimumSize(self.render_placeholder.minimumSize())
+        self.render_placeholder.parentWidget().layout().replaceWidget(self.render_placeholder, self.gcode_render)
+        self.render_placeholder.deleteLater()
+
+        self.gcode_render.commands_picked.connect(self.on_commands_picked)
+        self.render_created.emit()
+        self.on_preview_changed()
 
-        self.add_tree_item(self.command_tree.invisibleRootItem(), self.model.feature_post_print, "Post-Print")
-        for index, layer in reversed(list(enumerate(self.model.get_layers()))):
-            self.add_tree_item(self.command_tree.invisibleRootItem(), layer, "Layer " + str(index))
-        self.add_tree_item(self.command_tree.invisibleRootItem(), self.model.feature_pre_print, "Pre-Print")
-        
-        self.set_layer_count(self.model.layer_count())
-        self.layer_height = self.model.layer_height
-        # Force update
-        self.on_slider_value_changed(0)
-    
     def render_layer(self, index: int = None):
-        if self.model == None:
+        if self.model == None or self.gcode_render == None:
             return
         
         if index == None:
-            if self.open_top_level_item == None:
+            index = self.get_open_layer_index()
+            if index == None:
                 return
-            
-            index = self.layer_count - self.command_tree.invisibleRootItem().indexOfChild(self.open_top_level_item)
 
-        selected_commands: dict[Command, int] = {}
-        for item in self.command_tree.selectedItems():
-            model_reference: Child = item.model_reference
+        self.gcode_render.render_layer(self.model, index, self.get_selected_rows(index))
+        self.layer_scheduler.mark_rendered(index)
 
-            if isinstance(model_reference, Command):
-                selected_commands[model_reference] = None
-            elif isinstance(model_reference, Feature):
-                selected_commands.update(dict.fromkeys(model_reference.get_commands(), None))
-        
-        self.gcode_render.render_layer(self.model, index, selected_commands)
+    def get_open_layer_index(self) -> int:
+        if not self.open_top_level_index.isValid():
+            return None
+        return self.tree_model.get_layer_index(QtCore.QModelIndex(self.open_top_level_index))
+
+    def get_selected_rows(self, layer_index: int = None) -> np.ndarray:
+        # Store rows of the selected commands of the open layer, whole features count as all of their commands.
+        # There are none if layer_index is given and another layer is open.
+        import numpy as np
+
+        if not self.open_top_level_index.isValid():
+            return np.empty(0, np.int64)
+        if layer_index != None and layer_index != self.get_open_layer_index():
+            return np.empty(0, np.int64)
+        open_layer = self.tree_model.get_reference(QtCore.QModelIndex(self.open_top_level_index))
+        if not isinstance(open_layer, Layer):
+            return np.empty(0, np.int64)
+
+        selected_rows = []
+        for feature, rows in self.tree_model.get_selection_rows(self.command_tree.selectionModel().selection()):
+            if feature.store is open_layer.store:
+                selected_rows.append(rows)
+
+        if len(selected_rows) == 0:
+            return np.empty(0, np.int64)
+        return np.concatenate([np.asarray(rows, np.int64) for rows in selected_rows])
 
     def setup_ui(self) -> None:
         self.setWindowTitle("GCode Editor")
         self.setMinimumSize(1000, 530)
 
-        self.open_top_level_item = None
+        self.open_top_level_index = QtCore.QPersistentModelIndex()
 
-        for _, brush in self.COLORS.items():
+        for _, brush in CommandTreeModel.COLORS.items():
             brush.setStyle(QtCore.Qt.SolidPattern)
 
         centralwidget = QtWidgets.QWidget(self)
@@ -362,14 +922,30 @@ class MainWindow(QtWidgets.QMainWindow):
         grid_layout_widget = QtWidgets.QWidget(self.splitter)
         grid_layout = QtWidgets.QGridLayout(grid_layout_widget)
 
-        self.command_tree = QtWidgets.QTreeWidget(grid_layout_widget)
+        self.tree_model = CommandTreeModel(self)
+
+        # Rows all have the same height, so the view never has to measure the rows it doesn't show
+        self.command_tree = QtWidgets.QTreeView(grid_layout_widget)
+        self.command_tree.setModel(self.tree_model)
+        self.command_tree.setUniformRowHeights(True)
         size_policy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.MinimumExpanding, QtWidgets.QSizePolicy.Expanding)
         self.command_tree.setSizePolicy(size_policy)
         self.command_tree.setMinimumSize(QtCore.QSize(300, 0))
         self.command_tree.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
         self.command_tree.header().setVisible(False)
 
-        grid_layout.addWidget(self.command_tree, 0, 0, 2, 1)
+        self.search_box = QtWidgets.QLineEdit(grid_layout_widget)
+        self.search_box.setPlaceholderText("Search: M106, Z>10 F<1200, ;TYPE:SKIRT, /regex/")
+        self.search_box.setClearButtonEnabled(True)
+        grid_layout.addWidget(self.search_box, 0, 0, 1, 1)
+
+        self.search_results = QtWidgets.QTreeWidget(grid_layout_widget)
+        self.search_results.setUniformRowHeights(True)
+        self.search_results.setMaximumHeight(250)
+        self.search_results.hide()
+        grid_layout.addWidget(self.search_results, 1, 0, 1, 1)
+
+        grid_layout.addWidget(self.command_tree, 2, 0, 2, 1)
 
         horizontal_layout = QtWidgets.QHBoxLayout()
 
@@ -399,7 +975,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.button_insert.setMaximumSize(QtCore.QSize(50, 50))
         self.button_insert.setBaseSize(QtCore.QSize(50, 50))
         horizontal_layout.addWidget(self.button_insert)
-        grid_layout.addLayout(horizontal_layout, 2, 0, 1, 1)
+        grid_layout.addLayout(horizontal_layout, 4, 0, 1, 1)
 
 
         grid_layout_widget_2 = QtWidgets.QWidget(self.splitter)
@@ -438,11 +1014,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
         grid_layout2.addLayout(vertical_layout_2, 0, 0, 2, 1)
 
-        self.gcode_render = MplCanvas(self, width=5, height=5, dpi=100)
+        self.render_placeholder = QtWidgets.QWidget(grid_layout_widget_2)
         size_policy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
-        self.gcode_render.setSizePolicy(size_policy)
-        self.gcode_render.setMinimumSize(QtCore.QSize(500, 500))
-        grid_layout2.addWidget(self.gcode_render, 0, 1, 2, 1)
+        self.render_placeholder.setSizePolicy(size_policy)
+        self.render_placeholder.setMinimumSize(QtCore.QSize(500, 500))
+        grid_layout2.addWidget(self.render_placeholder, 0, 1, 2, 1)
 
         self.setCentralWidget(centralwidget)
 
@@ -470,6 +1046,26 @@ class MainWindow(QtWidgets.QMainWindow):
         self.menu_file.addAction(self.action_file_saveas)
         menubar.addAction(self.menu_file.menuAction())
 
+        self.menu_edit = QtWidgets.QMenu(menubar)
+        self.menu_edit.setTitle("Edit")
+
+        self.action_edit_undo = QtWidgets.QAction(self)
+        self.action_edit_undo.setText("Undo")
+        self.action_edit_undo.setShortcut("Ctrl+Z")
+
+        self.action_edit_redo = QtWidgets.QAction(self)
+        self.action_edit_redo.setText("Redo")
+        self.action_edit_redo.setShortcuts(["Ctrl+Y", "Ctrl+Shift+Z"])
+
+        self.action_edit_find = QtWidgets.QAction(self)
+        self.action_edit_find.setText("Find")
+        self.action_edit_find.setShortcut("Ctrl+F")
+
+        self.menu_edit.addAction(self.action_edit_undo)
+        self.menu_edit.addAction(self.action_edit_redo)
+        self.menu_edit.addAction(self.action_edit_find)
+        menubar.addAction(self.menu_edit.menuAction())
+
         self.menu_functions = QtWidgets.QMenu(menubar)
         self.menu_functions.setTitle("Functions")
         self.setMenuBar(menubar)
@@ -478,29 +1074,89 @@ class MainWindow(QtWidgets.QMainWindow):
         self.action_recalculate_extrusion.setText("Recalculate extrusion")
         self.action_recalculate_extrusion.setShortcut("Ctrl+R")
 
+        self.action_estimate_print = QtWidgets.QAction(self)
+        self.action_estimate_print.setText("Estimate print time")
+        self.action_estimate_print.setShortcut("Ctrl+T")
+
         self.menu_functions.addAction(self.action_recalculate_extrusion)
+        self.menu_functions.addAction(self.action_estimate_print)
         menubar.addAction(self.menu_functions.menuAction())
 
+        self.menu_view = QtWidgets.QMenu(menubar)
+        self.menu_view.setTitle("View")
+
+        self.action_view_preview = QtWidgets.QAction(self)
+        self.action_view_preview.setText("Stacked preview")
+        self.action_view_preview.setShortcut("Ctrl+3")
+        self.action_view_preview.setCheckable(True)
+
+        self.menu_view.addAction(self.action_view_preview)
+        menubar.addAction(self.menu_view.menuAction())
+
         self.selection_change_timer = QTimer()
         self.selection_change_timer.setSingleShot(True)
 
+        self.layer_scheduler = LayerScheduler()
+
+        self.search_timer = QTimer()
+        self.search_delay_timer = QTimer()
+        self.search_delay_timer.setSingleShot(True)
+
+        self.estimate_label = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.estimate_label)
+
+        self.preview_depth_box = QtWidgets.QSpinBox()
+        self.preview_depth_box.setPrefix("Preview layers ")
+        self.preview_depth_box.setSpecialValueText("Preview all layers")
+        self.preview_depth_box.setRange(0, 100000)
+        self.preview_depth_box.setValue(0)
+        self.preview_depth_box.hide()
+        self.statusBar().addPermanentWidget(self.preview_depth_box)
+
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
+
+        self.button_cancel = QtWidgets.QPushButton("Cancel")
+        self.button_cancel.hide()
+        self.statusBar().addPermanentWidget(self.button_cancel)
+
         self.button_remove.pressed.connect(self.remove_selected_items)
         self.button_insert.pressed.connect(self.insert_new_item_under_selection)
         self.button_down.pressed.connect(self.on_button_down_pressed)
+        self.button_cancel.pressed.connect(self.on_button_cancel_pressed)
         self.button_up.pressed.connect(self.on_button_up_pressed)
-        self.command_tree.itemChanged.connect(self.update_item)
-        self.command_tree.itemExpanded.connect(self.on_item_expanded)
-        self.command_tree.itemCollapsed.connect(self.on_item_collapsed)
+        self.tree_model.item_edited.connect(self.on_item_edited)
+        self.command_tree.expanded.connect(self.on_item_expanded)
+        self.command_tree.collapsed.connect(self.on_item_collapsed)
         self.slider_layer.valueChanged.connect(self.on_slider_value_changed)
+        self.slider_layer.sliderPressed.connect(self.layer_scheduler.hold)
+        self.slider_layer.sliderReleased.connect(self.layer_scheduler.release)
+        self.layer_scheduler.render_due.connect(self.on_layer_render_due)
+        self.layer_scheduler.settled.connect(self.on_layer_settled)
         self.button_zoom_in.pressed.connect(self.on_button_zoom_in_pressed)
         self.button_zoom_out.pressed.connect(self.on_button_zoom_out_pressed)
         self.action_file_open.triggered.connect(self.open_file_dialog)
         self.action_file_save.triggered.connect(self.save_file)
         self.action_file_saveas.triggered.connect(self.saveas_file_dialog)
         self.action_recalculate_extrusion.triggered.connect(self.recalculate_extrusion)
-        self.command_tree.itemSelectionChanged.connect(self.on_selection_change)
+        self.action_estimate_print.triggered.connect(self.estimate_print)
+        self.action_edit_undo.triggered.connect(self.undo)
+        self.action_edit_redo.triggered.connect(self.redo)
+        self.action_view_preview.toggled.connect(self.on_preview_changed)
+        self.preview_depth_box.valueChanged.connect(self.on_preview_changed)
+        self.command_tree.selectionModel().selectionChanged.connect(self.on_selection_change)
         self.selection_change_timer.timeout.connect(self.on_selection_timer_timeout)
         self.splitter.splitterMoved.connect(self.on_splitter_moved)
+        self.action_edit_find.triggered.connect(self.on_find)
+        self.search_box.textChanged.connect(self.on_search_text_changed)
+        self.search_box.returnPressed.connect(self.start_search)
+        self.search_delay_timer.timeout.connect(self.start_search)
+        self.search_timer.timeout.connect(self.on_search_timer_timeout)
+        self.search_results.itemExpanded.connect(self.on_search_result_expanded)
+        self.search_results.itemActivated.connect(self.on_search_result_activated)
+        self.search_results.itemClicked.connect(self.on_search_result_activated)
 
         self.show()
 
@@ -533,5 +1189,12 @@ if __name__ == "__main__":
     app.setPalette(DarkPalette())
 
     ui = MainWindow()
+
+    # Used by Benchmark.py to time startup: reports when the window is painted and the canvas exists, then quits
+    if "--startup-benchmark" in sys.argv:
+        ui.first_painted.connect(lambda: print("first-paint", flush=True))
+        ui.render_created.connect(lambda: print("render-created", flush=True))
+        ui.render_created.connect(app.quit, QtCore.Qt.QueuedConnection)
+
     ui.setup_ui()
     sys.exit(app.exec_())
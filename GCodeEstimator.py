@@ -0,0 +1,282 @@
+from __future__ import annotations
+from collections.abc import Callable
+from functools import partial
+from math import isnan
+
+import numpy as np
+
+from GCodeModel import Model, Layer, Feature, CommandStore, KIND_MCODE, KIND_OTHER, FLAG_MOVE, FLAG_EXTRUDE, EXTRUSION_ABSOLUTE, EXTRUSION_RELATIVE
+
+
+class MotionModel:
+    # Kinematic limits of the printer: accelerations in mm/s² for printing, travel and extruder only (retraction)
+    # moves, the classic jerk in mm/s and the feedrate in mm/min that applies until the file sets one
+    acceleration: float
+    travel_acceleration: float
+    retract_acceleration: float
+    jerk: float
+    default_feedrate: float
+
+    def __init__(self, acceleration: float = 500.0, jerk: float = 10.0, travel_acceleration: float = None,
+                 retract_acceleration: float = None, default_feedrate: float = 1500.0) -> None:
+        self.acceleration = acceleration
+        self.jerk = jerk
+        self.travel_acceleration = travel_acceleration or acceleration
+        self.retract_acceleration = retract_acceleration or acceleration
+        self.default_feedrate = default_feedrate
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, MotionModel):
+            return NotImplemented
+        return vars(self) == vars(other)
+
+
+class LayerEstimate:
+    # Print time in seconds and filament in mm of the commands of a layer (or of the pre-print or post-print feature),
+    # per command indexed by store row, per feature in the order of the features and in total. Filament is the
+    # net E change, so retractions cancel out with the moves that undo them.
+    revision: int
+    # Where the estimate started and ended: x, y, feedrate, E mode and E position, None where unknown
+    start_state: tuple
+    end_state: tuple
+    times: np.ndarray
+    filament: np.ndarray
+    feature_names: list[str]
+    feature_times: list[float]
+    feature_filament: list[float]
+    time: float
+    total_filament: float
+
+    def __init__(self, revision: int, start_state: tuple, end_state: tuple, times: np.ndarray, filament: np.ndarray,
+                 feature_names: list[str], feature_times: list[float], feature_filament: list[float]) -> None:
+        self.revision = revision
+        self.start_state = start_state
+        self.end_state = end_state
+        self.times = times
+        self.filament = filament
+        self.feature_names = feature_names
+        self.feature_times = feature_times
+        self.feature_filament = feature_filament
+        self.time = sum(feature_times)
+        self.total_filament = sum(feature_filament)
+
+
+class PrintEstimate:
+    pre_print: LayerEstimate
+    layers: list[LayerEstimate]
+    post_print: LayerEstimate
+    time: float
+    filament: float
+
+    def __init__(self, pre_print: LayerEstimate, layers: list[LayerEstimate], post_print: LayerEstimate) -> None:
+        self.pre_print = pre_print
+        self.layers = layers
+        self.post_print = post_print
+        estimates = [pre_print, *layers, post_print]
+        self.time = sum(estimate.time for estimate in estimates)
+        self.filament = sum(estimate.total_filament for estimate in estimates)
+
+
+class PrintEstimator:
+    # Estimates print time and filament use the way the firmware plans the moves: every move accelerates from the
+    # speed it is entered at to its feedrate and decelerates to the speed of the next one, with a trapezoidal
+    # profile. The speed through a corner is limited by the jerk, moves of the extruder alone start and end at rest.
+    #
+    # Estimates are kept per layer and only computed again for layers that were edited since, or that start in
+    # a different state because a layer before them ended differently. Layers that are not loaded are estimated
+    # from a parsed copy, so the model doesn't change and can be looked at from another thread in the meantime.
+    motion_model: MotionModel
+    # Layer estimates by id of the layer, the pre-print and post-print estimates by id of their feature
+    estimates: dict[int, tuple[Layer | Feature, LayerEstimate]]
+
+    def __init__(self, motion_model: MotionModel) -> None:
+        self.motion_model = motion_model
+        self.estimates = {}
+
+    def estimate_model(self, model: Model, progress: Callable[[float], None] = None) -> PrintEstimate:
+        estimates = {}
+        state = (None, None, None, EXTRUSION_ABSOLUTE, None)
+
+        pre_print = self.get_estimate(model.feature_pre_print, model.revision, state, estimates,
+                                      lambda: (model.feature_pre_print.store, [model.feature_pre_print]))
+        state = pre_print.end_state
+
+        layers = []
+        layer_count = model.layer_count()
+        for index, layer in enumerate(model.get_layers()):
+            layers.append(self.get_estimate(layer, layer.revision, state, estimates, partial(PrintEstimator.get_layer_contents, layer)))
+            state = layers[-1].end_state
+
+            if progress != None:
+                progress((index + 1) / layer_count)
+
+        post_print = self.get_estimate(model.feature_post_print, model.revision, state, estimates,
+                                       lambda: (model.feature_post_print.store, [model.feature_post_print]))
+
+        # Estimates of layers that were removed are dropped
+        self.estimates = estimates
+        return PrintEstimate(pre_print, layers, post_print)
+
+    def get_estimate(self, parent: Layer | Feature, revision: int, state: tuple, estimates: dict,
+                     get_contents: Callable[[], tuple[CommandStore, list[Feature]]]) -> LayerEstimate:
+        _, estimate = self.estimates.get(id(parent), (None, None))
+        if estimate == None or estimate.revision != revision or estimate.start_state != state:
+            estimate = PrintEstimator.estimate_features(*get_contents(), revision, state, self.motion_model)
+        estimates[id(parent)] = (parent, estimate)
+        return estimate
+
+    # Store and features of a layer, a copy is parsed when the layer isn't loaded. Its rows are the same ones
+    # loading the layer gives, so the estimate stays valid once it is loaded.
+    def get_layer_contents(layer: Layer) -> tuple[CommandStore, list[Feature]]:
+        parsed_layer = layer.peek()
+        return parsed_layer.store, parsed_layer.get_features()
+
+    def estimate_features(store: CommandStore, features: list[Feature], revision: int, state: tuple,
+                          motion_model: MotionModel) -> LayerEstimate:
+        start_x, start_y, start_feedrate, _, position = (np.nan if value == None else value for value in state)
+        mode = state[3] or EXTRUSION_ABSOLUTE
+
+        lengths = np.array([len(feature.rows) for feature in features], np.int64)
+        if len(features) > 0:
+            rows = np.concatenate([np.frombuffer(feature.rows, np.int64) for feature in features])
+        else:
+            rows = np.empty(0, np.int64)
+        count = len(rows)
+
+        kinds = np.frombuffer(store.kinds, np.uint8)[rows]
+        flags = np.frombuffer(store.flags, np.uint8)[rows]
+        xs = np.frombuffer(store.x, np.float64)[rows]
+        ys = np.frombuffer(store.y, np.float64)[rows]
+        es = np.frombuffer(store.e, np.float64)[rows]
+        fs = np.frombuffer(store.f, np.float64)[rows]
+
+        is_move = (flags & FLAG_MOVE) != 0
+        is_extrude = (flags & FLAG_EXTRUDE) != 0
+        is_retract = is_extrude & ~is_move
+
+        # F is modal, every command moves at the feedrate set last
+        set_at = np.where(np.isnan(fs), -1, np.arange(count))
+        np.maximum.accumulate(set_at, out=set_at)
+        feedrates = np.where(set_at >= 0, fs[set_at], start_feedrate)
+        end_feedrate = feedrates[-1] if count > 0 else start_feedrate
+        feedrates = np.where(np.isnan(feedrates) | (feedrates <= 0), motion_model.default_feedrate, feedrates) / 60.0
+
+        moves = np.flatnonzero(is_move)
+        move_x, move_y = xs[moves], ys[moves]
+        delta_x = np.diff(move_x, prepend=start_x)
+        delta_y = np.diff(move_y, prepend=start_y)
+        distances = np.nan_to_num(np.hypot(delta_x, delta_y))
+        end_x, end_y = (move_x[-1], move_y[-1]) if len(moves) > 0 else (start_x, start_y)
+
+        # E changes between the commands that set the E mode or position, the settings themselves are read one by one
+        filament = np.zeros(count)
+        times = np.zeros(count)
+        extrusions = np.flatnonzero(is_extrude)
+        settings = np.flatnonzero((kinds == KIND_MCODE) | (kinds == KIND_OTHER))
+
+        start = 0
+        for setting in [*settings.tolist(), count]:
+            segment = extrusions[np.searchsorted(extrusions, start):np.searchsorted(extrusions, setting)]
+            values = es[segment]
+            if len(segment) > 0:
+                if mode == EXTRUSION_RELATIVE:
+                    filament[segment] = values
+                    position += float(values.sum())
+                else:
+                    filament[segment] = np.diff(values, prepend=position)
+                    position = float(values[-1])
+
+            if setting < count:
+                row = rows[setting]
+                setting_mode, setting_position = store.get_extrusion_setting(row)
+                mode = setting_mode or mode
+                if not isnan(setting_position):
+                    position = setting_position
+                times[setting] = PrintEstimator.get_dwell_time(store.get_command(row))
+            start = setting + 1
+
+        filament = np.nan_to_num(filament)
+
+        # The moves that take time in the order they are made: moves with a length and extruder only moves
+        lengths_by_command = np.zeros(count)
+        lengths_by_command[moves] = distances
+        lengths_by_command[is_retract] = np.abs(filament[is_retract])
+        segments = np.flatnonzero(lengths_by_command > 0)
+
+        if len(segments) > 0:
+            times[segments] = PrintEstimator.get_move_times(segments, lengths_by_command, moves, delta_x, delta_y,
+                                                            feedrates, is_extrude, is_retract, motion_model)
+
+        # Totals per feature from the running sums at the feature boundaries
+        ends = np.cumsum(lengths)
+        time_sums = np.concatenate(([0.0], np.cumsum(times)))
+        filament_sums = np.concatenate(([0.0], np.cumsum(filament)))
+        feature_times = (time_sums[ends] - time_sums[ends - lengths]).tolist()
+        feature_filament = (filament_sums[ends] - filament_sums[ends - lengths]).tolist()
+
+        row_times = np.zeros(len(store))
+        row_times[rows] = times
+        row_filament = np.zeros(len(store))
+        row_filament[rows] = filament
+
+        end_state = tuple(None if isnan(value) else float(value) for value in (end_x, end_y, end_feedrate))
+        end_state += (mode, None if isnan(position) else float(position))
+        return LayerEstimate(revision, state, end_state, row_times, row_filament, [feature.name for feature in features],
+                             feature_times, feature_filament)
+
+    def get_move_times(segments: np.ndarray, lengths: np.ndarray, moves: np.ndarray, delta_x: np.ndarray, delta_y: np.ndarray,
+                       feedrates: np.ndarray, is_extrude: np.ndarray, is_retract: np.ndarray, motion_model: MotionModel) -> np.ndarray:
+        distances = lengths[segments]
+        speeds = feedrates[segments]
+        retracts = is_retract[segments]
+        accelerations = np.where(retracts, motion_model.retract_acceleration,
+                                 np.where(is_extrude[segments], motion_model.acceleration, motion_model.travel_acceleration))
+
+        # Direction of every move, the extruder only moves have none
+        direction_x = np.zeros(len(lengths))
+        direction_y = np.zeros(len(lengths))
+        direction_x[moves] = np.nan_to_num(delta_x) / np.maximum(lengths[moves], 1e-12)
+        direction_y[moves] = np.nan_to_num(delta_y) / np.maximum(lengths[moves], 1e-12)
+        direction_x, direction_y = direction_x[segments], direction_y[segments]
+
+        # Highest speed at every junction, from the change of velocity the jerk allows on either axis.
+        # Moves start and end at the jerk, so do the moves around an extruder only move.
+        change = np.maximum(np.abs(np.diff(direction_x)), np.abs(np.diff(direction_y)))
+        change[retracts[1:] | retracts[:-1]] = 1.0
+        with np.errstate(divide="ignore"):
+            junction_limits = np.minimum(np.minimum(speeds[1:], speeds[:-1]), motion_model.jerk / change)
+        limits = np.concatenate(([min(speeds[0], motion_model.jerk)], junction_limits, [min(speeds[-1], motion_model.jerk)]))
+
+        # The firmware planner's forward and backward passes, on squared speeds: a junction can be entered no faster
+        # than the one before it allows by accelerating over the move between them (v² ≤ u² + 2ad), and no faster
+        # than what still lets the next one be reached by braking. Both are running minimums over cumulative 2ad.
+        reach = np.concatenate(([0.0], np.cumsum(2.0 * accelerations * distances)))
+        squared = reach + np.minimum.accumulate(limits ** 2 - reach)
+        squared = np.minimum.accumulate((squared + reach)[::-1])[::-1] - reach
+        junction_speeds = np.sqrt(np.maximum(squared, 0.0))
+        entry, exit = junction_speeds[:-1], junction_speeds[1:]
+
+        # Trapezoid if the move is long enough to reach its feedrate, triangle up to the peak speed otherwise
+        accelerate = (speeds ** 2 - entry ** 2) / (2.0 * accelerations)
+        decelerate = (speeds ** 2 - exit ** 2) / (2.0 * accelerations)
+        cruise = distances - accelerate - decelerate
+        peak = np.sqrt((2.0 * accelerations * distances + entry ** 2 + exit ** 2) / 2.0)
+        top = np.where(cruise >= 0, speeds, peak)
+        return (2.0 * top - entry - exit) / accelerations + np.maximum(cruise, 0.0) / speeds
+
+    # Seconds a G4 waits, P is in milliseconds and S in seconds
+    def get_dwell_time(command: str) -> float:
+        command_parts = command.split(";")[0].split()
+        if len(command_parts) == 0 or command_parts[0] != "G4":
+            return 0.0
+
+        time = 0.0
+        for part in command_parts[1:]:
+            try:
+                if part.startswith("P"):
+                    time += float(part[1:]) / 1000.0
+                elif part.startswith("S"):
+                    time += float(part[1:])
+            except ValueError:
+                pass
+        return time
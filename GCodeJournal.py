@@ -0,0 +1,264 @@
+from __future__ import annotations
+from array import array
+
+from GCodeModel import Layer, Feature, Parent
+
+
+class _RowsChange:
+    # Contents of the rows of a feature's store that an edit changed, before and after it
+    feature: Feature
+    rows: array
+    before: tuple
+    after: tuple
+
+    def __init__(self, feature: Feature, rows: array, before: tuple, after: tuple) -> None:
+        self.feature = feature
+        self.rows = rows
+        self.before = before
+        self.after = after
+
+    def apply(self, state: tuple) -> None:
+        self.feature.store.set_rows_state(self.rows, state)
+        self.feature.modified()
+
+    def get_size(self) -> int:
+        size = len(self.rows) * self.rows.itemsize
+        for state in (self.before, self.after):
+            size += sum(len(values) * values.itemsize for values in state[:6])
+            size += sum(len(command) + 56 for command in state[6] if command != None) + len(state[6]) * 8
+        return size
+
+
+class _ChildrenChange:
+    # Splice of the children of a parent: the rows of a feature, the features of a layer or the layers of the model.
+    # Only the part between the common start and end is kept, the slice at start was before and became after.
+    parent: Parent
+    start: int
+    before: array | list
+    after: array | list
+
+    def __init__(self, parent: Parent, start: int, before: array | list, after: array | list) -> None:
+        self.parent = parent
+        self.start = start
+        self.before = before
+        self.after = after
+
+    def get_children(parent: Parent) -> array | list:
+        return parent.rows if isinstance(parent, Feature) else parent.children
+
+    def apply(self, children: array | list) -> None:
+        replaced = self.after if children is self.before else self.before
+        _ChildrenChange.get_children(self.parent)[self.start:self.start + len(replaced)] = children
+        self.parent.modified()
+
+    def get_size(self) -> int:
+        return sum(len(children) * (children.itemsize if isinstance(children, array) else 8) for children in (self.before, self.after))
+
+
+class _NameChange:
+    feature: Feature
+    before: str
+    after: str
+
+    def __init__(self, feature: Feature, before: str, after: str) -> None:
+        self.feature = feature
+        self.before = before
+        self.after = after
+
+    def apply(self, name: str) -> None:
+        self.feature.name = name
+        self.feature.modified()
+
+    def get_size(self) -> int:
+        return len(self.before) + len(self.after) + 112
+
+
+class JournalEntry:
+    # All changes of a single operation, undone and redone together
+    description: str
+    changes: list[_RowsChange | _ChildrenChange | _NameChange]
+    size: int
+
+    def __init__(self, description: str, changes: list[_RowsChange | _ChildrenChange | _NameChange]) -> None:
+        self.description = description
+        self.changes = changes
+        self.size = sum(change.get_size() for change in changes)
+
+    def get_parents(self) -> list[Parent]:
+        # Features, layers and the model whose children changed
+        return [change.parent for change in self.changes if isinstance(change, _ChildrenChange)]
+
+
+class Journal:
+    # Undo history of a model. Instead of copies of the model, an entry keeps what an operation actually changed:
+    # the contents of the edited rows and the spliced part of the children lists, both before and after.
+    #
+    # An operation is recorded between begin and end. Everything it may change is watched before it is changed,
+    # the state is only compared at the end, so watching the same thing again is cheap and bulk operations
+    # end up as a single entry. The oldest entries are dropped once the history gets larger than memory_limit.
+    memory_limit: int = 1 << 28
+    undo_entries: list[JournalEntry]
+    redo_entries: list[JournalEntry]
+    size: int = 0
+
+    # State of the operation being recorded
+    description: str = None
+    depth: int = 0
+    watched_rows: dict[int, tuple[Feature, set[int], list[tuple[array, tuple]]]]
+    watched_children: dict[int, tuple[Parent, array | list]]
+    watched_names: dict[int, tuple[Feature, str]]
+
+    def __init__(self) -> None:
+        self.undo_entries = []
+        self.redo_entries = []
+        self.watched_rows = {}
+        self.watched_children = {}
+        self.watched_names = {}
+
+    def is_recording(self) -> bool:
+        return self.depth > 0
+
+    def begin(self, description: str) -> None:
+        # Operations started while another one is recorded become part of it
+        if self.depth == 0:
+            self.description = description
+        self.depth += 1
+
+    def watch_rows(self, feature: Feature, rows: array) -> None:
+        if self.depth == 0:
+            return
+
+        # Only the state of rows that were not watched yet is saved, watching them again keeps their first state
+        _, watched, states = self.watched_rows.setdefault(id(feature), (feature, set(), []))
+        rows = array("q", (row for row in rows if row not in watched))
+        if len(rows) > 0:
+            watched.update(rows)
+            states.append((rows, feature.store.get_rows_state(rows)))
+
+    def watch_children(self, parent: Parent) -> None:
+        if self.depth == 0 or id(parent) in self.watched_children:
+            return
+        if isinstance(parent, Layer):
+            parent.load()
+        self.watched_children[id(parent)] = (parent, _ChildrenChange.get_children(parent)[:])
+
+    def watch_name(self, feature: Feature) -> None:
+        if self.depth == 0 or id(feature) in self.watched_names:
+            return
+        self.watched_names[id(feature)] = (feature, feature.name)
+
+    def end(self) -> None:
+        self.depth -= 1
+        if self.depth > 0:
+            return
+
+        changes = []
+        for feature, _, states in self.watched_rows.values():
+            change = Journal.compare_rows(feature, states)
+            if change != None:
+                changes.append(change)
+
+        for parent, before in self.watched_children.values():
+            change = Journal.compare_children(parent, before)
+            if change != None:
+                changes.append(change)
+
+        for feature, before in self.watched_names.values():
+            if feature.name != before:
+                changes.append(_NameChange(feature, before, feature.name))
+
+        self.watched_rows = {}
+        self.watched_children = {}
+        self.watched_names = {}
+
+        if len(changes) == 0:
+            return
+
+        entry = JournalEntry(self.description, changes)
+        self.undo_entries.append(entry)
+        self.redo_entries = []
+        self.size += entry.size
+
+        while self.size > self.memory_limit and len(self.undo_entries) > 1:
+            self.size -= self.undo_entries.pop(0).size
+
+    def compare_rows(feature: Feature, states: list[tuple[array, tuple]]) -> _RowsChange:
+        rows = array("q")
+        before = tuple(array(values.typecode) for values in states[0][1][:6]) + ([],)
+        for chunk_rows, state in states:
+            rows.extend(chunk_rows)
+            for values, chunk_values in zip(before, state):
+                values.extend(chunk_values)
+        after = feature.store.get_rows_state(rows)
+
+        # Only rows that differ are kept, coordinates are compared by their bits so NaN equals NaN
+        keys = []
+        for state in (before, after):
+            columns = [array("Q", values.tobytes()) if values.typecode == "d" else values for values in state[:6]]
+            keys.append(zip(*columns, state[6]))
+        changed = [index for index, (key_before, key_after) in enumerate(zip(*keys)) if key_before != key_after]
+
+        if len(changed) == 0:
+            return None
+        if len(changed) < len(rows):
+            rows = array("q", map(rows.__getitem__, changed))
+            before, after = (tuple(array(values.typecode, map(values.__getitem__, changed)) for values in state[:6])
+                             + (list(map(state[6].__getitem__, changed)),) for state in (before, after))
+        return _RowsChange(feature, rows, before, after)
+
+    def compare_children(parent: Parent, before: array | list) -> _ChildrenChange:
+        after = _ChildrenChange.get_children(parent)
+
+        # The common start and end are found by bisection, comparing slices is done in C
+        limit = min(len(before), len(after))
+        low, high = 0, limit
+        while low < high:
+            middle = (low + high + 1) // 2
+            if before[:middle] == after[:middle]:
+                low = middle
+            else:
+                high = middle - 1
+        start = low
+
+        low, high = 0, limit - start
+        while low < high:
+            middle = (low + high + 1) // 2
+            if before[len(before) - middle:] == after[len(after) - middle:]:
+                low = middle
+            else:
+                high = middle - 1
+        end = low
+
+        if start == len(before) == len(after):
+            return None
+        return _ChildrenChange(parent, start, before[start:len(before) - end], after[start:len(after) - end])
+
+    def can_undo(self) -> bool:
+        return len(self.undo_entries) > 0
+
+    def can_redo(self) -> bool:
+        return len(self.redo_entries) > 0
+
+    def undo(self) -> JournalEntry:
+        if len(self.undo_entries) == 0:
+            return None
+
+        entry = self.undo_entries.pop()
+        for change in reversed(entry.changes):
+            change.apply(change.before)
+
+        self.size -= entry.size
+        self.redo_entries.append(entry)
+        return entry
+
+    def redo(self) -> JournalEntry:
+        if len(self.redo_entries) == 0:
+            return None
+
+        entry = self.redo_entries.pop()
+        for change in entry.changes:
+            change.apply(change.after)
+
+        self.size += entry.size
+        self.undo_entries.append(entry)
+        return entry
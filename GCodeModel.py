@@ -1,5 +1,15 @@
 from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable, Iterator, Sequence
 from io import TextIOWrapper
+from itertools import accumulate, chain, compress, count, repeat
+import locale
+from math import hypot, isnan, nan, pi
+import mmap
+import os
+from operator import add, and_, lshift, ne, or_, sub
+import re
 
 
 class Child:
@@ -23,111 +33,576 @@ class Parent:
     def remove_child(self, child: Child) -> None:
         self.children.remove(child)
 
+    # Removes many children at once, given as the children themselves or as ranges of their indexes.
+    # The list is rebuilt a single time instead of being searched for every child.
+    def remove_children(self, children: Iterable[Child | range]) -> None:
+        self.children[:] = compress(self.children, self.get_keep_mask(children))
 
-class Command(Child):
-    command: str
-    is_move_command: bool = False
-    is_extrude_command: bool = False
-    x: float = None
-    y: float = None
-    e: float = None
-    f: float = None
-    color: str
-    selected_color: str
-
-    def __init__(self, parent: Feature, command: str) -> None:
-        super().__init__(parent=parent)
-        self.parse_command(command)
+    def get_keep_mask(self, children: Iterable[Child | range]) -> bytearray:
+        # One byte for every child, cleared for the ones to remove
+        mask = bytearray(b"\x01") * len(self.children)
+        positions = None
 
-    def parse_command(self, command: str) -> None:
-        self.command = command
+        for child in children:
+            if isinstance(child, range):
+                if child.step == 1:
+                    mask[child.start:child.stop] = bytes(len(mask[child.start:child.stop]))
+                else:
+                    for index in child:
+                        mask[index] = 0
+            else:
+                if positions == None:
+                    positions = self.get_child_positions()
+                mask[positions[self.get_child_key(child)]] = 0
+
+        return mask
+
+    def get_child_positions(self) -> dict[int, int]:
+        return {id(child): index for index, child in enumerate(self.children)}
+
+    def get_child_key(self, child: Child) -> int:
+        return id(child)
+
+
+# Line kind codes kept in CommandStore.kinds
+KIND_OTHER: int = 0
+KIND_COMMENT: int = 1
+KIND_MCODE: int = 2
+KIND_G0: int = 3
+KIND_G1: int = 4
+
+# Bit flags kept in CommandStore.flags
+FLAG_MOVE: int = 1
+FLAG_EXTRUDE: int = 2
+# The text of the command is made from its fields when it is read, see CommandStore.generate_commands
+FLAG_GENERATED: int = 4
+
+# E modes set by M82 and M83, or by G90 and G91 along with the other axes
+EXTRUSION_ABSOLUTE: int = 1
+EXTRUSION_RELATIVE: int = 2
+
+
+class CommandStore:
+    # Columnar storage for the commands of one layer (or of the pre/post print features).
+    # Every command is a row, the row number never changes once assigned so views stay valid.
+    # Missing coordinates are stored as NaN, the command text is a slice of the shared source
+    # buffer unless the command was edited or inserted, in which case it is kept in overrides,
+    # or unless the command is flagged to have its text generated from its fields.
+    source: str
+    kinds: array
+    flags: array
+    x: array
+    y: array
+    e: array
+    f: array
+    starts: array
+    ends: array
+    overrides: dict[int, str]
+
+    def __init__(self, source: str = "") -> None:
+        self.source = source
+        self.kinds = array("B")
+        self.flags = array("B")
+        self.x = array("d")
+        self.y = array("d")
+        self.e = array("d")
+        self.f = array("d")
+        self.starts = array("q")
+        self.ends = array("q")
+        self.overrides = {}
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def add_rows(self, other: CommandStore, first: int, last: int) -> int:
+        # Copies rows [first, last) of another store, returns the row number of the first copy
+        row = len(self.kinds)
+
+        self.kinds.extend(other.kinds[first:last])
+        self.flags.extend(other.flags[first:last])
+        self.x.extend(other.x[first:last])
+        self.y.extend(other.y[first:last])
+        self.e.extend(other.e[first:last])
+        self.f.extend(other.f[first:last])
+        self.starts.extend(other.starts[first:last])
+        self.ends.extend(other.ends[first:last])
+
+        for other_row, command in other.overrides.items():
+            if first <= other_row < last:
+                self.overrides[row + other_row - first] = command
+
+        return row
+
+    def add_command(self, command: str, start: int = -1, end: int = -1) -> int:
+        kind, flags, x, y, e, f = CommandStore.parse_fields(command)
+        row = len(self.kinds)
+
+        self.kinds.append(kind)
+        self.flags.append(flags)
+        self.x.append(x)
+        self.y.append(y)
+        self.e.append(e)
+        self.f.append(f)
+        self.starts.append(start)
+        self.ends.append(end)
+
+        # Commands which are not backed by the source buffer keep their own text
+        if start < 0:
+            self.overrides[row] = command
+
+        return row
+
+    def set_command(self, row: int, command: str) -> None:
+        kind, flags, x, y, e, f = CommandStore.parse_fields(command)
+
+        self.kinds[row] = kind
+        self.flags[row] = flags
+        self.x[row] = x
+        self.y[row] = y
+        self.e[row] = e
+        self.f[row] = f
+        self.overrides[row] = command
+
+    # Editable contents of some rows: the kind, flag and coordinate columns and the overridden text (None if not overridden)
+    def get_rows_state(self, rows: array) -> tuple[array, array, array, array, array, array, list[str]]:
+        columns = (self.kinds, self.flags, self.x, self.y, self.e, self.f)
+        return (*(array(column.typecode, map(column.__getitem__, rows)) for column in columns),
+                list(map(self.overrides.get, rows)))
+
+    def set_rows_state(self, rows: array, state: tuple[array, array, array, array, array, array, list[str]]) -> None:
+        for column, values in zip((self.kinds, self.flags, self.x, self.y, self.e, self.f), state):
+            for row, value in zip(rows, values):
+                column[row] = value
+
+        for row, command in zip(rows, state[6]):
+            if command == None:
+                self.overrides.pop(row, None)
+            else:
+                self.overrides[row] = command
+
+    # Regenerates the text of a move command from its fields, returns whether the row is a move command
+    def generate_command(self, row: int) -> bool:
+        flags = self.flags[row]
+        if not flags & FLAG_MOVE:
+            return False
+
+        self.overrides[row] = self.format_command(row)
+        self.kinds[row] = KIND_G1 if flags & FLAG_EXTRUDE else KIND_G0
+        return True
+
+    # Same as generate_command for many move commands, but their text is only made when it is read.
+    # Most of the commands changed at once are never looked at before the file is saved.
+    def generate_commands(self, rows: Iterable[int]) -> None:
+        kinds, flags, overrides = self.kinds, self.flags, self.overrides
+        for row in rows:
+            if flags[row] & FLAG_MOVE:
+                flags[row] |= FLAG_GENERATED
+                kinds[row] = KIND_G1 if flags[row] & FLAG_EXTRUDE else KIND_G0
+                if overrides:
+                    overrides.pop(row, None)
+
+    # Same as generate_commands for a NumPy array of rows
+    def generate_commands_numpy(self, rows, np) -> None:
+        flags = np.frombuffer(self.flags, np.uint8)
+        rows = rows[flags[rows] & FLAG_MOVE != 0]
+        flags[rows] |= FLAG_GENERATED
+        np.frombuffer(self.kinds, np.uint8)[rows] = np.where(flags[rows] & FLAG_EXTRUDE, KIND_G1, KIND_G0)
+
+        # Overrides are usually few, they are checked instead of the rows
+        if self.overrides:
+            generated = np.zeros(len(self), bool)
+            generated[rows] = True
+            for row in [row for row in self.overrides if generated[row]]:
+                del self.overrides[row]
+
+    # Text of a move command made from its fields
+    def format_command(self, row: int) -> str:
+        is_extrude_command = self.flags[row] & FLAG_EXTRUDE
+        command = "G1" if is_extrude_command else "G0"
+        if not isnan(self.f[row]):
+            command += f" F{self.f[row]:.1f}"
+        command += f" X{self.x[row]:.3f}"
+        command += f" Y{self.y[row]:.3f}"
+        if is_extrude_command:
+            command += f" E{self.e[row]:.5f}"
+        return command
+
+    # Returns the E mode set by M82/M83 or G90/G91 and the E position set by G92, None and NaN for anything else
+    def get_extrusion_setting(self, row: int) -> tuple[int, float]:
+        command_parts = self.get_command(row).split(" ")
+
+        match command_parts[0]:
+            case "M82" | "G90":
+                return EXTRUSION_ABSOLUTE, nan
+            case "M83" | "G91":
+                return EXTRUSION_RELATIVE, nan
+            case "G92":
+                for part in command_parts:
+                    if part.startswith("E"):
+                        return None, float(part[1::])
+
+        return None, nan
+
+    def get_command(self, row: int) -> str:
+        command = self.overrides.get(row)
+        if command is None:
+            if self.flags[row] & FLAG_GENERATED:
+                return self.format_command(row)
+            command = self.source[self.starts[row]:self.ends[row]]
+        return command
+
+    # Same as get_command, but the text of a generated command is kept, so it is made once for commands that are
+    # read over and over, like when a file is saved again. Only safe while nothing else changes the row.
+    def keep_command(self, row: int) -> str:
+        command = self.overrides.get(row)
+        if command is None:
+            if self.flags[row] & FLAG_GENERATED:
+                command = self.overrides[row] = self.format_command(row)
+            else:
+                command = self.source[self.starts[row]:self.ends[row]]
+        return command
+
+    def parse_fields(command: str) -> tuple[int, int, float, float, float, float]:
         command_parts = command.split(" ")
+        x = y = e = f = nan
 
         match command_parts[0]:
             case "G0":
-                self.color = "red"
-                self.selected_color = "darkturquoise"
+                kind = KIND_G0
             case "G1":
-                self.color = "royalblue"
-                self.selected_color = "gold"
+                kind = KIND_G1
             case _:
-                return # Not a move command, no need to continue parsing
+                # Not a move command, no need to continue parsing
+                if command.startswith(";"):
+                    return KIND_COMMENT, 0, x, y, e, f
+                if command.startswith("M"):
+                    return KIND_MCODE, 0, x, y, e, f
+                return KIND_OTHER, 0, x, y, e, f
 
         # Parts can go in any order, need to check all of them
         for part in command_parts:
             if part.startswith("X"):
-                self.x = float(part[1::])
+                x = float(part[1::])
             elif part.startswith("Y"):
-                self.y = float(part[1::])
+                y = float(part[1::])
             elif part.startswith("E"):
-                self.e = float(part[1::])
+                e = float(part[1::])
             elif part.startswith("F"):
-                self.f = float(part[1::])
-        
+                f = float(part[1::])
+
         # Move command must have both X and Y parts
-        self.is_move_command = (self.x != None and self.y != None)
-        self.is_extrude_command = self.e != None
-    
+        flags = FLAG_MOVE if not (isnan(x) or isnan(y)) else 0
+        if not isnan(e):
+            flags |= FLAG_EXTRUDE
+
+        return kind, flags, x, y, e, f
+
+
+class Command(Child):
+    # Thin view over a single CommandStore row, created on demand.
+    # Two views of the same row compare equal, so they can be used as dict keys.
+    row: int
+
+    COLORS = {KIND_G0: ("red", "darkturquoise"), KIND_G1: ("royalblue", "gold")}
+
+    def __init__(self, parent: Feature, row: int) -> None:
+        super().__init__(parent=parent)
+        self.row = row
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Command):
+            return NotImplemented
+        return self.row == other.row and self.parent.store is other.parent.store
+
+    def __hash__(self) -> int:
+        return hash((id(self.parent.store), self.row))
+
+    @property
+    def store(self) -> CommandStore:
+        return self.parent.store
+
+    @property
+    def command(self) -> str:
+        return self.parent.store.get_command(self.row)
+
+    @property
+    def kind(self) -> int:
+        return self.parent.store.kinds[self.row]
+
+    @property
+    def is_move_command(self) -> bool:
+        return bool(self.parent.store.flags[self.row] & FLAG_MOVE)
+
+    @property
+    def is_extrude_command(self) -> bool:
+        return bool(self.parent.store.flags[self.row] & FLAG_EXTRUDE)
+
+    @property
+    def color(self) -> str:
+        return self.COLORS.get(self.kind, (None, None))[0]
+
+    @property
+    def selected_color(self) -> str:
+        return self.COLORS.get(self.kind, (None, None))[1]
+
+    def _get_field(column: str):
+        def getter(self) -> float:
+            value = getattr(self.parent.store, column)[self.row]
+            return None if isnan(value) else value
+
+        def setter(self, value: float) -> None:
+            getattr(self.parent.store, column)[self.row] = nan if value == None else value
+            self.parent.modified()
+
+        return property(getter, setter)
+
+    x = _get_field("x")
+    y = _get_field("y")
+    e = _get_field("e")
+    f = _get_field("f")
+    del _get_field
+
+    def parse_command(self, command: str) -> None:
+        self.parent.store.set_command(self.row, command)
+        self.parent.modified()
+
     # Regenerate command string if this is a move command
     def generate_command(self) -> None:
-        if not self.is_move_command:
-            return
-        
-        self.command = "G1" if self.is_extrude_command else "G0"
-        if self.f != None:
-            self.command += f" F{self.f:.1f}"
-        self.command += f" X{self.x:.3f}"
-        self.command += f" Y{self.y:.3f}"
-        if self.is_extrude_command:
-            self.command += f" E{self.e:.5f}"
+        if self.parent.store.generate_command(self.row):
+            self.parent.modified()
+
+
+class _CommandList(Sequence):
+    # List-like access to the commands of a feature, backed by the feature's row array
+    feature: Feature
+
+    def __init__(self, feature: Feature) -> None:
+        self.feature = feature
+
+    def __len__(self) -> int:
+        return len(self.feature.rows)
+
+    def __getitem__(self, index: int | slice) -> Command | list[Command]:
+        if isinstance(index, slice):
+            return [Command(self.feature, row) for row in self.feature.rows[index]]
+        return Command(self.feature, self.feature.rows[index])
+
+    def __iter__(self) -> Iterator[Command]:
+        feature = self.feature
+        for row in feature.rows:
+            yield Command(feature, row)
+
+    def __reversed__(self) -> Iterator[Command]:
+        feature = self.feature
+        for row in reversed(feature.rows):
+            yield Command(feature, row)
+
+    def __contains__(self, command: object) -> bool:
+        return isinstance(command, Command) and command.parent is self.feature and command.row in self.feature.rows
+
+    def index(self, command: Command, start: int = 0, stop: int = None) -> int:
+        if not isinstance(command, Command) or command.parent is not self.feature:
+            raise ValueError(f"{command!r} is not in list")
+
+        rows = self.feature.rows
+        return rows.index(command.row, start, len(rows) if stop == None else stop)
+
+    def append(self, command: Command) -> None:
+        self.feature.rows.append(command.row)
+        self.feature.modified()
+
+    def insert(self, index: int, command: Command) -> None:
+        self.feature.rows.insert(index, command.row)
+        self.feature.modified()
+
+    def remove(self, command: Command) -> None:
+        del self.feature.rows[self.index(command)]
+        self.feature.modified()
 
 
 class Feature(Child, Parent):
     name: str
+    store: CommandStore
+    rows: array
+    children: _CommandList
+    # Range of store.source that holds the whole feature as parsed, cleared once the feature is modified
+    source_span: tuple[int, int] = None
 
-    def __init__(self, parent: Layer, name: str) -> None:
+    def __init__(self, parent: Layer | Model, name: str) -> None:
         super().__init__(parent=parent)
         self.name = name
+        self.store = parent.store
+        self.rows = array("q")
+        self.children = _CommandList(self)
     
-    def add_command(self, command: str) -> Command:
-        child = Command(self, command)
-        self.children.append(child)
-        return child
+    def modified(self) -> None:
+        self.source_span = None
+        self.parent.modified()
+    
+    def add_command(self, command: str, start: int = -1, end: int = -1) -> Command:
+        row = self.store.add_command(command, start, end)
+        self.rows.append(row)
+        self.modified()
+        return Command(self, row)
+    
+    def add_rows(self, store: CommandStore, first: int, last: int, span: tuple[int, int] = None) -> None:
+        # Span is the range of the source that holds the rows exactly as they would be exported, if there is one.
+        # The source span of the feature is kept as long as the rows continue right where the feature ended.
+        if len(self.rows) == 0:
+            self.source_span = span
+        elif self.source_span != None and span != None and span[0] == self.source_span[1] + 1:
+            self.source_span = (self.source_span[0], span[1])
+        else:
+            self.source_span = None
+
+        row = self.store.add_rows(store, first, last)
+        self.rows.extend(range(row, row + last - first))
     
     def insert_command(self, command: str, index: int) -> Command:
-        child = Command(self, command)
-        self.children.insert(index, child)
-        return child
+        row = self.store.add_command(command)
+        self.rows.insert(index, row)
+        self.modified()
+        return Command(self, row)
     
     def get_command(self, index: int) -> Command:
         return self.children[index]
 
-    def get_commands(self) -> list[Command]:
+    def get_commands(self) -> _CommandList:
         return self.children
+
+    def remove_children(self, children: Iterable[Command | range]) -> None:
+        self.rows[:] = array("q", compress(self.rows, self.get_keep_mask(children)))
+        self.modified()
+
+    def get_child_positions(self) -> dict[int, int]:
+        return {row: index for index, row in enumerate(self.rows)}
+
+    def get_child_key(self, child: Command) -> int:
+        return child.row
     
     def command_count(self) -> int:
-        return len(self.children)
+        return len(self.rows)
 
 
 class Layer(Child, Parent):
     features: list[Feature]
+    store: CommandStore
+    # Byte range of the layer in the mapped source file, set until a lazily loaded layer is parsed
+    source_range: tuple[int, int] = None
+    # Byte range the layer was loaded from, so it can be unloaded again
+    file_range: tuple[int, int] = None
+    # Increased on every edit of the layer or its commands, so views can tell when their cached data is stale
+    revision: int = 0
+    move_index: _MoveIndex = None
 
     def __init__(self, parent: Model):
         super().__init__(parent=parent)
+        self.store = CommandStore(parent.source)
+
+    def is_loaded(self) -> bool:
+        return self.source_range == None
+
+    def modified(self) -> None:
+        self.revision += 1
+
+    def get_move_index(self) -> _MoveIndex:
+        self.load()
+        if self.move_index == None or self.move_index.revision != self.revision or self.move_index.previous_x == None:
+            self.move_index = _MoveIndex(self)
+        return self.move_index
+
+    # Move index that is only used for where the layer ends, the one of an unloaded layer is kept without the rows
+    def get_end_state(self) -> _MoveIndex:
+        if self.has_end_state():
+            return self.move_index
+        return self.get_move_index()
+
+    def has_end_state(self) -> bool:
+        return self.move_index != None and self.move_index.revision == self.revision
+
+    # A copy parsed ahead of time from the source range, by parse_source on another thread, is taken over instead of parsing the layer again
+    def load(self, parsed_layer: Layer = None) -> None:
+        if self.source_range == None:
+            return
+
+        # The range is cleared last, a save running on another thread must never see a loaded layer without its features
+        if parsed_layer == None:
+            parsed_layer = self.parse_source(self.source_range)
+        self.load_payload(parsed_layer.payload())
+        self.file_range = self.source_range
+        self.source_range = None
+
+    # Drops the parsed contents of a layer that was loaded from the mapped source file, it is parsed again when accessed.
+    # Edits are lost, but where the layer ended is kept, so it is meant for layers that were already written out:
+    # the layers after it still start where the edited layer ended.
+    def unload(self) -> None:
+        if self.source_range != None or self.file_range == None:
+            return
+
+        if self.has_end_state():
+            self.move_index.release()
+        else:
+            self.move_index = None
+
+        self.store = CommandStore(self.parent.source)
+        self.children = []
+        self.source_range = self.file_range
+
+    # Compact form of the layer contents: the command store and the name, rows and source span of every feature
+    def payload(self) -> tuple[CommandStore, list[tuple[str, array, tuple[int, int]]]]:
+        return self.store, [(feature.name, feature.rows, feature.source_span) for feature in self.get_features()]
+
+    def load_payload(self, payload: tuple[CommandStore, list[tuple[str, array, tuple[int, int]]]]) -> None:
+        self.store, features = payload
+        self.children = []
+        for name, rows, source_span in features:
+            feature = Feature(self, name)
+            feature.rows = rows
+            feature.source_span = source_span
+            self.children.append(feature)
+
+    # Returns a parsed copy of a layer that is not loaded yet, without keeping it in memory
+    def peek(self) -> Layer:
+        # The range is read once, the layer might get loaded from another thread in the meantime
+        source_range = self.source_range
+        if source_range == None:
+            return self
+        return self.parse_source(source_range)
+
+    # Parsed copy of the layer from a range of the mapped source file, which is safe to do on any thread
+    def parse_source(self, source_range: tuple[int, int]) -> Layer:
+        return self.parent.source_file.parse_layer(*source_range)
+
+    def remove_child(self, child: Child) -> None:
+        self.load()
+        super().remove_child(child)
+        self.modified()
+
+    def remove_children(self, children: Iterable[Feature | range]) -> None:
+        self.load()
+        super().remove_children(children)
+        self.modified()
     
     def add_feature(self, feature: Feature):
+        self.load()
         self.children.append(feature)
+        self.modified()
     
     def insert_feature(self, feature: Feature, index: int):
+        self.load()
         self.children.insert(index, feature)
+        self.modified()
     
     def get_feature(self, index: int) -> Feature:
+        self.load()
         return self.children[index]
     
     def get_features(self) -> list[Feature]:
+        self.load()
         return self.children
     
     def feature_count(self) -> int:
+        self.load()
         return len(self.children)
 
 
@@ -135,12 +610,23 @@ class Model(Parent):
     feature_pre_print: Feature
     feature_post_print: Feature
     layer_height: float = None
+    source: str
+    store: CommandStore
+    # Set when layers are loaded lazily from a memory mapped file
+    source_file: _MappedSource = None
+    # Increased when the pre-print or post-print features are edited
+    revision: int = 0
 
-    def __init__(self) -> None:
+    def __init__(self, source: str = "") -> None:
         super().__init__()
+        self.source = source
+        self.store = CommandStore(source)
         self.feature_pre_print = Feature(self, "PRE_PRINT")
         self.feature_post_print = Feature(self, "POST_PRINT")
 
+    def modified(self) -> None:
+        self.revision += 1
+
     def add_layer(self, layer: Layer) -> None:
         self.children.append(layer)
     
@@ -148,7 +634,9 @@ class Model(Parent):
         self.children.insert(index, layer)
     
     def get_layer(self, index: int) -> Layer:
-        return self.children[index]
+        layer = self.children[index]
+        layer.load()
+        return layer
     
     def get_layers(self) -> list[Layer]:
         return self.children
@@ -156,17 +644,464 @@ class Model(Parent):
     def layer_count(self) -> int:
         return len(self.children)
     
-    def export(self, output_file: TextIOWrapper) -> None:
-        _GcodeExporter.export_model(output_file, self)
+    # progress is called with the exported fraction of the layers after every layer
+    # process_layer is called with every layer right before it is written. Layers that were not loaded before are
+    # unloaded again once the next one is written, so a file is processed without keeping all of its layers in memory.
+    def export(self, output_file: TextIOWrapper, progress: Callable[[float], None] = None, process_layer: Callable[[Layer], None] = None) -> None:
+        _GcodeExporter.export_model(output_file, self, progress, process_layer)
+    
+    # Loads every layer and closes the mapped source file, needed before the source file is overwritten
+    def release_source(self) -> None:
+        if self.source_file == None:
+            return
+
+        for layer in self.get_layers():
+            layer.load()
+
+        self.source_file.close()
+        self.source_file = None
+    
+    # Position of the print head when the layer starts, (nan, nan) if nothing before it has a move command
+    def get_start_position(self, layer: Layer) -> tuple[float, float]:
+        for previous_layer in reversed(self.children[:self.children.index(layer)]):
+            end_state = previous_layer.get_end_state()
+            if not isnan(end_state.last_x):
+                return end_state.last_x, end_state.last_y
+
+        for command in reversed(self.feature_pre_print.get_commands()):
+            if command.is_move_command:
+                return command.x, command.y
+        return nan, nan
+
+    # E mode and E position when the layer starts. The mode defaults to absolute, the position is NaN if unknown.
+    def get_extrusion_state(self, layer: Layer) -> tuple[int, float]:
+        mode, position = None, nan
+
+        for previous_layer in reversed(self.children[:self.children.index(layer)]):
+            if isnan(position) or previous_layer.is_loaded() or previous_layer.has_end_state():
+                end_state = previous_layer.get_end_state()
+                layer_mode, layer_position = end_state.last_mode, end_state.last_e
+            else:
+                # Only the mode is still needed, layers that were never loaded are searched without parsing them
+                layer_mode, layer_position = self.source_file.find_extrusion_mode(*previous_layer.source_range), nan
+
+            mode = mode or layer_mode
+            if isnan(position):
+                position = layer_position
+            if mode != None and not isnan(position):
+                return mode, position
+
+        pre_print_mode, pre_print_position = _MoveIndex.scan_extrusion(self.feature_pre_print.store, self.feature_pre_print.rows)
+        if isnan(position):
+            position = pre_print_position
+        return mode or pre_print_mode or EXTRUSION_ABSOLUTE, position
+
+    # Recalculates E of every extruding move in the given commands, features, layers and ranges of layer indexes.
+    # Returns the features that got new commands, see _MoveIndex.recalculate_extrusion.
+    def recalculate_extrusion(self, targets: list[Child | range], flow_model: FlowModel) -> list[Feature]:
+        rows_by_layer: dict[Layer, set[int]] = {}
+        for target in targets:
+            if isinstance(target, range):
+                for index in target:
+                    layer = self.get_layer(index)
+                    rows_by_layer.setdefault(layer, set()).update(chain.from_iterable(feature.rows for feature in layer.get_features()))
+            elif isinstance(target, Command) and isinstance(target.parent.parent, Layer):
+                rows_by_layer.setdefault(target.parent.parent, set()).add(target.row)
+            elif isinstance(target, Feature) and isinstance(target.parent, Layer):
+                rows_by_layer.setdefault(target.parent, set()).update(target.rows)
+            elif isinstance(target, Layer):
+                rows_by_layer.setdefault(target, set()).update(chain.from_iterable(feature.rows for feature in target.get_features()))
+
+        # Earlier layers first, a layer's E position at the end can depend on the layers before it
+        extended_features = []
+        for layer in sorted(rows_by_layer, key=self.children.index):
+            extended_features += layer.get_move_index().recalculate_extrusion(rows_by_layer[layer], flow_model)
+        return extended_features
     
     def parse_gcode(gcode_file: TextIOWrapper) -> Model:
         parser = _GCodeParser()
         return parser.parse(gcode_file)
 
+    # Only reads the layer boundaries, layers are parsed the first time they are accessed
+    def parse_gcode_lazy(file_name: str) -> Model:
+        return _MappedSource.open_model(file_name)
+
+    # Opens the file like parse_gcode_lazy, but yields while it looks for the layers: the model as soon as the parts
+    # outside of the layers are parsed, then the layers found since the last step, each time with the fraction of the
+    # file read so far. The layers are left for the caller to add to the model, so that can happen on another thread.
+    # Files that don't follow the usual layout are parsed up front, the model is None until they are done, and a
+    # model yielded after another one replaces it.
+    def parse_gcode_progressive(file_name: str) -> Iterator[tuple[Model, list[Layer], float]]:
+        return _MappedSource.open_model_progressive(file_name)
+
+    # Parses the layers in worker processes, max_workers defaults to the number of CPUs
+    def parse_gcode_parallel(file_name: str, max_workers: int = None) -> Model:
+        return _MappedSource.open_model_parallel(file_name, max_workers)
+
+
+class FlowModel:
+    # Filament needed for a line: the volume of the line (layer height by line width by length)
+    # divided by the cross-section of the filament, scaled by the flow multiplier
+    layer_height: float
+    line_width: float
+    filament_diameter: float
+    flow_multiplier: float
+
+    def __init__(self, layer_height: float, line_width: float, filament_diameter: float = 1.75, flow_multiplier: float = 1.0) -> None:
+        self.layer_height = layer_height
+        self.line_width = line_width
+        self.filament_diameter = filament_diameter
+        self.flow_multiplier = flow_multiplier
+
+    def get_extrusion(self, distance: float) -> float:
+        filament_area = pi * (self.filament_diameter / 2.0) ** 2
+        return self.layer_height * self.line_width * distance / filament_area * self.flow_multiplier
+
+
+class _MoveIndex:
+    # Position of the print head before every command of a layer, indexed by store row, so the previous move of
+    # a command is found without searching. Commands before the first move of the layer have NaN positions,
+    # they start where the previous layer ended. Rebuilt when the layer changes, except by edits of E values only.
+    # With NumPy a rebuild is a few array operations, cheap enough that the index isn't patched on every edit.
+    layer: Layer
+    revision: int
+    previous_x: array
+    previous_y: array
+    # Index of the feature that holds each row, -1 for rows no feature uses
+    feature_indexes: array
+    last_x: float
+    last_y: float
+    # E mode set last in the layer (None if the layer doesn't set it) and the E position at its end
+    last_mode: int
+    last_e: float
+
+    def __init__(self, layer: Layer) -> None:
+        self.layer = layer
+        self.revision = layer.revision
+
+        # NumPy is optional here, without it the rows are gone through one at a time
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if numpy != None:
+            self.index_rows_numpy(numpy)
+        else:
+            self.index_rows()
+
+    def index_rows(self) -> None:
+        layer = self.layer
+        store = layer.store
+        flags, xs, ys = store.flags, store.x, store.y
+        self.previous_x = previous_x = array("d", bytes(8 * len(store)))
+        self.previous_y = previous_y = array("d", bytes(8 * len(store)))
+        self.feature_indexes = feature_indexes = array("q", repeat(-1, len(store)))
+
+        x = y = nan
+        for feature_index, feature in enumerate(layer.get_features()):
+            for row in feature.rows:
+                previous_x[row] = x
+                previous_y[row] = y
+                feature_indexes[row] = feature_index
+                if flags[row] & FLAG_MOVE:
+                    x = xs[row]
+                    y = ys[row]
+
+        self.last_x, self.last_y = x, y
+        self.last_mode, self.last_e = _MoveIndex.scan_extrusion(store, chain.from_iterable(feature.rows for feature in layer.get_features()))
+
+    def index_rows_numpy(self, np) -> None:
+        store = self.layer.store
+        features = self.layer.get_features()
+        order = _MoveIndex.get_order(features, np)
+
+        # Every command starts at the last move before it, the first move is preceded by NaN
+        moves = np.flatnonzero(np.frombuffer(store.flags, np.uint8)[order] & FLAG_MOVE)
+        last_moves = np.searchsorted(moves, np.arange(len(order)))
+        xs = np.concatenate(([nan], np.frombuffer(store.x, np.float64)[order[moves]]))
+        ys = np.concatenate(([nan], np.frombuffer(store.y, np.float64)[order[moves]]))
+
+        previous_x, previous_y = np.zeros(len(store)), np.zeros(len(store))
+        previous_x[order], previous_y[order] = xs[last_moves], ys[last_moves]
+        feature_indexes = np.full(len(store), -1, np.int64)
+        feature_indexes[order] = np.repeat(np.arange(len(features)), [len(feature.rows) for feature in features])
+
+        self.previous_x = array("d", previous_x.tobytes())
+        self.previous_y = array("d", previous_y.tobytes())
+        self.feature_indexes = array("q", feature_indexes.tobytes())
+        self.last_x, self.last_y = float(xs[-1]), float(ys[-1])
+        self.last_mode, self.last_e = _MoveIndex.scan_extrusion_numpy(store, order, np)
+
+    # Keeps only where the layer ends, for a layer that is unloaded
+    def release(self) -> None:
+        self.previous_x = self.previous_y = self.feature_indexes = None
+
+    # Returns the last E mode set in the rows (None if none is) and the E position after them, assuming absolute E
+    # until a mode is set. The position is NaN if no command in the rows sets it.
+    def scan_extrusion(store: CommandStore, rows: Iterator[int]) -> tuple[int, float]:
+        kinds, flags, es = store.kinds, store.flags, store.e
+        mode, position = None, nan
+
+        for row in rows:
+            if flags[row] & FLAG_EXTRUDE:
+                position = position + es[row] if mode == EXTRUSION_RELATIVE else es[row]
+            elif kinds[row] == KIND_MCODE or kinds[row] == KIND_OTHER:
+                setting_mode, setting_position = store.get_extrusion_setting(row)
+                mode = setting_mode or mode
+                if not isnan(setting_position):
+                    position = setting_position
+
+        return mode, position
+
+    # Same as scan_extrusion for the rows in order, the extruding commands between two settings are handled at once
+    def scan_extrusion_numpy(store: CommandStore, order, np) -> tuple[int, float]:
+        extruding = np.flatnonzero(np.frombuffer(store.flags, np.uint8)[order] & FLAG_EXTRUDE)
+        es = np.frombuffer(store.e, np.float64)[order[extruding]]
+        mode, position = None, nan
+
+        segment_start = 0
+        for setting, setting_mode, setting_position in _MoveIndex.get_extrusion_settings(store, order, np):
+            segment_end = int(np.searchsorted(extruding, setting))
+            if segment_end > segment_start:
+                if mode == EXTRUSION_RELATIVE:
+                    position = float(np.cumsum(np.concatenate(([position], es[segment_start:segment_end])))[-1])
+                else:
+                    position = float(es[segment_end - 1])
+            segment_start = segment_end
+
+            mode = setting_mode or mode
+            if not isnan(setting_position):
+                position = setting_position
+
+        return mode, position
+
+    # Rows of the features one after another
+    def get_order(features: list[Feature], np):
+        return np.concatenate([np.empty(0, np.int64)] + [np.frombuffer(feature.rows, np.int64) for feature in features])
+
+    # Positions in order of the commands that set the E mode or position, with the mode and position they set.
+    # Ends with the end of the rows, which sets nothing. Only the commands that could be settings are read.
+    def get_extrusion_settings(store: CommandStore, order, np) -> list[tuple[int, int, float]]:
+        kinds = np.frombuffer(store.kinds, np.uint8)[order]
+        settings = []
+        for setting in np.flatnonzero((kinds == KIND_MCODE) | (kinds == KIND_OTHER)).tolist():
+            setting_mode, setting_position = store.get_extrusion_setting(int(order[setting]))
+            if setting_mode != None or not isnan(setting_position):
+                settings.append((setting, setting_mode, setting_position))
+        settings.append((len(order), None, nan))
+        return settings
+
+    def recalculate_extrusion(self, rows: set[int], flow_model: FlowModel) -> list[Feature]:
+        # With relative E only the recalculated moves change. With absolute E every recalculated move is offset by the
+        # change of the moves before it, and the original E position is restored with a G92 before the next command
+        # that uses E (or at the end of the layer), so the rest of the file stays as it is.
+        # Returns the features that got such G92 commands.
+        features = self.layer.get_features()
+
+        # NumPy is optional here, without it the commands are gone through one at a time
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if numpy != None:
+            modified_features, resyncs = self.update_extrusion_numpy(rows, flow_model, numpy)
+        else:
+            modified_features, resyncs = self.update_extrusion(rows, flow_model)
+
+        for feature_index in modified_features:
+            features[feature_index].modified()
+
+        # Positions don't depend on E, the index is still valid unless commands were inserted
+        if len(resyncs) == 0:
+            self.revision = self.layer.revision
+
+        for feature_index, command_index, command in reversed(resyncs):
+            features[feature_index].insert_command(command, command_index)
+
+        return list(dict.fromkeys(features[feature_index] for feature_index, _, _ in resyncs))
+
+    # Sets the new E values and marks their text to be generated. Returns the indexes of the features with changed
+    # moves, and the G92 commands to insert with the feature and command index to insert them at.
+    # Recalculated E positions are summed up unrounded and only rounded on their own.
+    def update_extrusion(self, rows: set[int], flow_model: FlowModel) -> tuple[set[int], list[tuple[int, int, str]]]:
+        store = self.layer.store
+        kinds, flags, xs, ys, es = store.kinds, store.flags, store.x, store.y, store.e
+        features = self.layer.get_features()
+
+        start_position = None
+        mode, position = self.layer.parent.get_extrusion_state(self.layer)
+        total, offset = position, 0.0
+
+        changed_rows: list[int] = []
+        modified_features: set[int] = set()
+        resyncs: list[tuple[int, int, str]] = []
+
+        for feature_index, feature in enumerate(features):
+            for command_index, row in enumerate(feature.rows):
+                if flags[row] & FLAG_EXTRUDE:
+                    extrusion = None
+                    if row in rows and flags[row] & FLAG_MOVE:
+                        previous_x, previous_y = self.previous_x[row], self.previous_y[row]
+                        if isnan(previous_x):
+                            # Only looked up once, and only if some command needs it
+                            if start_position == None:
+                                start_position = self.layer.parent.get_start_position(self.layer)
+                            previous_x, previous_y = start_position
+                        if not isnan(previous_x):
+                            extrusion = flow_model.get_extrusion(hypot(xs[row] - previous_x, ys[row] - previous_y))
+
+                    if mode == EXTRUSION_RELATIVE:
+                        if extrusion != None:
+                            es[row] = extrusion
+                            changed_rows.append(row)
+                            modified_features.add(feature_index)
+                        continue
+
+                    original = es[row]
+                    if extrusion != None and not isnan(position):
+                        total += extrusion
+                        es[row] = round(total, 5)
+                        offset = es[row] - original
+                        changed_rows.append(row)
+                        modified_features.add(feature_index)
+                    else:
+                        if offset != 0.0:
+                            resyncs.append((feature_index, command_index, f"G92 E{position:.5f}"))
+                        total, offset = original, 0.0
+                    position = original
+
+                elif kinds[row] == KIND_MCODE or kinds[row] == KIND_OTHER:
+                    setting_mode, setting_position = store.get_extrusion_setting(row)
+                    if setting_mode != None:
+                        if offset != 0.0:
+                            resyncs.append((feature_index, command_index, f"G92 E{position:.5f}"))
+                        total, offset = position, 0.0
+                        mode = setting_mode
+                    if not isnan(setting_position):
+                        position = total = setting_position
+                        offset = 0.0
+
+        if offset != 0.0:
+            resyncs.append((len(features) - 1, features[-1].command_count(), f"G92 E{position:.5f}"))
+
+        store.generate_commands(changed_rows)
+        return modified_features, resyncs
+
+    # Same as update_extrusion, with the layer split into segments at the commands that set the E mode or position.
+    # Within a segment the moves are handled all at once, E positions are summed up over runs of recalculated moves.
+    def update_extrusion_numpy(self, rows: set[int], flow_model: FlowModel, np) -> tuple[list[int], list[tuple[int, int, str]]]:
+        store = self.layer.store
+        features = self.layer.get_features()
+        mode, position = self.layer.parent.get_extrusion_state(self.layer)
+
+        # Rows of the layer in order, the feature and command index of a position in it are found by the feature starts
+        order = _MoveIndex.get_order(features, np)
+        feature_starts = list(accumulate((len(feature.rows) for feature in features), initial=0))
+        def get_indexes(position: int) -> tuple[int, int]:
+            feature_index = bisect_right(feature_starts, position) - 1
+            return feature_index, position - feature_starts[feature_index]
+
+        flags = np.frombuffer(store.flags, np.uint8)[order]
+        selected = np.zeros(len(store), bool)
+        selected[np.fromiter(rows, np.int64, len(rows))] = True
+
+        # Lengths of the selected extruding moves, the ones before the first move of the layer start where the layer starts
+        extruding = np.flatnonzero(flags & FLAG_EXTRUDE)
+        originals = np.frombuffer(store.e, np.float64)[order[extruding]]
+        candidates = np.flatnonzero((flags[extruding] & FLAG_MOVE != 0) & selected[order[extruding]])
+        candidate_rows = order[extruding[candidates]]
+        previous_x = np.frombuffer(self.previous_x, np.float64)[candidate_rows]
+        previous_y = np.frombuffer(self.previous_y, np.float64)[candidate_rows]
+        unknown = np.isnan(previous_x)
+        if unknown.any():
+            previous_x[unknown], previous_y[unknown] = self.layer.parent.get_start_position(self.layer)
+        known = ~np.isnan(previous_x)
+        distances = np.hypot(np.frombuffer(store.x, np.float64)[candidate_rows[known]] - previous_x[known],
+                             np.frombuffer(store.y, np.float64)[candidate_rows[known]] - previous_y[known])
+
+        # Extrusion of every extruding command, NaN if it is not recalculated
+        extrusions = np.full(len(extruding), np.nan)
+        extrusions[candidates[known]] = flow_model.get_extrusion(distances)
+
+        # Segments end at the commands that set the E mode or position
+        settings = _MoveIndex.get_extrusion_settings(store, order, np)
+        segment_ends = np.searchsorted(extruding, [setting for setting, _, _ in settings])
+
+        changed_rows, changed_es, resyncs = [np.empty(0, np.int64)], [np.empty(0)], []
+        segment_start = 0
+        for (setting, setting_mode, setting_position), segment_end in zip(settings, segment_ends.tolist()):
+            segment = slice(segment_start, segment_end)
+            segment_start = segment_end
+            recalculated = ~np.isnan(extrusions[segment])
+            offset = 0.0
+
+            if mode == EXTRUSION_RELATIVE:
+                changed_rows.append(order[extruding[segment][recalculated]])
+                changed_es.append(extrusions[segment][recalculated])
+
+            elif segment_end > segment.start:
+                # Every recalculated move continues from the unrounded E position of the one before it, or from
+                # the original position of the command before it if that one is not recalculated
+                segment_originals = originals[segment]
+                previous_originals = np.concatenate(([position], segment_originals[:-1]))
+                if isnan(position):
+                    recalculated[0] = False
+                run_starts = recalculated & ~np.concatenate(([False], recalculated[:-1]))
+
+                totals = np.where(run_starts, previous_originals + extrusions[segment], extrusions[segment])[recalculated]
+                run_bounds = np.flatnonzero(run_starts[recalculated]).tolist() + [len(totals)]
+                for run_start, run_end in zip(run_bounds, run_bounds[1:]):
+                    if run_end - run_start > 1:
+                        np.cumsum(totals[run_start:run_end], out=totals[run_start:run_end])
+                totals = np.round(totals, 5)
+                changed_rows.append(order[extruding[segment][recalculated]])
+                changed_es.append(totals)
+
+                # The original position is restored before the first command using E after a run that is off
+                offsets = np.zeros(len(recalculated))
+                offsets[recalculated] = totals - segment_originals[recalculated]
+                for resync in np.flatnonzero((offsets[:-1] != 0.0) & ~recalculated[1:]).tolist():
+                    resyncs.append((*get_indexes(int(extruding[segment.start + resync + 1])), f"G92 E{segment_originals[resync]:.5f}"))
+                offset = offsets[-1]
+                position = float(segment_originals[-1])
+
+            if setting == len(order):
+                if offset != 0.0:
+                    resyncs.append((len(features) - 1, features[-1].command_count(), f"G92 E{position:.5f}"))
+                break
+
+            if setting_mode != None:
+                if offset != 0.0:
+                    resyncs.append((*get_indexes(setting), f"G92 E{position:.5f}"))
+                mode = setting_mode
+            if not isnan(setting_position):
+                position = setting_position
+
+        changed_rows = np.concatenate(changed_rows)
+        np.frombuffer(store.e, np.float64)[changed_rows] = np.concatenate(changed_es)
+        store.generate_commands_numpy(changed_rows, np)
+        modified_features = np.zeros(len(features), bool)
+        modified_features[np.frombuffer(self.feature_indexes, np.int64)[changed_rows]] = True
+        return np.flatnonzero(modified_features).tolist(), resyncs
+
 
 class _GCodeParser:
     FEATURE_TYPES = ("FILL", "SKIN", "SKIRT", "SUPPORT", "SUPPORT-INTERFACE", "WALL-INNER", "WALL-OUTER")
 
+    # The source is scanned in chunks of roughly this many characters, split on line boundaries.
+    # Small enough that the NumPy arrays of a chunk stay in the cache.
+    CHUNK_SIZE = 1 << 20
+
+    # Matches every line once. Captures the kind prefix, and for G0/G1 lines the value of the last X, Y, E and F parameters
+    LINE_PATTERN = re.compile(
+        r"^[^\S\n]*(?:(G[01])(?= |[^\S\n]*$)"
+        r"(?=(?:[^\n]* X([^ \n]*))?)(?=(?:[^\n]* Y([^ \n]*))?)(?=(?:[^\n]* E([^ \n]*))?)(?=(?:[^\n]* F([^ \n]*))?)"
+        r"|(;|M))?[^\n]*$", re.MULTILINE)
+    KIND_CODES = {"": KIND_OTHER, ";": KIND_COMMENT, "M": KIND_MCODE, "G0": KIND_G0, "G1": KIND_G1}
+    COLON = re.compile(":")
+
     parsed_model: Model
     layer_count: int
 
@@ -176,6 +1111,26 @@ class _GCodeParser:
     current_layer: Layer
     current_feature: Feature
 
+    # Lines of the chunk being parsed and the index of the annotation being handled
+    chunk: CommandStore
+    line_index: int
+    # Lines of the chunk after which the next line doesn't start right away, because whitespace was stripped
+    chunk_gaps: list[int]
+
+    def add_lines(self, first: int, last: int) -> None:
+        if last <= first:
+            return
+
+        # The lines are exported straight from the source unless there is a gap between them
+        span = None
+        gap = bisect_left(self.chunk_gaps, first)
+        if gap == len(self.chunk_gaps) or self.chunk_gaps[gap] >= last - 1:
+            span = (self.chunk.starts[first], self.chunk.ends[last - 1])
+        self.current_feature.add_rows(self.chunk, first, last, span)
+
+    def add_annotation_line(self) -> None:
+        self.add_lines(self.line_index, self.line_index + 1)
+
     def set_layer_count(self, count: str, _) -> bool:
         self.layer_count = int(count)
         return True
@@ -185,15 +1140,14 @@ class _GCodeParser:
         self.current_feature = Feature(self.current_layer, "LAYER_START")
         return True
     
-    def end_layer(self, _, command) -> bool:
+    def end_layer(self, _, __) -> bool:
         self.current_layer.add_feature(self.current_feature)
         self.parsed_model.add_layer(self.current_layer)
 
-        a = self.parsed_model.layer_count()
         if self.parsed_model.layer_count() != self.layer_count:
             return True
         
-        self.current_feature.add_command(command)
+        self.add_annotation_line()
         self.current_feature = self.parsed_model.feature_post_print
         return False
 
@@ -217,43 +1171,593 @@ class _GCodeParser:
     # These commands return a bool, whether this command should be added to commands list automatically (True) or not (False)
     ANNOTATION_COMMANDS = {"LAYER_COUNT":set_layer_count, "LAYER":start_layer, "TIME_ELAPSED":end_layer, "TYPE":start_feature, "MESH":start_mesh, "Layer height":set_layer_height}
 
-    def parse_line(self, line: str) -> None:
-        # Commands
-        if not line.startswith(";"):
-            self.current_feature.add_command(line)
-            return
+    def scan_lines(source: str, position: int, end: int) -> CommandStore:
+        # Builds the columns for every line in source[position:end] without a per-line Python loop
+        lines = source[position:end].split("\n")
+        kinds, xs, ys, es, fs, others = zip(*_GCodeParser.LINE_PATTERN.findall(source, position, end))
 
-        # Comments
-        if len(line[1::].split(":")) != 2:
-            self.current_feature.add_command(line)
-            return
+        chunk = CommandStore(source)
+        chunk.kinds = array("B", map(_GCodeParser.KIND_CODES.__getitem__, map(add, kinds, others)))
+        chunk.x = array("d", map(float, [value or "nan" for value in xs]))
+        chunk.y = array("d", map(float, [value or "nan" for value in ys]))
+        chunk.e = array("d", map(float, [value or "nan" for value in es]))
+        chunk.f = array("d", map(float, [value or "nan" for value in fs]))
 
-        # Command comments
-        annotation_command, annotation_value = line[1::].split(":")
-        if annotation_command in self.ANNOTATION_COMMANDS:
-            if self.ANNOTATION_COMMANDS[annotation_command](self, annotation_value, line):
-                self.current_feature.add_command(line)
+        # Move command must have both X and Y parts
+        moves = map(and_, map(bool, xs), map(bool, ys))
+        extrudes = map(lshift, map(bool, es), repeat(1))
+        chunk.flags = array("B", map(or_, moves, extrudes))
+
+        # Offsets of the stripped lines in the source
+        lengths = list(map(len, lines))
+        line_starts = accumulate(map(add, lengths, repeat(1)), initial=position)
+        chunk.starts = array("q", map(sub, map(add, line_starts, lengths), map(len, map(str.lstrip, lines))))
+        chunk.ends = array("q", map(add, chunk.starts, map(len, map(str.strip, lines))))
+
+        return chunk
+
+    def scan_lines_numpy(source: str, position: int, end: int, np) -> CommandStore:
+        # Same as scan_lines, but works on the raw bytes of the chunk with NumPy.
+        # Returns None if the chunk is not ASCII or some parameter value can not be read, scan_lines then handles it.
+        text = source[position:end]
+        if not text.isascii():
+            return None
+
+        data = np.frombuffer(text.encode("ascii"), np.uint8)
+        size = len(data)
+
+        newlines = np.flatnonzero(data == ord("\n"))
+        line_starts = np.concatenate(([0], newlines + 1))
+        line_ends = np.concatenate((newlines, [size]))
+
+        # Strip the same whitespace str.strip does, only a few lines have any so step over it one character at a time
+        whitespace = np.zeros(256, bool)
+        whitespace[[ord(char) for char in "\t\n\v\f\r\x1c\x1d\x1e\x1f "]] = True
+        padded = np.concatenate((data, np.full(3, ord(" "), np.uint8)))
+
+        starts = line_starts.copy()
+        stripped = np.flatnonzero(whitespace[padded[starts]] & (starts < line_ends))
+        while len(stripped):
+            starts[stripped] += 1
+            stripped = stripped[whitespace[padded[starts[stripped]]] & (starts[stripped] < line_ends[stripped])]
+
+        ends = line_ends.copy()
+        stripped = np.flatnonzero(whitespace[padded[ends - 1]] & (ends > starts))
+        while len(stripped):
+            ends[stripped] -= 1
+            stripped = stripped[whitespace[padded[ends[stripped] - 1]] & (ends[stripped] > starts[stripped])]
+        lengths = ends - starts
+
+        first_char = padded[starts]
+        second_char = padded[starts + 1]
+        third_char = padded[starts + 2]
+
+        kinds = np.full(len(starts), KIND_OTHER, np.uint8)
+        kinds[(first_char == ord(";")) & (lengths > 0)] = KIND_COMMENT
+        kinds[(first_char == ord("M")) & (lengths > 0)] = KIND_MCODE
+        moves = (first_char == ord("G")) & ((lengths == 2) | (third_char == ord(" ")))
+        kinds[moves & (second_char == ord("0"))] = KIND_G0
+        kinds[moves & (second_char == ord("1"))] = KIND_G1
+        moves = kinds >= KIND_G0
+
+        # Parameters are the parts of a move command that follow a space, the value of one runs up to the next space
+        letters = np.zeros(256, np.int8)
+        for index, letter in enumerate("XYEF"):
+            letters[ord(letter)] = index + 1
+        spaces = np.concatenate((np.flatnonzero(data == ord(" ")), [size]))
+        token_spaces = np.flatnonzero(letters[padded[spaces + 1]])
+        tokens = spaces[token_spaces] + 1
+
+        # Tokens are found in order, so the tokens of each line follow the one the line starts with
+        line_tokens = np.diff(np.searchsorted(tokens, line_starts), append=len(tokens))
+        in_moves = np.repeat(moves, line_tokens)
+        token_lines = np.repeat(np.flatnonzero(moves), line_tokens[moves])
+        if not in_moves.all():
+            tokens, token_spaces = tokens[in_moves], token_spaces[in_moves]
+
+        value_starts = tokens + 1
+        value_ends = np.minimum(spaces[token_spaces + 1], ends[token_lines])
+        token_letters = letters[data[tokens]]
+
+        # Empty values are treated as missing, and only the last value of each letter on a line is used
+        keep = value_ends > value_starts
+        for index in range(1, 5):
+            letter_tokens = np.flatnonzero(keep & (token_letters == index))
+            letter_lines = token_lines[letter_tokens]
+            keep[letter_tokens[np.flatnonzero(letter_lines[1:] == letter_lines[:-1])]] = False
+        if not keep.all():
+            value_starts, value_ends = value_starts[keep], value_ends[keep]
+            token_lines, token_letters = token_lines[keep], token_letters[keep]
+
+        values = _GCodeParser.parse_decimals(data, value_starts, value_ends, np)
+        if values is None:
+            return None
+
+        columns = np.full((5, len(starts)), np.nan)
+        columns[token_letters, token_lines] = values
+        _, x, y, e, f = columns
+
+        flags = (~np.isnan(x) & ~np.isnan(y)).astype(np.uint8) * FLAG_MOVE
+        flags[~np.isnan(e)] |= FLAG_EXTRUDE
+
+        chunk = CommandStore(source)
+        chunk.kinds = array("B", kinds.tobytes())
+        chunk.flags = array("B", flags.tobytes())
+        chunk.x = array("d", x.tobytes())
+        chunk.y = array("d", y.tobytes())
+        chunk.e = array("d", e.tobytes())
+        chunk.f = array("d", f.tobytes())
+        chunk.starts = array("q", (starts + position).astype(np.int64).tobytes())
+        chunk.ends = array("q", (ends + position).astype(np.int64).tobytes())
+
+        return chunk
+
+    def parse_decimals(data, value_starts, value_ends, np):
+        # Reads plain decimal numbers like "-12.345" from data[value_starts[i]:value_ends[i]].
+        # Every value is right aligned in a row of 16 characters padded with zeros, the digits of a row are
+        # combined pairwise into an exact integer that is divided by a power of ten once, which rounds the
+        # same way float() does. Returns None for anything else.
+        if len(value_starts) == 0:
+            return np.empty(0)
+
+        lengths = value_ends - value_starts
+        if lengths.min() < 1 or lengths.max() > 16:
+            return None
+
+        # Only values close to the start of the data need padding in front for a full row
+        if value_ends.min() < 16:
+            data = np.concatenate((np.zeros(16, np.uint8), data))
+            value_ends = value_ends + 16
+        chars = np.lib.stride_tricks.sliding_window_view(data, 16)[value_ends - 16]
+
+        # Digits of the characters, the ones before a value are masked to zero with rows looked up by its length.
+        # Other characters wrap around to values above 9.
+        digits = np.subtract(chars, ord("0"), out=chars)
+        digits *= np.take((np.arange(16) >= 16 - np.arange(17)[:, None]).astype(np.uint8), lengths, axis=0)
+
+        # A minus sign can only start the value
+        rows = np.arange(len(lengths))
+        firsts = 16 - lengths
+        negative = digits[rows, firsts] == ord("-") - ord("0") + 256
+        digits[rows[negative], firsts[negative]] = 0
+
+        # There can be one point, it is left as a zero digit and taken out of the combined integer below
+        dot_positions = np.flatnonzero(digits == ord(".") - ord("0") + 256)
+        dot_rows, dot_columns = dot_positions >> 4, dot_positions & 15
+        if (dot_rows[1:] == dot_rows[:-1]).any():
+            return None
+        digits[dot_rows, dot_columns] = 0
+        if digits.max() > 9:
+            return None
+
+        has_dot = np.zeros(len(lengths), bool)
+        has_dot[dot_rows] = True
+        digit_counts = lengths - has_dot - negative
+        if (digit_counts == 0).any() or (digit_counts > 15).any():
+            return None
+
+        for dtype, scale in ((np.uint8, 10), (np.uint16, 100), (np.uint32, 10 ** 4), (np.uint64, 10 ** 8)):
+            pairs = np.multiply(digits[:, 0::2], scale, dtype=dtype)
+            pairs += digits[:, 1::2]
+            digits = pairs
+        combined = digits[:, 0].view(np.int64)
+
+        fraction_digits = np.zeros(len(lengths), np.int64)
+        fraction_digits[dot_rows] = 15 - dot_columns
+        scale = 10 ** fraction_digits
+        mantissa = np.where(has_dot, combined // (scale * 10) * scale + combined % scale, combined)
+
+        values = mantissa / scale
+        return np.where(negative, -values, values)
+
+    def parse_chunk(self, source: str, position: int, end: int, numpy) -> None:
+        self.chunk = None
+        if numpy != None:
+            self.chunk = _GCodeParser.scan_lines_numpy(source, position, end, numpy)
+        if self.chunk == None:
+            self.chunk = _GCodeParser.scan_lines(source, position, end)
+
+        if numpy != None:
+            starts, ends = numpy.frombuffer(self.chunk.starts, numpy.int64), numpy.frombuffer(self.chunk.ends, numpy.int64)
+            self.chunk_gaps = numpy.flatnonzero(starts[1:] != ends[:-1] + 1).tolist()
         else:
-            self.current_feature.add_command(line)
+            self.chunk_gaps = list(compress(count(), map(ne, self.chunk.starts[1:], map(add, self.chunk.ends, repeat(1)))))
+
+        # Only comments with exactly one colon can be annotations, so only the lines holding a colon are looked at.
+        # Plain lines between annotations are added to the current feature in bulk
+        first_line = 0
+        colon_lines = (bisect_right(self.chunk.starts, colon.start()) - 1 for colon in self.COLON.finditer(source, position, end))
+        for line_index in dict.fromkeys(colon_lines):
+            if self.chunk.kinds[line_index] != KIND_COMMENT:
+                continue
+
+            line = self.chunk.get_command(line_index)
+            annotation = line[1::].split(":")
+            if len(annotation) != 2 or annotation[0] not in self.ANNOTATION_COMMANDS:
+                continue
+
+            self.add_lines(first_line, line_index)
+            first_line = line_index + 1
+
+            self.line_index = line_index
+            annotation_command, annotation_value = annotation
+            if self.ANNOTATION_COMMANDS[annotation_command](self, annotation_value, line):
+                self.add_annotation_line()
+
+        self.add_lines(first_line, len(self.chunk))
 
     def parse(self, gcode_file: TextIOWrapper) -> Model:
-        self.parsed_model = Model()
+        # The whole file is kept as a single buffer, commands only reference their slice of it
+        return self.parse_source(gcode_file.read())
+
+    def parse_source(self, source: str) -> Model:
+        for _ in self.parse_source_steps(source):
+            pass
+        return self.parsed_model
+
+    # Parses the source a chunk at a time, yielding the fraction of it parsed so far after every chunk
+    def parse_source_steps(self, source: str) -> Iterator[float]:
+        self.parsed_model = Model(source)
         self.current_feature = self.parsed_model.feature_pre_print
 
-        gcode_line = gcode_file.readline()
+        # A trailing newline does not start another line
+        source_end = len(source) - 1 if source.endswith("\n") else len(source)
 
-        while gcode_line != "":
-            gcode_line = gcode_line.strip()
-            self.parse_line(gcode_line)
-            gcode_line = gcode_file.readline()
-        
-        return self.parsed_model
+        # NumPy is optional here, without it the chunks are scanned with regular expressions
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        position = 0
+        while position < len(source):
+            chunk_end = source.find("\n", position + self.CHUNK_SIZE, source_end)
+            if chunk_end == -1:
+                chunk_end = source_end
+
+            self.parse_chunk(source, position, chunk_end, numpy)
+            position = chunk_end + 1
+            yield min(position / len(source), 1.0)
+
+
+class _MappedSource:
+    # Read-only memory map of a G-code file. The first pass only looks for the layer boundaries,
+    # each layer is decoded and parsed from its byte range when it is first accessed.
+    STRIPPED_WHITESPACE = re.compile(r"^[^\S\n]|[^\S\n]$", re.MULTILINE)
+    # Bytes scanned for layers between two steps of a progressive open
+    SCAN_STEP: int = 1 << 23
+    EXTRUSION_MODE = re.compile(rb"^[ \t]*(M8[23]|G9[01])(?: |[ \t\r]*$)", re.MULTILINE)
+    # Annotations that need an open layer. After the last layer parse_gcode still adds them to that layer,
+    # so a file with them there is parsed up front.
+    LAYER_ANNOTATIONS = (b"TIME_ELAPSED", b"TYPE", b"MESH")
+
+    file_name: str
+    encoding: str
+    mapping: mmap.mmap
+    layer_count: int
+
+    def __init__(self, file_name: str) -> None:
+        self.file_name = file_name
+        # Same encoding open() uses in text mode
+        self.encoding = locale.getpreferredencoding(False)
+
+        with open(file_name, "rb") as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self) -> None:
+        self.mapping.close()
+
+    def read(self, start: int, end: int) -> str:
+        # Newlines are translated like in text mode
+        return str(self.mapping[start:end], self.encoding).replace("\r\n", "\n").replace("\r", "\n")
+
+    def read_unstripped(self, start: int, end: int) -> str:
+        # Returns the text if no line in it has whitespace that parsing would strip, so it can be exported as is
+        text = self.read(start, end)
+
+        # Plain substring searches are much faster than the regular expression, which is only needed for unusual whitespace
+        if text.isascii() and not any(char in text for char in "\t\v\f\r\x1c\x1d\x1e\x1f"):
+            stripped = " \n" in text or "\n " in text or text[:1] == " " or text[-1:] == " "
+        else:
+            stripped = _MappedSource.STRIPPED_WHITESPACE.search(text) != None
+
+        if stripped:
+            return None
+        return text if text.endswith("\n") else text + "\n"
+
+    def find_extrusion_mode(self, start: int, end: int) -> int:
+        # Last E mode set in the byte range, None if it has no M82, M83, G90 or G91
+        modes = _MappedSource.EXTRUSION_MODE.findall(self.mapping, start, end)
+        if len(modes) == 0:
+            return None
+        return EXTRUSION_ABSOLUTE if modes[-1] in (b"M82", b"G90") else EXTRUSION_RELATIVE
+
+    def find_annotation(self, name: bytes, start: int, end: int) -> tuple[int, int, bytes]:
+        # Finds the next annotation line, returns where the line starts and ends (including the newline) and its value
+        position = self.mapping.find(b";" + name + b":", start, end)
+
+        while position != -1:
+            annotation = self.read_annotation(position, end)
+            if annotation != None:
+                return annotation
+
+            position = self.mapping.find(b";" + name + b":", position + 1, end)
+
+        return None
+
+    def find_last_annotation(self, name: bytes, start: int, end: int) -> tuple[int, int, bytes]:
+        # Same as find_annotation, but searches backwards from the end of the range
+        position = self.mapping.rfind(b";" + name + b":", start, end)
+
+        while position != -1:
+            annotation = self.read_annotation(position, end)
+            if annotation != None:
+                return annotation
+
+            position = self.mapping.rfind(b";" + name + b":", start, position)
+
+        return None
+
+    def read_annotation(self, position: int, end: int) -> tuple[int, int, bytes]:
+        # Returns the annotation line found at position, None if the match is not an annotation of its own
+        mapping = self.mapping
+        line_start = mapping.rfind(b"\n", 0, position) + 1
+        line_end = mapping.find(b"\n", position, end)
+        line_end = end if line_end == -1 else line_end + 1
+        line = mapping[position:line_end]
+
+        if mapping[line_start:position].strip() == b"" and line.count(b":") == 1:
+            return line_start, line_end, line.split(b":")[1].strip()
+        return None
+
+    def parse_layer(self, start: int, end: int) -> Layer:
+        parser = _GCodeParser()
+        parser.layer_count = self.layer_count
+        parser.parse_source(self.read(start, end))
+
+        # The layer ends with TIME_ELAPSED, add the last feature if that is missing
+        layer = parser.current_layer
+        if layer.parent.layer_count() == 0:
+            layer.add_feature(parser.current_feature)
+
+        return layer
+
+    def find_layer_ranges(self) -> list[tuple[int, int]]:
+        # Returns the byte range of every layer, or None if the file doesn't follow the usual layout
+        size = len(self.mapping)
+
+        layer_starts = []
+        layer = self.find_annotation(b"LAYER", 0, size)
+        while layer != None:
+            layer_starts.append(layer[0])
+            layer = self.find_annotation(b"LAYER", layer[1], size)
+
+        layer_count = self.find_annotation(b"LAYER_COUNT", 0, layer_starts[0] if layer_starts else size)
+        if layer_count == None or len(layer_starts) != int(layer_count[2]):
+            return None
+        self.layer_count = int(layer_count[2])
+
+        last_layer_end = self.find_annotation(b"TIME_ELAPSED", layer_starts[-1], size) if layer_starts else None
+        if last_layer_end == None or not self.is_plain_tail(last_layer_end[1]):
+            return None
+
+        return list(zip(layer_starts, layer_starts[1:] + [last_layer_end[1]]))
+
+    # Whether the part after the last layer, from start on, can be parsed without a layer
+    def is_plain_tail(self, start: int) -> bool:
+        return all(self.find_annotation(name, start, len(self.mapping)) == None for name in _MappedSource.LAYER_ANNOTATIONS)
+
+    def parse_outside_layers(self, layer_ranges: list[tuple[int, int]]) -> Model:
+        # Parses the pre-print and post-print parts into a model without layers
+        parser = _GCodeParser()
+        model = parser.parse_source(self.read(0, layer_ranges[0][0]))
+
+        post_print = parser.parse_source(self.read(layer_ranges[-1][1], len(self.mapping))).feature_pre_print
+        post_print.name = model.feature_post_print.name
+        post_print.parent = model
+        model.feature_post_print = post_print
+
+        return model
+
+    def open(file_name: str) -> tuple[_MappedSource, list[tuple[int, int]]]:
+        # Empty files can't be mapped
+        if os.path.getsize(file_name) == 0:
+            return None, None
+
+        source_file = _MappedSource(file_name)
+        layer_ranges = source_file.find_layer_ranges()
+        if layer_ranges == None:
+            source_file.close()
+            return None, None
+
+        return source_file, layer_ranges
+
+    def open_model(file_name: str) -> Model:
+        source_file, layer_ranges = _MappedSource.open(file_name)
+
+        # Files that don't follow the usual layout are parsed up front, so they end up exactly the same as with parse_gcode
+        if source_file == None:
+            with open(file_name, "r") as file:
+                return Model.parse_gcode(file)
+
+        model = source_file.parse_outside_layers(layer_ranges)
+        model.source_file = source_file
+
+        for layer_range in layer_ranges:
+            layer = Layer(model)
+            layer.source_range = layer_range
+            model.add_layer(layer)
+
+        return model
+
+    def open_model_progressive(file_name: str) -> Iterator[tuple[Model, list[Layer], float]]:
+        size = os.path.getsize(file_name)
+        source_file = _MappedSource(file_name) if size > 0 else None
+
+        # Only the first and the last layer are looked for up front, everything outside of them can be parsed right away
+        first_layer = source_file.find_annotation(b"LAYER", 0, size) if source_file != None else None
+        last_layer = source_file.find_last_annotation(b"LAYER", 0, size) if first_layer != None else None
+        layer_count = source_file.find_annotation(b"LAYER_COUNT", 0, first_layer[0]) if first_layer != None else None
+        last_layer_end = source_file.find_annotation(b"TIME_ELAPSED", last_layer[0], size) if layer_count != None else None
+
+        if last_layer_end == None or not source_file.is_plain_tail(last_layer_end[1]):
+            if source_file != None:
+                source_file.close()
+            yield from _MappedSource.parse_model_progressive(file_name)
+            return
+
+        source_file.layer_count = int(layer_count[2])
+        model = source_file.parse_outside_layers([(first_layer[0], last_layer_end[1])])
+        model.source_file = source_file
+        yield model, [], first_layer[0] / size
+
+        layers = []
+        found_count = 0
+        step_end = first_layer[0] + _MappedSource.SCAN_STEP
+        layer = first_layer
+        while layer != None:
+            next_layer = source_file.find_annotation(b"LAYER", layer[1], size) if layer is not last_layer else None
+
+            layers.append(Layer(model))
+            layers[-1].source_range = (layer[0], next_layer[0] if next_layer != None else last_layer_end[1])
+            found_count += 1
+
+            if next_layer == None or next_layer[0] >= step_end:
+                yield model, layers, (next_layer[0] if next_layer != None else size) / size
+                layers = []
+                step_end = layer[1] + _MappedSource.SCAN_STEP
+            layer = next_layer
+
+        # Files that don't follow the usual layout are parsed again up front, so they end up the same as with parse_gcode.
+        # The mapping is left open, layers of the model yielded before may still be read from it.
+        if found_count != source_file.layer_count:
+            yield from _MappedSource.parse_model_progressive(file_name)
+
+    def parse_model_progressive(file_name: str) -> Iterator[tuple[Model, list[Layer], float]]:
+        with open(file_name, "r") as file:
+            source = file.read()
+
+        parser = _GCodeParser()
+        for fraction in parser.parse_source_steps(source):
+            yield None, [], fraction
+        yield parser.parsed_model, [], 1.0
+
+    def parse_layer_batch(file_name: str, layer_ranges: list[tuple[int, int]], layer_count: int) -> list[tuple]:
+        # Runs in a worker process, only the compact layer payloads are sent back
+        source_file = _MappedSource(file_name)
+        source_file.layer_count = layer_count
+
+        payloads = [source_file.parse_layer(*layer_range).payload() for layer_range in layer_ranges]
+
+        source_file.close()
+        return payloads
+
+    def open_model_parallel(file_name: str, max_workers: int = None) -> Model:
+        source_file, layer_ranges = _MappedSource.open(file_name)
+
+        if source_file == None:
+            with open(file_name, "r") as file:
+                return Model.parse_gcode(file)
+
+        model = source_file.parse_outside_layers(layer_ranges)
+        source_file.close()
+
+        # Consecutive layers are grouped into a few batches per worker, so the batches stay balanced
+        # even when layer sizes differ, without paying the process round trip for every layer
+        max_workers = max_workers or os.cpu_count() or 1
+        batch_size = (layer_ranges[-1][1] - layer_ranges[0][0]) / (max_workers * 4)
+
+        batches = [[]]
+        batch_start = layer_ranges[0][0]
+        for layer_range in layer_ranges:
+            if layer_range[0] - batch_start >= batch_size:
+                batches.append([])
+                batch_start = layer_range[0]
+            batches[-1].append(layer_range)
+
+        # Imported here, it pulls in multiprocessing and logging which every other use of the model can do without
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers) as executor:
+            for payloads in executor.map(_MappedSource.parse_layer_batch, repeat(file_name), batches, repeat(source_file.layer_count)):
+                for payload in payloads:
+                    layer = Layer(model)
+                    layer.load_payload(payload)
+                    model.add_layer(layer)
+
+        return model
 
 
 class _GcodeExporter:
-    def export_model(output_file: TextIOWrapper, model: Model) -> None:
-        output_file.writelines(command.command + '\n' for command in model.feature_pre_print.get_commands())
-        for layer in model.get_layers():
-            for feature in layer.get_features():
-                output_file.writelines(command.command + '\n' for command in feature.get_commands())
-        output_file.writelines(command.command + '\n' for command in model.feature_post_print.get_commands())
+    # Features that were not modified since parsing are copied from their source span.
+    # Adjacent spans are merged, so untouched parts of the file are written in large blocks.
+    output_file: TextIOWrapper
+    source: str = None
+    start: int
+    end: int
+
+    def __init__(self, output_file: TextIOWrapper) -> None:
+        self.output_file = output_file
+
+    def flush(self) -> None:
+        if self.source == None:
+            return
+
+        self.output_file.write(self.source[self.start:self.end])
+        self.output_file.write("\n")
+        self.source = None
+
+    def write_text(self, text: str) -> None:
+        self.flush()
+        self.output_file.write(text)
+
+    def write_feature(self, feature: Feature) -> None:
+        span = feature.source_span
+        if span != None and feature.store.source is self.source and span[0] == self.end + 1:
+            self.end = span[1]
+            return
+
+        self.flush()
+        if span != None:
+            self.source = feature.store.source
+            self.start, self.end = span
+            return
+
+        # The model doesn't change while it is written
+        get_command = feature.store.keep_command
+        self.output_file.writelines(get_command(row) + '\n' for row in feature.rows)
+
+    def export_model(output_file: TextIOWrapper, model: Model, progress: Callable[[float], None] = None, process_layer: Callable[[Layer], None] = None) -> None:
+        exporter = _GcodeExporter(output_file)
+        layers = model.get_layers()
+        # The previous layer stays loaded while a layer is processed, the layer usually starts where it ended
+        unload_layers = []
+
+        exporter.write_feature(model.feature_pre_print)
+        for index, layer in enumerate(layers):
+            if process_layer != None:
+                if not layer.is_loaded():
+                    unload_layers.append(layer)
+                process_layer(layer)
+
+            # Layers that were never loaded can't be modified, their text is copied from the mapped file
+            source_range = layer.source_range
+            text = model.source_file.read_unstripped(*source_range) if source_range != None else None
+
+            if text != None:
+                exporter.write_text(text)
+            else:
+                for feature in layer.peek().get_features():
+                    exporter.write_feature(feature)
+
+            while len(unload_layers) > 0 and unload_layers[0] is not layer:
+                unload_layers.pop(0).unload()
+
+            if progress != None:
+                progress((index + 1) / len(layers))
+
+        for layer in unload_layers:
+            layer.unload()
+        exporter.write_feature(model.feature_post_print)
+
+        exporter.flush()
@@ -0,0 +1,365 @@
+from __future__ import annotations
+from collections.abc import Callable, Iterator
+from itertools import chain
+import re
+
+import numpy as np
+
+from GCodeModel import Model, Layer, Feature, CommandStore, _GCodeParser
+
+
+class SearchQuery:
+    # Terms separated by spaces, a command matches if it matches every term:
+    #
+    #     M106            command code, G, M or T and a number
+    #     E               commands with an E parameter, same for any other capital letter on its own
+    #     X10.5           parameter with exactly this value
+    #     Z>10 F<=1200    parameter compared with a value, one of <, <=, =, >= and >
+    #     outer           word in the comment of the command, case doesn't matter
+    #     ;TYPE:WALL      text in the comment of the command, case doesn't matter
+    #     /E-\d+/         regular expression searched for in the whole command, it takes the rest of the query
+    CODE_TERM = re.compile(r"[GMTgmt]\d+")
+    VALUE_TERM = re.compile(r"([A-Za-z])(<=|>=|<|>|=)?(-?\d*\.?\d+)")
+    LETTER_TERM = re.compile(r"[A-Z]")
+    WORD = re.compile(r"\w+")
+
+    codes: list[str]
+    letters: list[str]
+    comparisons: list[tuple[str, str, float]]
+    words: list[str]
+    phrases: list[str]
+    pattern: re.Pattern = None
+
+    # Raises re.error if the regular expression is invalid
+    def __init__(self, text: str) -> None:
+        self.codes = []
+        self.letters = []
+        self.comparisons = []
+        self.words = []
+        self.phrases = []
+
+        terms, slash, pattern = text.partition("/")
+        if slash:
+            pattern = pattern[:-1] if pattern.endswith("/") else pattern
+            if pattern != "":
+                self.pattern = re.compile(pattern, re.MULTILINE)
+
+        for term in terms.split():
+            if SearchQuery.CODE_TERM.fullmatch(term):
+                self.codes.append(term.upper())
+                continue
+            if SearchQuery.LETTER_TERM.fullmatch(term):
+                self.letters.append(term)
+                continue
+
+            match = SearchQuery.VALUE_TERM.fullmatch(term)
+            if match != None:
+                letter, operator, value = match.groups()
+                self.comparisons.append((letter.upper(), operator or "=", float(value)))
+                continue
+
+            # Comments are matched by their words through the index, text that is more than one word is checked as well
+            phrase = term.lower().removeprefix(";")
+            words = SearchQuery.WORD.findall(phrase)
+            self.words += words
+            if words != [phrase]:
+                self.phrases.append(phrase)
+
+    def is_empty(self) -> bool:
+        return not (self.codes or self.letters or self.comparisons or self.words or self.phrases or self.pattern)
+
+
+class LayerIndex:
+    # Inverted index of the commands of a layer (or of the pre-print or post-print feature). The commands of all
+    # features are numbered in order, these positions are what the index holds. Every list of positions is sorted.
+    revision: int
+    # Position of the first command of every feature
+    feature_starts: np.ndarray
+    # All commands, one per line. Line p starts at line_starts[p] and ends before line_starts[p + 1] - 1.
+    text: str
+    line_starts: np.ndarray
+    # Where the comment of every command starts in text, the end of its line if it has none
+    comment_starts: np.ndarray
+    # Positions by command code, by comment word in lower case, and by parameter letter along with the
+    # values, NaN where the value is not a number
+    codes: dict[str, np.ndarray]
+    words: dict[str, np.ndarray]
+    parameters: dict[str, tuple[np.ndarray, np.ndarray]]
+
+    OPERATORS = {"<": np.less, "<=": np.less_equal, "=": np.equal, ">=": np.greater_equal, ">": np.greater}
+    # Positions and offsets are 32 bit, the index is mostly made of them
+    NO_POSITIONS = np.empty(0, np.int32)
+    NO_PARAMETERS = (NO_POSITIONS, np.empty(0))
+
+    def __len__(self) -> int:
+        return len(self.line_starts) - 1
+
+    def get_line(self, position: int) -> str:
+        return self.text[self.line_starts[position]:self.line_starts[position + 1] - 1]
+
+    def get_comment(self, position: int) -> str:
+        return self.text[self.comment_starts[position] + 1:self.line_starts[position + 1] - 1]
+
+    # Feature and command index of every position
+    def get_commands(self, positions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        features = np.searchsorted(self.feature_starts, positions, "right") - 1
+        return features, positions - self.feature_starts[features]
+
+    def match(self, query: SearchQuery) -> np.ndarray:
+        # Narrows the positions down term by term, the regular expression and the phrases are only tried on what is left
+        candidates = None
+        terms = chain(
+            (self.codes.get(code, LayerIndex.NO_POSITIONS) for code in query.codes),
+            (self.words.get(word, LayerIndex.NO_POSITIONS) for word in query.words),
+            (self.parameters.get(letter, LayerIndex.NO_PARAMETERS)[0] for letter in query.letters),
+            (self.compare(*comparison) for comparison in query.comparisons))
+
+        for positions in terms:
+            candidates = positions if candidates is None else np.intersect1d(candidates, positions, assume_unique=True)
+            if len(candidates) == 0:
+                return candidates
+
+        if query.phrases:
+            if candidates is None:
+                candidates = np.arange(len(self))
+            candidates = np.array([position for position in candidates.tolist()
+                                   if all(phrase in self.get_comment(position).lower() for phrase in query.phrases)], np.int32)
+
+        if query.pattern != None:
+            candidates = self.search_pattern(query.pattern, candidates)
+
+        return LayerIndex.NO_POSITIONS if candidates is None else candidates
+
+    def compare(self, letter: str, operator: str, value: float) -> np.ndarray:
+        positions, values = self.parameters.get(letter, LayerIndex.NO_PARAMETERS)
+        return positions[LayerIndex.OPERATORS[operator](values, value)]
+
+    def search_pattern(self, pattern: re.Pattern, candidates: np.ndarray) -> np.ndarray:
+        # A few candidates are searched line by line, otherwise the whole text is searched at once
+        if candidates is not None and len(candidates) < len(self) // 8:
+            line_starts = self.line_starts
+            return np.array([position for position in candidates.tolist()
+                             if pattern.search(self.text, line_starts[position], line_starts[position + 1] - 1)], np.int32)
+
+        starts = np.fromiter((match.start() for match in pattern.finditer(self.text)), np.int64)
+        positions = np.unique(np.searchsorted(self.line_starts, starts, "right") - 1)
+        if candidates is None:
+            return positions
+        return np.intersect1d(candidates, positions, assume_unique=True)
+
+
+class SearchMatches:
+    # Commands of a layer that matched a query, layer is None for the pre-print and post-print features
+    layer: int
+    parent: Layer | Feature
+    features: np.ndarray
+    commands: np.ndarray
+    texts: list[str]
+
+    def __init__(self, layer: int, parent: Layer | Feature, layer_index: LayerIndex, positions: np.ndarray) -> None:
+        self.layer = layer
+        self.parent = parent
+        self.features, self.commands = layer_index.get_commands(positions)
+        self.texts = [layer_index.get_line(position) for position in positions.tolist()]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+
+class SearchIndex:
+    # Finds commands by their code, parameters and comments. Every layer gets its own LayerIndex, which is only
+    # built again once the layer was edited, the same way PrintEstimator keeps its estimates.
+    #
+    # index_model builds the indexes of the layers that aren't loaded from a parsed copy, so it can run on another
+    # thread while the model is in use. Layers that are loaded, and anything index_model didn't get to yet, are
+    # indexed by search on the thread it runs on.
+    #
+    # Only parsing and tokenizing take time, a query looks up its terms per layer and combines the positions.
+    indexes: dict[int, tuple[Layer | Feature, LayerIndex]]
+
+    def __init__(self) -> None:
+        self.indexes = {}
+
+    # Goes from the top layer down, a search that runs meanwhile starts at the bottom and doesn't parse the same layers
+    def index_model(self, model: Model, progress: Callable[[float], None] = None, is_cancelled: Callable[[], bool] = None) -> None:
+        layer_count = model.layer_count()
+        for number, layer in enumerate(reversed(model.get_layers()[:])):
+            if is_cancelled != None and is_cancelled():
+                return
+
+            # The revision is read first, an index of a layer that gets edited in the meantime is outdated right away
+            revision = layer.revision
+            source_range = layer.source_range
+            if source_range != None and not self.has_index(layer, revision):
+                parsed_layer = layer.parse_source(source_range)
+                self.indexes[id(layer)] = (layer, SearchIndex.index_features(parsed_layer.store, parsed_layer.get_features(), revision))
+
+            if progress != None:
+                progress((number + 1) / layer_count)
+
+    def has_index(self, parent: Layer | Feature, revision: int) -> bool:
+        _, layer_index = self.indexes.get(id(parent), (None, None))
+        return layer_index != None and layer_index.revision == revision
+
+    def get_index(self, parent: Layer | Feature, revision: int) -> LayerIndex:
+        if not self.has_index(parent, revision):
+            if isinstance(parent, Feature):
+                store, features = parent.store, [parent]
+            else:
+                parsed_layer = parent.peek()
+                store, features = parsed_layer.store, parsed_layer.get_features()
+            self.indexes[id(parent)] = (parent, SearchIndex.index_features(store, features, revision))
+        return self.indexes[id(parent)][1]
+
+    def search(self, model: Model, query: SearchQuery) -> Iterator[SearchMatches]:
+        # Matches of every layer from Pre-Print up to Post-Print, also the empty ones so the caller can stop in between
+        parents = [(None, model.feature_pre_print, model.revision),
+                   *((number, layer, layer.revision) for number, layer in enumerate(model.get_layers())),
+                   (None, model.feature_post_print, model.revision)]
+
+        # Indexes of layers that were removed are dropped, index_model might be adding some meanwhile
+        keys = {id(parent) for _, parent, _ in parents}
+        for key in [key for key in list(self.indexes) if key not in keys]:
+            self.indexes.pop(key, None)
+
+        if query.is_empty():
+            return
+
+        for number, parent, revision in parents:
+            layer_index = self.get_index(parent, revision)
+            yield SearchMatches(number, parent, layer_index, layer_index.match(query))
+
+    def index_features(store: CommandStore, features: list[Feature], revision: int) -> LayerIndex:
+        layer_index = LayerIndex()
+        layer_index.revision = revision
+
+        sizes = np.fromiter(map(len, (feature.rows for feature in features)), np.int64, len(features))
+        layer_index.feature_starts = np.cumsum(sizes) - sizes
+
+        # Features that are still as they were parsed are taken from the source in one piece
+        texts, feature_lengths = [], []
+        command_starts, command_ends = np.frombuffer(store.starts, np.int64), np.frombuffer(store.ends, np.int64)
+        for feature in features:
+            if len(feature.rows) == 0:
+                continue
+            if feature.source_span != None:
+                rows = np.frombuffer(feature.rows, np.int64)
+                texts.append(store.source[feature.source_span[0]:feature.source_span[1]])
+                feature_lengths.append(command_ends[rows] - command_starts[rows])
+            else:
+                commands = list(map(store.get_command, feature.rows))
+                texts.append("\n".join(commands))
+                feature_lengths.append(np.fromiter(map(len, commands), np.int64, len(commands)))
+
+        text = layer_index.text = "\n".join(texts) + "\n"
+        lengths = np.concatenate(feature_lengths) if feature_lengths else LayerIndex.NO_POSITIONS
+        line_starts = layer_index.line_starts = np.concatenate(([0], np.cumsum(lengths + 1))).astype(np.int32)
+        starts, ends = line_starts[:-1], line_starts[:-1] + lengths
+
+        # Characters that aren't ASCII are replaced one for one, so offsets in the bytes are offsets in the text.
+        # Comments are split into words on the text itself, so their words keep them.
+        data = np.frombuffer(text.encode("ascii", "replace"), np.uint8)
+        size = len(data)
+
+        # The comment of a line starts at its first semicolon
+        semicolons = np.flatnonzero(data == ord(";"))
+        semicolon_lines = np.searchsorted(line_starts, semicolons, "right") - 1
+        first_semicolons = np.diff(semicolon_lines, prepend=-1) != 0
+        comment_starts = layer_index.comment_starts = ends.astype(np.int32)
+        comment_starts[semicolon_lines[first_semicolons]] = semicolons[first_semicolons]
+
+        # Words of the commands themselves, without the comments: the first one is the code, the others are parameters
+        is_space = np.zeros(256, bool)
+        is_space[[ord(char) for char in " \t\n\r\v\f"]] = True
+        spaces = np.concatenate((np.flatnonzero(is_space[data]), [size]))
+        after_space = np.concatenate(([True], is_space[data[:-1]])) & ~is_space[data]
+        word_starts = np.flatnonzero(after_space)
+        word_lines = (np.searchsorted(line_starts, word_starts, "right") - 1).astype(np.int32)
+        in_command = word_starts < comment_starts[word_lines]
+        word_starts, word_lines = word_starts[in_command], word_lines[in_command]
+        word_ends = np.minimum(spaces[np.searchsorted(spaces, word_starts)], comment_starts[word_lines])
+
+        is_code = np.diff(word_lines, prepend=-1) != 0
+        layer_index.codes = SearchIndex.index_codes(text, data, word_starts[is_code], word_ends[is_code], word_lines[is_code])
+        layer_index.parameters = SearchIndex.index_parameters(text, data, word_starts[~is_code], word_ends[~is_code], word_lines[~is_code])
+
+        comment_lines = np.flatnonzero(comment_starts < ends).astype(np.int32)
+        layer_index.words = SearchIndex.index_comments(text, comment_starts[comment_lines], ends[comment_lines], comment_lines)
+        return layer_index
+
+    # The groups of sorted keys with the positions that have them, positions stay sorted within a group
+    def group_positions(keys: np.ndarray, positions: np.ndarray) -> Iterator[tuple[object, np.ndarray]]:
+        if len(keys) == 0:
+            return
+        order = np.argsort(keys, kind="stable")
+        keys, positions = keys[order], positions[order]
+        bounds = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1], [True])))
+        for first, last in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            yield keys[first], positions[first:last]
+
+    def index_codes(text: str, data: np.ndarray, starts: np.ndarray, ends: np.ndarray, lines: np.ndarray) -> dict[str, np.ndarray]:
+        # Codes are upper cased and packed into a single integer to group them, longer ones are rare and read one by one
+        upper = np.arange(256, dtype=np.uint64)
+        upper[ord("a"):ord("z") + 1] -= 32
+        padded = np.concatenate((data, np.zeros(8, np.uint8)))
+        lengths = ends - starts
+
+        keys = np.zeros(len(starts), np.uint64)
+        for offset in range(8):
+            keys |= np.where(offset < lengths, upper[padded[starts + offset]], 0) << np.uint64(8 * offset)
+
+        codes = {}
+        packed = lengths <= 8
+        for key, positions in SearchIndex.group_positions(keys[packed], lines[packed]):
+            codes[int(key).to_bytes(8, "little").rstrip(b"\0").decode("ascii")] = positions
+
+        for start, end, line in zip(starts[~packed].tolist(), ends[~packed].tolist(), lines[~packed].tolist()):
+            code = text[start:end].upper()
+            codes[code] = np.union1d(codes.get(code, LayerIndex.NO_POSITIONS), [line])
+        return codes
+
+    def index_parameters(text: str, data: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                         lines: np.ndarray) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+        # Only the last value of a letter on a line counts, the same as for the X, Y, E and F columns
+        if len(starts) == 0:
+            return {}
+
+        letters = data[starts] & np.uint8(0xDF)
+        keys = letters.astype(np.int64) * (len(data) + 1) + lines
+        order = np.argsort(keys, kind="stable")
+        keys, starts, ends, lines, letters = keys[order], starts[order], ends[order], lines[order], letters[order]
+        last = np.diff(keys, append=-1) != 0
+        starts, ends, lines, letters = starts[last], ends[last], lines[last], letters[last]
+
+        # Values that aren't plain decimal numbers, like "+1" or "1e3", are read with float(), anything else is NaN
+        values = np.full(len(starts), np.nan)
+        has_value = ends > starts + 1
+        parsed = _GCodeParser.parse_decimals(data, starts[has_value] + 1, ends[has_value], np)
+        if parsed is None:
+            parsed = [SearchIndex.read_value(text[start + 1:end]) for start, end in zip(starts[has_value].tolist(), ends[has_value].tolist())]
+        values[has_value] = parsed
+
+        parameters = {}
+        for letter, positions in SearchIndex.group_positions(letters, np.arange(len(lines))):
+            if ord("A") <= letter <= ord("Z"):
+                parameters[chr(letter)] = (lines[positions], values[positions])
+        return parameters
+
+    def read_value(value: str) -> float:
+        try:
+            return float(value)
+        except ValueError:
+            return np.nan
+
+    def index_comments(text: str, starts: np.ndarray, ends: np.ndarray, lines: np.ndarray) -> dict[str, np.ndarray]:
+        # Most comments repeat, every different one is only split into words once
+        comments = {}
+        for start, end, line in zip(starts.tolist(), ends.tolist(), lines.tolist()):
+            comments.setdefault(text[start + 1:end].lower(), []).append(line)
+
+        words = {}
+        for comment, comment_lines in comments.items():
+            for word in set(SearchQuery.WORD.findall(comment)):
+                words.setdefault(word, []).append(comment_lines)
+        return {word: np.sort(np.concatenate(word_lines)) if len(word_lines) > 1 else np.array(word_lines[0], np.int32)
+                for word, word_lines in words.items()}
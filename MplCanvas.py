@@ -1,4 +1,5 @@
-from GCodeModel import Model, Command
+from __future__ import annotations
+from GCodeModel import Model, Layer, Command, FLAG_MOVE, KIND_G1
 
 import numpy as np
 
@@ -8,9 +9,18 @@ from matplotlib.backend_bases import MouseButton
 matplotlib.use('Qt5Agg')
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.figure import Figure
 from matplotlib.collections import LineCollection
+from matplotlib.patches import Rectangle
+from matplotlib.image import AxesImage
+from matplotlib.layout_engine import LayoutEngine
+from matplotlib.colors import to_rgba_array
 
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
+
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
 from functools import partial
 
 RENDER_BG_COLOR: str = '0.208'
@@ -41,6 +51,9 @@ class _Viewport:
     def get_height(self) -> float:
         return self._center_y + (self._height / 2.0)
 
+    def get_size(self) -> tuple[float, float]:
+        return self._width, self._height
+
     def set_canvas_size(self, width: float, height: float) -> None:
         self._canvas_width = width
         self._canvas_height = height
@@ -86,6 +99,424 @@ class _Viewport:
             self._center_y = self._canvas_height - (self._height / 2.0)
 
 
+class _SegmentIndex:
+    # Uniform grid over the segment bounding boxes, stored as one array of segment indexes sorted by cell.
+    # Segments that would cover too many cells (long travel moves) are kept apart and always checked.
+    TARGET_SEGMENTS_PER_CELL: int = 4
+    MAX_CELLS_PER_SEGMENT: int = 16
+
+    segments: np.ndarray
+    origin: np.ndarray
+    cell_size: float
+    columns: int
+    rows: int
+
+    cell_starts: np.ndarray
+    cell_segments: np.ndarray
+    large_segments: np.ndarray
+
+    def __init__(self, segments: np.ndarray) -> None:
+        self.segments = segments
+
+        if len(segments) == 0:
+            self.origin, self.cell_size, self.columns, self.rows = np.zeros(2), 1.0, 1, 1
+            self.cell_starts = np.zeros(2, np.int64)
+            self.cell_segments = self.large_segments = np.empty(0, np.int64)
+            return
+
+        low = segments.min(axis=1)
+        high = segments.max(axis=1)
+        self.origin = low.min(axis=0)
+        size = np.maximum(high.max(axis=0) - self.origin, 1e-6)
+
+        cell_count = max(len(segments) // self.TARGET_SEGMENTS_PER_CELL, 1)
+        self.cell_size = max(float(np.sqrt(size[0] * size[1] / cell_count)), float(size.max()) / 4096, 1e-6)
+        self.columns, self.rows = (size // self.cell_size).astype(np.int64) + 1
+
+        first_cells = self.get_cells(low)
+        last_cells = self.get_cells(high)
+        spans = last_cells - first_cells + 1
+        cell_counts = spans[:, 0] * spans[:, 1]
+
+        large = cell_counts > self.MAX_CELLS_PER_SEGMENT
+        self.large_segments = np.flatnonzero(large)
+        indexed = np.flatnonzero(~large)
+
+        # Every indexed segment is listed once in each cell its bounding box touches
+        counts = cell_counts[indexed]
+        entries = np.repeat(indexed, counts)
+        offsets = np.arange(len(entries)) - np.repeat(np.cumsum(counts) - counts, counts)
+        widths = spans[entries, 0]
+        columns = first_cells[entries, 0] + offsets % widths
+        rows = first_cells[entries, 1] + offsets // widths
+        cells = rows * self.columns + columns
+
+        order = np.argsort(cells, kind="stable")
+        self.cell_segments = entries[order]
+        self.cell_starts = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=self.columns * self.rows))))
+
+    def get_cells(self, points: np.ndarray) -> np.ndarray:
+        cells = ((points - self.origin) // self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, (self.columns - 1, self.rows - 1))
+
+    def get_candidates(self, x0: float, x1: float, y0: float, y1: float) -> np.ndarray:
+        # Segments whose cells touch the rectangle, some of them may still be outside of it
+        (first_column, first_row), (last_column, last_row) = self.get_cells(np.array([[x0, y0], [x1, y1]]))
+        columns = np.arange(first_column, last_column + 1)
+        cells = (np.arange(first_row, last_row + 1)[:, None] * self.columns + columns).ravel()
+
+        starts, ends = self.cell_starts[cells], self.cell_starts[cells + 1]
+        counts = ends - starts
+        positions = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return np.unique(np.concatenate((self.cell_segments[positions], self.large_segments)))
+
+    def find_nearest(self, x: float, y: float, radius: float) -> int:
+        # Index of the segment closest to the point, None if none is within radius
+        candidates = self.get_candidates(x - radius, x + radius, y - radius, y + radius)
+        if len(candidates) == 0:
+            return None
+
+        start = self.segments[candidates, 0]
+        direction = self.segments[candidates, 1] - start
+        offset = np.array([x, y]) - start
+        length = np.einsum("ij,ij->i", direction, direction)
+        along = np.clip(np.einsum("ij,ij->i", offset, direction) / np.where(length > 0, length, 1), 0, 1)
+        distance = offset - direction * along[:, None]
+        distance = np.einsum("ij,ij->i", distance, distance)
+
+        # The segment drawn last is on top, it wins ties
+        nearest = len(distance) - 1 - np.argmin(distance[::-1])
+        if distance[nearest] > radius * radius:
+            return None
+        return int(candidates[nearest])
+
+    def find_ending_in(self, x0: float, x1: float, y0: float, y1: float) -> np.ndarray:
+        # Indexes of the segments that end inside the rectangle
+        candidates = self.get_candidates(x0, x1, y0, y1)
+        x, y = self.segments[candidates, 1, 0], self.segments[candidates, 1, 1]
+        return candidates[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+
+class _LayerGeometry:
+    # Move positions and colors of one layer, rebuilt only when the layer's revision changes
+    BASE_COLORS: np.ndarray = to_rgba_array([Command.COLORS.get(kind, ("white", "white"))[0] for kind in range(256)])
+    SELECTED_COLORS: np.ndarray = to_rgba_array([Command.COLORS.get(kind, ("white", "white"))[1] for kind in range(256)])
+
+    revision: int
+    # Store rows of the move commands in drawing order, used to find the selected segments
+    rows: np.ndarray
+    points: np.ndarray
+    kinds: np.ndarray
+
+    # Feature index and command index within the feature of every move command
+    features: np.ndarray
+    commands: np.ndarray
+
+    # Rows sorted, and the position of each sorted row in drawing order, to look up selected rows quickly
+    sorted_rows: np.ndarray
+    row_order: np.ndarray
+
+    start: tuple[float, float] = None
+    segments: np.ndarray = None
+    colors: np.ndarray = None
+
+    # Simplified versions of the segments for zoomed out views. Each tier allows twice the deviation of the
+    # previous one and is built from it, the first tier is the full detail. Tiers are kept as the tolerance,
+    # the segments and their colors and kinds.
+    LOD_BASE_TOLERANCE: float = 0.01
+    LOD_TIER_COUNT: int = 10
+    LOD_PASSES: int = 3
+    tiers: list[tuple[float, np.ndarray, np.ndarray, np.ndarray]] = None
+
+    index: _SegmentIndex = None
+
+    def __init__(self, layer: Layer) -> None:
+        self.revision = layer.revision
+        store = layer.store
+
+        rows = [np.frombuffer(feature.rows, np.int64) for feature in layer.get_features()]
+        counts = np.array([len(feature_rows) for feature_rows in rows], np.int64)
+        rows = np.concatenate(rows) if rows else np.empty(0, np.int64)
+
+        features = np.repeat(np.arange(len(counts)), counts)
+        commands = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        # The store arrays are only indexed, so no view of them outlives this call and they can still grow
+        moves = np.frombuffer(store.flags, np.uint8)[rows] & FLAG_MOVE != 0
+        self.rows = rows[moves]
+        self.features = features[moves]
+        self.commands = commands[moves]
+        self.points = np.column_stack((np.frombuffer(store.x)[self.rows], np.frombuffer(store.y)[self.rows]))
+        self.kinds = np.frombuffer(store.kinds, np.uint8)[self.rows]
+
+        self.row_order = np.argsort(self.rows, kind="stable")
+        self.sorted_rows = self.rows[self.row_order]
+
+    def get_last_point(self) -> tuple[float, float]:
+        if len(self.points) == 0:
+            return None
+        return tuple(self.points[-1])
+
+    def get_segments(self, start: tuple[float, float]) -> np.ndarray:
+        # Every segment ends at a move command, the first one starts where the previous layer ended
+        if self.segments is None or self.start != start:
+            points = self.points if start == None else np.concatenate(([start], self.points))
+            self.segments = np.stack((points[:-1], points[1:]), axis=1)
+            self.colors = self.BASE_COLORS[self.kinds if start != None else self.kinds[1:]]
+            self.start = start
+            self.tiers = None
+            self.index = None
+        return self.segments
+
+    def simplify(path: np.ndarray, end_kinds: np.ndarray, keep: np.ndarray, tolerance: float) -> np.ndarray:
+        # Drops points of the path (given as indexes into it) that are closer than tolerance to the segment between
+        # their neighbours, which covers both collinear and very short segments. The merged segments must have the
+        # same kind, so color boundaries stay where they are. Only every other point of a run of removable points is
+        # dropped in one pass, so every point is checked against neighbours that are still there.
+        points = path[keep]
+        previous, current, following = points[:-2], points[1:-1], points[2:]
+        same_kind = end_kinds[keep[1:-1]] == end_kinds[keep[2:]]
+
+        chord = following - previous
+        chord_length = np.einsum("ij,ij->i", chord, chord)
+        offset = current - previous
+        along = np.clip(np.einsum("ij,ij->i", offset, chord) / np.where(chord_length > 0, chord_length, 1), 0, 1)
+        deviation = offset - chord * along[:, None]
+        removable = same_kind & (np.einsum("ij,ij->i", deviation, deviation) < tolerance * tolerance)
+
+        positions = np.arange(len(removable))
+        run_positions = positions - np.maximum.accumulate(np.where(removable, -1, positions))
+        removed = removable & (run_positions % 2 == 1)
+
+        return keep[np.concatenate(([True], ~removed, [True]))]
+
+    def get_tiers(self) -> list[tuple[float, np.ndarray, np.ndarray, np.ndarray]]:
+        if self.tiers != None:
+            return self.tiers
+
+        path = self.points if self.start == None else np.concatenate(([self.start], self.points))
+        # Kind of the segment that ends at each point of the path, the first point has none
+        end_kinds = self.kinds.astype(np.int16) if self.start == None else np.concatenate(([0], self.kinds)).astype(np.int16)
+        end_kinds[0] = -1
+
+        self.tiers = [(0.0, self.segments, self.colors, end_kinds[1:])]
+        keep = np.arange(len(path))
+        tolerance = self.LOD_BASE_TOLERANCE
+        for _ in range(self.LOD_TIER_COUNT):
+            # Every pass may move the path by its tolerance, together they stay within the tier's tolerance
+            for _ in range(self.LOD_PASSES):
+                if len(keep) > 2:
+                    keep = _LayerGeometry.simplify(path, end_kinds, keep, tolerance / self.LOD_PASSES)
+
+            segments = np.stack((path[keep[:-1]], path[keep[1:]]), axis=1)
+            self.tiers.append((tolerance, segments, self.BASE_COLORS[end_kinds[keep[1:]]], end_kinds[keep[1:]]))
+            tolerance *= 2
+
+        return self.tiers
+
+    def get_visible(self, x0: float, x1: float, y0: float, y1: float, tolerance: float) -> tuple[np.ndarray, np.ndarray]:
+        # Segments and colors of the most simplified tier within tolerance, without the segments outside the view
+        _, segments, colors, _ = [tier for tier in self.get_tiers() if tier[0] <= tolerance][-1]
+
+        x, y = segments[:, :, 0], segments[:, :, 1]
+        visible = (x.max(axis=1) >= x0) & (x.min(axis=1) <= x1) & (y.max(axis=1) >= y0) & (y.min(axis=1) <= y1)
+        return segments[visible], colors[visible]
+
+    def get_selected_moves(self, selected_rows: np.ndarray) -> np.ndarray:
+        # Indexes (in drawing order) of the move commands whose row is in selected_rows
+        positions = np.searchsorted(self.sorted_rows, selected_rows)
+        found = positions < len(self.sorted_rows)
+        positions = positions[found]
+        positions = positions[self.sorted_rows[positions] == selected_rows[found]]
+        return np.sort(self.row_order[positions])
+
+    def get_index(self) -> _SegmentIndex:
+        if self.index == None:
+            self.index = _SegmentIndex(self.segments)
+        return self.index
+
+    def get_moves(self, segments: np.ndarray) -> np.ndarray:
+        # Move commands that end the given segments of the last get_segments call
+        return segments if self.start != None else segments + 1
+
+    def get_selection(self, selected_rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Segments and colors of the selected move commands, matching the segments of the last get_segments call
+        moves = self.get_selected_moves(selected_rows)
+        if self.start == None:
+            # Without a start point the first move has no segment
+            moves = moves[moves > 0]
+            return self.segments[moves - 1], self.SELECTED_COLORS[self.kinds[moves]]
+        return self.segments[moves], self.SELECTED_COLORS[self.kinds[moves]]
+
+
+class _LayerPreview:
+    # Printed lines of one layer for the stacked preview, at every level of detail of the layer's geometry.
+    # Travel moves are left out and the points are kept in single precision, so a whole print fits in memory.
+    revision: int
+    tiers: list[tuple[float, np.ndarray]]
+    # Bounding box of the lines, None if the layer prints nothing
+    bounds: tuple[float, float, float, float] = None
+
+    def __init__(self, layer: Layer, geometry: _LayerGeometry = None) -> None:
+        # The geometry of the plan view is reused if the layer has one. Otherwise a layer that isn't loaded is
+        # parsed into a copy, previewing it doesn't keep it in memory.
+        self.revision = layer.revision
+        if geometry == None:
+            geometry = _LayerGeometry(layer.peek())
+            if len(geometry.points) < 2:
+                self.tiers = [(0.0, np.empty((0, 2, 2), np.float32))]
+                return
+            geometry.get_segments(None)
+        self.tiers = [(tolerance, segments[kinds == KIND_G1].astype(np.float32)) for tolerance, segments, _, kinds in geometry.get_tiers()]
+
+        points = self.tiers[0][1].reshape(-1, 2)
+        if len(points) > 0:
+            (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+            self.bounds = (float(x0), float(x1), float(y0), float(y1))
+
+    def get_segments(self, tolerance: float) -> np.ndarray:
+        return [segments for tier_tolerance, segments in self.tiers if tier_tolerance <= tolerance][-1]
+
+
+class _LayerRaster:
+    # Bitmap of the layer lines around the viewport, shown instead of the lines while panning or zooming
+    image: np.ndarray
+    extent: tuple[float, float, float, float]
+    pixels_per_unit: float
+
+    def __init__(self, image: np.ndarray, extent: tuple[float, float, float, float], pixels_per_unit: float) -> None:
+        self.image = image
+        self.extent = extent
+        self.pixels_per_unit = pixels_per_unit
+
+    def draw_lines(segments: np.ndarray, colors: np.ndarray, extent: tuple[float, float, float, float], pixels_per_unit: float, line_dpi: float) -> _LayerRaster:
+        # The dpi keeps the line width in points the same thickness relative to the lines as on screen
+        x0, x1, y0, y1 = extent
+        figure = Figure(figsize=((x1 - x0) * pixels_per_unit / line_dpi, (y1 - y0) * pixels_per_unit / line_dpi), dpi=line_dpi, facecolor=RENDER_BG_COLOR)
+        canvas = FigureCanvasAgg(figure)
+
+        axes = figure.add_axes([0, 0, 1, 1])
+        axes.set_axis_off()
+        axes.set_xlim([x0, x1])
+        axes.set_ylim([y0, y1])
+        axes.add_collection(LineCollection(segments, colors=colors))
+
+        canvas.draw()
+        return _LayerRaster(np.asarray(canvas.buffer_rgba()).copy(), extent, pixels_per_unit)
+
+    def draw_geometry(geometry: _LayerGeometry, extent: tuple[float, float, float, float], pixels_per_unit: float, line_dpi: float) -> _LayerRaster:
+        segments, colors = geometry.get_visible(*extent, MplCanvas.LOD_PIXEL_TOLERANCE / pixels_per_unit)
+        return _LayerRaster.draw_lines(segments, colors, extent, pixels_per_unit, line_dpi)
+
+    def splat_lines(lines: Iterable[tuple[np.ndarray, np.ndarray]], extent: tuple[float, float, float, float], pixels_per_unit: float) -> _LayerRaster:
+        # Draws batches of one pixel wide lines of one color each with NumPy alone, by setting a pixel for every pixel
+        # of length along each segment. It is far quicker than matplotlib for millions of segments and only one batch
+        # is sampled at a time. Later segments are drawn over earlier ones.
+        x0, x1, y0, y1 = extent
+        width, height = max(int(round((x1 - x0) * pixels_per_unit)), 1), max(int(round((y1 - y0) * pixels_per_unit)), 1)
+        image = np.full(height * width, _LayerRaster.pack_colors(to_rgba_array(RENDER_BG_COLOR))[0])
+
+        for segments, color in lines:
+            starts = ((segments[:, 0] - (x0, y0)) * pixels_per_unit).astype(np.float32)
+            deltas = ((segments[:, 1] - segments[:, 0]) * pixels_per_unit).astype(np.float32)
+            counts = np.ceil(np.abs(deltas).max(axis=1, initial=0)).astype(np.int64) + 1
+            steps_sizes = deltas / np.maximum(counts - 1, 1)[:, None]
+            segment_indexes = np.repeat(np.arange(len(segments)), counts)
+            steps = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)).astype(np.float32)
+            points = (starts[segment_indexes] + steps_sizes[segment_indexes] * steps[:, None]).astype(np.int64)
+
+            columns, rows = points[:, 0], height - 1 - points[:, 1]
+            inside = (columns >= 0) & (columns < width) & (rows >= 0) & (rows < height)
+            image[rows[inside] * width + columns[inside]] = _LayerRaster.pack_colors(color[None])[0]
+
+        return _LayerRaster(image.view(np.uint8).reshape(height, width, 4), extent, pixels_per_unit)
+
+    def pack_colors(colors: np.ndarray) -> np.ndarray:
+        # RGBA colors as one 32 bit value each, in the byte order of an RGBA image
+        return np.ascontiguousarray(np.round(colors * 255), np.uint8).view(np.uint32)[:, 0]
+
+    def crop(self, x0: float, x1: float, y0: float, y1: float) -> tuple[np.ndarray, tuple[float, float, float, float]]:
+        # Part of the bitmap that shows the view, so only the visible pixels are resampled on every frame
+        raster_x0, _, _, raster_y1 = self.extent
+        height, width = self.image.shape[:2]
+
+        first_column = min(max(int((x0 - raster_x0) * self.pixels_per_unit), 0), width - 1)
+        last_column = min(max(int(np.ceil((x1 - raster_x0) * self.pixels_per_unit)), first_column + 1), width)
+        first_row = min(max(int((raster_y1 - y1) * self.pixels_per_unit), 0), height - 1)
+        last_row = min(max(int(np.ceil((raster_y1 - y0) * self.pixels_per_unit)), first_row + 1), height)
+
+        extent = (raster_x0 + first_column / self.pixels_per_unit, raster_x0 + last_column / self.pixels_per_unit,
+                  raster_y1 - last_row / self.pixels_per_unit, raster_y1 - first_row / self.pixels_per_unit)
+        return self.image[first_row:last_row, first_column:last_column], extent
+
+    def covers(self, x0: float, x1: float, y0: float, y1: float, pixels_per_unit: float, detail_threshold: float) -> bool:
+        # Whether the view lies inside the bitmap and the bitmap is still detailed enough for it
+        raster_x0, raster_x1, raster_y0, raster_y1 = self.extent
+        if x0 < raster_x0 or x1 > raster_x1 or y0 < raster_y0 or y1 > raster_y1:
+            return False
+        return self.pixels_per_unit >= pixels_per_unit * detail_threshold
+
+
+class _LayerPrefetch:
+    # What is built ahead of time for one layer: its geometry, the parsed copy of a layer that wasn't loaded, and a
+    # bitmap of the layer for the view at the time of the request
+    layer: Layer
+    revision: int
+    # Set for a layer that isn't loaded, it is parsed from this range on the prefetch thread
+    source_range: tuple[int, int] = None
+    parsed_layer: Layer = None
+    geometry: _LayerGeometry = None
+    start: tuple[float, float] = None
+    raster: _LayerRaster = None
+
+    def __init__(self, layer: Layer) -> None:
+        self.layer = layer
+        self.revision = layer.revision
+
+
+class _PrefetchWorker(QThread):
+    # Builds the layers that are likely shown next while the main thread waits for input. The segments and tiers
+    # are only built on geometry that no other thread uses, loaded layers are read into it on the main thread.
+    layer_prefetched = pyqtSignal(object)
+
+    # Layers to build, nearest first, and the layers before them whose end is needed as their start
+    order: list[int]
+    prefetches: dict[int, _LayerPrefetch]
+    extent: tuple[float, float, float, float]
+    pixels_per_unit: float
+    line_dpi: float
+
+    def __init__(self, order: list[int], prefetches: dict[int, _LayerPrefetch], extent: tuple[float, float, float, float],
+                 pixels_per_unit: float, line_dpi: float) -> None:
+        super().__init__()
+        self.order = order
+        self.prefetches = prefetches
+        self.extent = extent
+        self.pixels_per_unit = pixels_per_unit
+        self.line_dpi = line_dpi
+
+    def get_geometry(self, index: int) -> _LayerGeometry:
+        prefetch = self.prefetches[index]
+        if prefetch.geometry == None:
+            prefetch.parsed_layer = prefetch.layer.parse_source(prefetch.source_range)
+            prefetch.geometry = _LayerGeometry(prefetch.parsed_layer)
+            prefetch.geometry.revision = prefetch.revision
+        return prefetch.geometry
+
+    def run(self) -> None:
+        # Every finished layer is handed over right away, a newer request only has to wait for the current one
+        for index in self.order:
+            if self.isInterruptionRequested():
+                return
+
+            prefetch = self.prefetches[index]
+            geometry = self.get_geometry(index)
+            prefetch.start = (0.0, 0.0) if index == 0 else self.get_geometry(index - 1).get_last_point()
+            geometry.get_segments(prefetch.start)
+            prefetch.raster = _LayerRaster.draw_geometry(geometry, self.extent, self.pixels_per_unit, self.line_dpi)
+            self.layer_prefetched.emit(prefetch)
+
+
 class MplCanvas(FigureCanvasQTAgg):
     axes: Axes
     canvas_size_x: int = 210
@@ -96,11 +527,89 @@ class MplCanvas(FigureCanvasQTAgg):
     pan_position_y: int
     viewport: _Viewport
 
+    # A left click that moves less than this many pixels selects the command under the cursor,
+    # dragging with shift held selects every command that ends inside the dragged rectangle
+    CLICK_DISTANCE: int = 3
+    PICK_RADIUS: int = 6
+    press_position: tuple[float, float] = None
+    is_selecting: bool = False
+    selection_rectangle: Rectangle
+
+    # Emitted with (feature index, command index) pairs of the open layer, and whether the selection is extended
+    commands_picked = pyqtSignal(list, bool)
+
+    # Geometry of the most recently rendered layers, the least recently used ones are dropped first
+    GEOMETRY_CACHE_SIZE: int = 256
+    geometry_cache: OrderedDict[Layer, _LayerGeometry]
+    geometry_model: Model = None
+
+    layer_lines: LineCollection
+    rendered_layer: Layer = None
+    rendered_revision: int = None
+    rendered_geometry: _LayerGeometry = None
+
+    # Selected segments are drawn over the layer by a separate collection, which is blitted onto a copy of the
+    # rendered layer instead of redrawing the whole figure
+    selection_lines: LineCollection
+    selected_rows: np.ndarray
+    background = None
+
+    # While panning or zooming the layer is drawn from a bitmap, rendered at a higher resolution than the screen
+    # and with a margin around the view. The lines are drawn again once the gesture ends, or the bitmap is
+    # rendered again when the view leaves it or is zoomed in too far for its resolution.
+    RASTER_SCALE: float = 2.0
+    RASTER_MARGIN: float = 0.5
+    RASTER_DETAIL_THRESHOLD: float = 0.75
+    RASTER_MAX_SIZE: int = 4096
+    ZOOM_SETTLE_TIME: int = 300
+
+    # The lines are simplified until they deviate from the actual path by this fraction of a pixel
+    LOD_PIXEL_TOLERANCE: float = 0.5
+
+    layer_raster: _LayerRaster = None
+    layer_image: AxesImage
+    layout_engine: LayoutEngine = None
+    is_interacting: bool = False
+    zoom_settle_timer: QTimer
+
+    # Stacked preview of the layers up to the rendered one, seen from the front left corner of the bed in an
+    # isometric projection and drawn from the bottom up. Each layer is raised by the layer height and the lower
+    # ones are drawn darker. The depth is the number of layers shown, 0 for all of them, None for the plan view.
+    PREVIEW_COS: float = float(np.cos(np.pi / 6))
+    PREVIEW_SIN: float = 0.5
+    PREVIEW_COLOR: np.ndarray = to_rgba_array(Command.COLORS[KIND_G1][0])[0]
+    PREVIEW_MIN_SHADE: float = 0.35
+    # Layers closer than this many pixels cover each other's lines, only every so many of them is drawn
+    PREVIEW_LAYER_PIXELS: float = 1.0
+    # The preview is always shown as a bitmap, drawn at the screen resolution
+    PREVIEW_RASTER_SCALE: float = 1.0
+    preview_depth: int = None
+    preview_cache: dict[Layer, _LayerPreview]
+    preview_layers: list[tuple[_LayerPreview, float]] = None
+    preview_layer_height: float = 0.2
+    plan_viewport: _Viewport = None
+
+    # The layers after the rendered one, or before it when stepping down, are parsed, built and drawn for the view
+    # on another thread. A layer with a bitmap is shown from it like during a zoom, its lines are drawn once the
+    # layers stop changing. The bitmaps take the most memory, the least recently used ones are dropped first.
+    PREFETCH_COUNT: int = 8
+    PREFETCH_RASTER_SCALE: float = 1.0
+    PREFETCH_MEMORY: int = 128 << 20
+    prefetch_worker: _PrefetchWorker = None
+    prefetch_pending: tuple[Model, int] = None
+    prefetch_direction: int = 1
+    prefetch_cache: OrderedDict[Layer, _LayerPrefetch]
+    prefetch_cache_bytes: int = 0
+    rendered_index: int = None
+
     def __init__(self, parent=None, width=5, height=4, dpi=100) -> None:
         fig = Figure(figsize=(width, height), dpi=dpi, tight_layout=True, facecolor=RENDER_BG_COLOR)
         self.axes = fig.add_subplot(111)
 
         self.viewport = _Viewport(self.canvas_size_x, self.canvas_size_y)
+        self.geometry_cache = OrderedDict()
+        self.preview_cache = {}
+        self.prefetch_cache = OrderedDict()
 
         super(MplCanvas, self).__init__(fig)
         on_press_partial = partial(self.on_press)
@@ -109,6 +618,7 @@ class MplCanvas(FigureCanvasQTAgg):
         self.mpl_connect('button_press_event', on_press_partial)
         self.mpl_connect('button_release_event', on_release_partial)
         self.mpl_connect('motion_notify_event', on_drag_partial)
+        self.mpl_connect('draw_event', self.on_draw)
 
         self.axes.set_facecolor(RENDER_BG_COLOR)
         self.axes.xaxis.label.set_color(RENDER_TEXT_COLOR)
@@ -124,88 +634,479 @@ class MplCanvas(FigureCanvasQTAgg):
         self.axes.set_xlim([0, self.canvas_size_x])
         self.axes.set_ylim([0, self.canvas_size_y])
 
+        # The same collection is reused for every layer, only its segments and colors change
+        self.layer_lines = LineCollection([])
+        self.axes.add_collection(self.layer_lines)
+
+        self.selection_lines = LineCollection([], animated=True)
+        self.axes.add_collection(self.selection_lines)
+        self.selected_rows = np.empty(0, np.int64)
+
+        self.selection_rectangle = Rectangle((0, 0), 0, 0, fill=False, edgecolor=RENDER_TEXT_COLOR, linestyle='--', animated=True, visible=False)
+        self.axes.add_patch(self.selection_rectangle)
+
+        self.layer_image = AxesImage(self.axes, interpolation='bilinear', visible=False)
+        self.axes.add_image(self.layer_image)
+
+        self.zoom_settle_timer = QTimer()
+        self.zoom_settle_timer.setSingleShot(True)
+        self.zoom_settle_timer.timeout.connect(self.end_interaction)
+
     def update_view(self) -> None:
         self.axes.set_xlim([self.viewport.get_x(), self.viewport.get_width()])
         self.axes.set_ylim([self.viewport.get_y(), self.viewport.get_height()])
+
+        if self.preview_depth != None:
+            self.update_layer_raster()
+        if not self.is_interacting and self.preview_depth == None:
+            self.update_layer_lines()
+        else:
+            image, extent = self.layer_raster.crop(self.viewport.get_x(), self.viewport.get_width(), self.viewport.get_y(), self.viewport.get_height())
+            self.layer_image.set_data(image)
+            self.layer_image.set_extent(extent)
+            self.layer_image.set_visible(True)
+
         self.draw()
 
+    def update_layer_lines(self) -> None:
+        # Only the segments in view are drawn, at a level of detail that matches the pixel size
+        if self.rendered_geometry == None:
+            return
+
+        pixel_size = self.viewport.get_size()[0] / self.axes.bbox.width
+        segments, colors = self.rendered_geometry.get_visible(self.viewport.get_x(), self.viewport.get_width(), self.viewport.get_y(),
+                                                              self.viewport.get_height(), pixel_size * self.LOD_PIXEL_TOLERANCE)
+        self.layer_lines.set_segments(segments)
+        self.layer_lines.set_colors(colors)
+
+    def get_preview_lines(self, x0: float, x1: float, y0: float, y1: float, pixel_size: float) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        # Projected segments and color of every layer of the preview that reaches the view, from the bottom up.
+        # Layers less than a pixel apart cover each other's lines, only every so many of them is drawn, always
+        # including the top one.
+        if not self.preview_layers:
+            return
+
+        stride = max(int(pixel_size * self.PREVIEW_LAYER_PIXELS / self.preview_layer_height), 1)
+        offset = MplCanvas.canvas_size_y * self.PREVIEW_COS
+        tolerance = pixel_size * self.LOD_PIXEL_TOLERANCE
+        bottom, top = self.preview_layers[0][1], self.preview_layers[-1][1]
+
+        for preview, z in self.preview_layers[::-stride][::-1]:
+            if preview.bounds == None:
+                continue
+            bounds_x0, bounds_x1, bounds_y0, bounds_y1 = preview.bounds
+            if ((bounds_x1 - bounds_y0) * self.PREVIEW_COS + offset < x0 or (bounds_x0 - bounds_y1) * self.PREVIEW_COS + offset > x1
+                    or (bounds_x1 + bounds_y1) * self.PREVIEW_SIN + z < y0 or (bounds_x0 + bounds_y0) * self.PREVIEW_SIN + z > y1):
+                continue
+
+            segments = preview.get_segments(tolerance)
+            x, y = segments[:, :, 0], segments[:, :, 1]
+            projected = np.stack(((x - y) * self.PREVIEW_COS + offset, (x + y) * self.PREVIEW_SIN + z), axis=2)
+
+            shade = self.PREVIEW_MIN_SHADE + (1.0 - self.PREVIEW_MIN_SHADE) * (z - bottom) / max(top - bottom, 1e-6)
+            yield projected, np.append(self.PREVIEW_COLOR[:3] * shade, 1.0)
+
+    def on_draw(self, event) -> None:
+        # Animated artists are skipped by a full draw, so this is the layer without the selection
+        self.background = self.copy_from_bbox(self.axes.bbox)
+        self.axes.draw_artist(self.selection_lines)
+        self.axes.draw_artist(self.selection_rectangle)
+
+    def blit_selection(self) -> None:
+        if self.background == None:
+            self.draw_idle()
+            return
+
+        self.restore_region(self.background)
+        self.axes.draw_artist(self.selection_lines)
+        self.axes.draw_artist(self.selection_rectangle)
+        self.blit(self.axes.bbox)
+
+    def blit_layer_raster(self) -> bool:
+        # Copies the part of the bitmap that shows the view straight into the canvas instead of drawing the figure,
+        # if it has the size of the axes on screen. The image shows the same if the figure is drawn after all.
+        image, extent = self.layer_raster.crop(self.viewport.get_x(), self.viewport.get_width(), self.viewport.get_y(), self.viewport.get_height())
+        self.layer_image.set_data(image)
+        self.layer_image.set_extent(extent)
+        self.layer_image.set_visible(True)
+
+        bbox = self.axes.bbox
+        left, bottom, width, height = int(round(bbox.x0)), int(round(bbox.y0)), int(round(bbox.width)), int(round(bbox.height))
+        if self.background == None or abs(image.shape[1] - width) > 1 or abs(image.shape[0] - height) > 1:
+            return False
+
+        buffer = np.asarray(self.buffer_rgba())
+        width, height = min(width, image.shape[1]), min(height, image.shape[0])
+        top = buffer.shape[0] - bottom - height
+        buffer[top:top + height, left:left + width] = image[:height, :width]
+        for spine in self.axes.spines.values():
+            self.axes.draw_artist(spine)
+
+        self.background = self.copy_from_bbox(bbox)
+        self.axes.draw_artist(self.selection_lines)
+        self.axes.draw_artist(self.selection_rectangle)
+        self.blit(bbox)
+        return True
+
+    def update_layer_raster(self) -> None:
+        # Renders the bitmap again if the current view is not covered by it
+        width, height = self.viewport.get_size()
+        x0, x1 = self.viewport.get_x(), self.viewport.get_width()
+        y0, y1 = self.viewport.get_y(), self.viewport.get_height()
+        screen_pixels_per_unit = self.axes.bbox.width / width
+
+        if self.layer_raster != None and self.layer_raster.covers(x0, x1, y0, y1, screen_pixels_per_unit, self.RASTER_DETAIL_THRESHOLD):
+            return
+
+        extent = (max(x0 - width * self.RASTER_MARGIN, 0.0), min(x1 + width * self.RASTER_MARGIN, self.canvas_size_x),
+                  max(y0 - height * self.RASTER_MARGIN, 0.0), min(y1 + height * self.RASTER_MARGIN, self.canvas_size_y))
+        pixels_per_unit = min(screen_pixels_per_unit * (self.RASTER_SCALE if self.preview_depth == None else self.PREVIEW_RASTER_SCALE),
+                              self.RASTER_MAX_SIZE / (extent[1] - extent[0]), self.RASTER_MAX_SIZE / (extent[3] - extent[2]))
+
+        if self.preview_depth != None:
+            self.layer_raster = _LayerRaster.splat_lines(self.get_preview_lines(*extent, 1.0 / pixels_per_unit), extent, pixels_per_unit)
+            return
+
+        segments, colors = np.empty((0, 2, 2)), np.empty((0, 4))
+        if self.rendered_geometry != None:
+            segments, colors = self.rendered_geometry.get_visible(*extent, self.LOD_PIXEL_TOLERANCE / pixels_per_unit)
+
+        self.layer_raster = _LayerRaster.draw_lines(segments, colors, extent,
+                                                    pixels_per_unit, self.figure.dpi * pixels_per_unit / screen_pixels_per_unit)
+
+    def begin_interaction(self) -> None:
+        self.update_layer_raster()
+        if self.is_interacting:
+            return
+
+        self.is_interacting = True
+        self.layer_lines.set_visible(False)
+        self.layer_image.set_visible(True)
+        # The layout only changes with the tick labels, it is fixed until the gesture ends
+        self.layout_engine = self.figure.get_layout_engine()
+        self.figure.set_layout_engine('none')
+
+    def end_interaction(self) -> None:
+        if not self.is_interacting:
+            return
+
+        self.zoom_settle_timer.stop()
+        self.is_interacting = False
+        self.layer_lines.set_visible(self.preview_depth == None)
+        self.layer_image.set_visible(self.preview_depth != None)
+        self.figure.set_layout_engine(self.layout_engine)
+        self.update_view()
+
     def set_zoom(self, zoom_delta: float) -> None:
         self.viewport.change_zoom(zoom_delta)
+
+        # Repeated zoom steps are drawn from the bitmap, the lines are drawn once the zooming stops
+        self.begin_interaction()
         self.update_view()
+        self.zoom_settle_timer.start(self.ZOOM_SETTLE_TIME)
     
     def on_press(self, event):
-        if not event.button == MouseButton.LEFT:
+        if not event.button == MouseButton.LEFT or event.xdata == None:
             return
 
-        self.is_panning = True
+        self.press_position = (event.x, event.y)
         self.pan_position_x = event.xdata
         self.pan_position_y = event.ydata
 
+        if event.key == 'shift':
+            self.is_selecting = True
+            self.selection_rectangle.set_bounds(event.xdata, event.ydata, 0, 0)
+            self.selection_rectangle.set_visible(True)
+
     def on_release(self, event):
-        if not event.button == MouseButton.LEFT:
+        if not event.button == MouseButton.LEFT or self.press_position == None:
             return
-        
-        self.is_panning = False
+
+        if self.is_selecting:
+            self.is_selecting = False
+            self.selection_rectangle.set_visible(False)
+            x, y = self.selection_rectangle.get_xy()
+            self.pick_rectangle(x, x + self.selection_rectangle.get_width(), y, y + self.selection_rectangle.get_height(), True)
+            self.blit_selection()
+        elif self.is_panning:
+            self.is_panning = False
+            self.end_interaction()
+        elif event.xdata != None:
+            self.pick_point(event.xdata, event.ydata, event.key == 'control')
+
+        self.press_position = None
     
     def on_drag(self, event):
-        if not event.button == MouseButton.LEFT:
-            return
-        
-        if not self.is_panning:
+        if not event.button == MouseButton.LEFT or self.press_position == None:
             return
         
         # If dragged outside the plot
         if event.xdata == None or event.ydata == None:
             return
 
+        if self.is_selecting:
+            self.selection_rectangle.set_bounds(self.pan_position_x, self.pan_position_y, event.xdata - self.pan_position_x, event.ydata - self.pan_position_y)
+            self.blit_selection()
+            return
+
+        # Small movements are still a click
+        if not self.is_panning:
+            if np.hypot(event.x - self.press_position[0], event.y - self.press_position[1]) < self.CLICK_DISTANCE:
+                return
+            self.is_panning = True
+            self.begin_interaction()
+
         delta_x = self.pan_position_x - event.xdata
         delta_y = self.pan_position_y - event.ydata
 
         self.viewport.move_center(delta_x, delta_y)
+        self.update_layer_raster()
         self.update_view()
 
-    
-    def render_layer(self, model: Model, index: int, selected_commands: dict[Command, int]) -> None:
-        x_coords = []
-        y_coords = []
-        colors = []
-
-        if index == 0:
-            x_coords.append(0.0)
-            y_coords.append(0.0)
-        else:
-            # Find the starting position of the print head from the previous layer
-            found =  False
-            for feature in reversed(model.get_layer(index - 1).get_features()):
-                if found: break
-
-                for command in reversed(feature.get_commands()):
-                    if command.is_move_command:
-                        x_coords.append(command.x)
-                        y_coords.append(command.y)
-                        found = True
-                        break
-
-        for feature in model.get_layer(index).get_features():
-            for command in feature.get_commands():
-                if command.is_move_command:
-                    x_coords.append(command.x)
-                    y_coords.append(command.y)
-                    if command in selected_commands:
-                        colors.append(command.selected_color)
-                    else:
-                        colors.append(command.color)
-
-        x_coords_array = np.array(x_coords)
-        y_coords_array = np.array(y_coords)
-        colors_array = np.array(colors)
-
-        points = np.array([x_coords_array, y_coords_array]).T.reshape(-1, 1, 2)
-        segments = np.concatenate([points[:-1], points[1:]], axis=1)
-
-        lc = LineCollection(segments, colors=colors_array)
-
-        self.axes.cla()
-        self.axes.set_aspect('equal')
-        self.axes.add_collection(lc)
+    def pick_point(self, x: float, y: float, extend: bool) -> None:
+        if self.rendered_geometry == None or self.preview_depth != None:
+            return
+
+        radius = self.PICK_RADIUS * self.viewport.get_size()[0] / self.axes.bbox.width
+        segment = self.rendered_geometry.get_index().find_nearest(x, y, radius)
+        segments = np.empty(0, np.int64) if segment == None else np.array([segment])
+        self.emit_picked(segments, extend)
+
+    def pick_rectangle(self, x0: float, x1: float, y0: float, y1: float, extend: bool) -> None:
+        if self.rendered_geometry == None or self.preview_depth != None:
+            return
+
+        segments = self.rendered_geometry.get_index().find_ending_in(min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1))
+        self.emit_picked(segments, extend)
+
+    def emit_picked(self, segments: np.ndarray, extend: bool) -> None:
+        moves = self.rendered_geometry.get_moves(segments)
+        geometry = self.rendered_geometry
+        self.commands_picked.emit(list(zip(geometry.features[moves].tolist(), geometry.commands[moves].tolist())), extend)
+
+    def set_geometry_model(self, model: Model) -> None:
+        # Cached geometry belongs to the layers of one model
+        if model is not self.geometry_model:
+            self.geometry_cache.clear()
+            self.preview_cache.clear()
+            self.prefetch_cache.clear()
+            self.prefetch_cache_bytes = 0
+            self.geometry_model = model
+
+    def get_geometry(self, model: Model, index: int) -> _LayerGeometry:
+        self.set_geometry_model(model)
+
+        layer = model.get_layer(index)
+        geometry = self.geometry_cache.get(layer)
+        if geometry == None or geometry.revision != layer.revision:
+            geometry = _LayerGeometry(layer)
+            self.geometry_cache[layer] = geometry
+
+        self.geometry_cache.move_to_end(layer)
+        if len(self.geometry_cache) > self.GEOMETRY_CACHE_SIZE:
+            self.geometry_cache.popitem(last=False)
+
+        return geometry
+
+    def update_selection_lines(self) -> None:
+        if self.rendered_geometry == None:
+            return
+
+        segments, colors = self.rendered_geometry.get_selection(self.selected_rows)
+        self.selection_lines.set_segments(segments)
+        self.selection_lines.set_colors(colors)
+
+    def set_selection(self, selected_rows: np.ndarray) -> None:
+        # selected_rows are store rows of the rendered layer, the layer itself is not redrawn
+        self.selected_rows = selected_rows
+        self.update_selection_lines()
+        self.blit_selection()
+
+    def set_preview(self, depth: int) -> None:
+        # Switches between the plan view of the rendered layer and the stacked preview, each keeps its own view.
+        # The layer has to be rendered again afterwards.
+        if (depth == None) != (self.preview_depth == None):
+            self.end_interaction()
+            if depth != None:
+                self.plan_viewport = self.viewport
+                self.viewport = _Viewport(self.canvas_size_x, self.canvas_size_y)
+                self.axes.set_axis_off()
+            else:
+                self.viewport = self.plan_viewport
+                self.canvas_size_x, self.canvas_size_y = MplCanvas.canvas_size_x, MplCanvas.canvas_size_y
+                self.axes.set_axis_on()
+
+            # The bitmap of the preview is shown once it has been drawn
+            self.layer_lines.set_visible(depth == None)
+            self.layer_image.set_visible(False)
+            self.layer_lines.set_segments([])
+            self.selection_lines.set_segments([])
+            self.rendered_layer = None
+            self.rendered_geometry = None
+            self.preview_layers = None
+            self.layer_raster = None
+
+        self.preview_depth = depth
+
+    def render_preview(self, model: Model, index: int) -> None:
+        self.set_geometry_model(model)
+
+        layers = model.get_layers()
+        self.preview_layer_height = model.layer_height or 0.2
+        first = 0 if self.preview_depth == 0 else max(index - self.preview_depth + 1, 0)
+
+        # The projection covers the bed and the height of the whole print, so the view stays where it is while
+        # moving through the layers
+        width = (MplCanvas.canvas_size_x + MplCanvas.canvas_size_y) * self.PREVIEW_COS
+        height = (MplCanvas.canvas_size_x + MplCanvas.canvas_size_y) * self.PREVIEW_SIN + len(layers) * self.preview_layer_height
+        if (width, height) != (self.canvas_size_x, self.canvas_size_y):
+            self.canvas_size_x, self.canvas_size_y = width, height
+            self.viewport.set_canvas_size(width, height)
+
+        self.preview_layers = []
+        for layer_index in range(first, index + 1):
+            layer = layers[layer_index]
+            preview = self.preview_cache.get(layer)
+            if preview == None or preview.revision != layer.revision:
+                geometry = self.geometry_cache.get(layer)
+                if geometry != None and (geometry.revision != layer.revision or geometry.segments is None):
+                    geometry = None
+                preview = _LayerPreview(layer, geometry)
+                self.preview_cache[layer] = preview
+            self.preview_layers.append((preview, (layer_index + 1) * self.preview_layer_height))
+
+        self.layer_raster = None
         self.update_view()
+
+    def render_layer(self, model: Model, index: int, selected_rows: np.ndarray) -> None:
+        if self.preview_depth != None:
+            self.render_preview(model, index)
+            return
+
+        # Find the starting position of the print head from the previous layer
+        start = (0.0, 0.0) if index == 0 else self.get_geometry(model, index - 1).get_last_point()
+
+        layer = model.get_layer(index)
+        geometry = self.get_geometry(model, index)
+
+        if self.rendered_index != None and index != self.rendered_index:
+            self.prefetch_direction = 1 if index > self.rendered_index else -1
+        self.rendered_index = index
+
+        # The layer itself is only updated when it changed
+        layer_changed = False
+        if layer is not self.rendered_layer or geometry.revision != self.rendered_revision or start != geometry.start:
+            geometry.get_segments(start)
+            self.rendered_layer = layer
+            self.rendered_revision = geometry.revision
+            self.rendered_geometry = geometry
+            layer_changed = True
+
+            # Stepping through the layers shows them from bitmaps like during a zoom, the lines are drawn once the
+            # layers stop changing. A layer that wasn't drawn ahead of time is drawn for the view alone.
+            self.layer_raster = self.get_prefetched_raster(layer, start)
+            if self.layer_raster == None and self.is_interacting:
+                self.layer_raster = _LayerRaster.draw_geometry(geometry, *self.get_prefetch_view())
+            if self.layer_raster != None and not self.is_panning:
+                self.begin_interaction()
+                self.zoom_settle_timer.start(self.ZOOM_SETTLE_TIME)
+
+        self.selected_rows = selected_rows
+        self.update_selection_lines()
+        if not (layer_changed and self.layer_raster != None and self.blit_layer_raster()):
+            self.update_view()
+        self.prefetch_layers(model, index)
+
+    def get_prefetch_view(self) -> tuple[tuple[float, float, float, float], float, float]:
+        # Extent, resolution and line dpi of the bitmaps drawn ahead of time, they cover the view and nothing more
+        width = self.viewport.get_size()[0]
+        screen_pixels_per_unit = self.axes.bbox.width / width
+        extent = (self.viewport.get_x(), self.viewport.get_width(), self.viewport.get_y(), self.viewport.get_height())
+        pixels_per_unit = min(screen_pixels_per_unit * self.PREFETCH_RASTER_SCALE,
+                              self.RASTER_MAX_SIZE / (extent[1] - extent[0]), self.RASTER_MAX_SIZE / (extent[3] - extent[2]))
+        return extent, pixels_per_unit, self.figure.dpi * pixels_per_unit / screen_pixels_per_unit
+
+    def get_prefetched_raster(self, layer: Layer, start: tuple[float, float]) -> _LayerRaster:
+        prefetch = self.prefetch_cache.get(layer)
+        if prefetch == None or prefetch.revision != layer.revision or (start != None and prefetch.start != start):
+            return None
+
+        screen_pixels_per_unit = self.axes.bbox.width / self.viewport.get_size()[0]
+        if not prefetch.raster.covers(self.viewport.get_x(), self.viewport.get_width(), self.viewport.get_y(), self.viewport.get_height(),
+                                      screen_pixels_per_unit, self.RASTER_DETAIL_THRESHOLD):
+            return None
+
+        self.prefetch_cache.move_to_end(layer)
+        return prefetch.raster
+
+    def prefetch_layers(self, model: Model, index: int) -> None:
+        if self.prefetch_worker != None:
+            # The running worker stops after its current layer, only the latest request is started after it
+            self.prefetch_worker.requestInterruption()
+            self.prefetch_pending = (model, index)
+            return
+
+        layers = model.get_layers()
+        last = index + self.prefetch_direction * self.PREFETCH_COUNT
+        order = [next_index for next_index in range(index + self.prefetch_direction, last + self.prefetch_direction, self.prefetch_direction)
+                 if 0 <= next_index < len(layers) and self.get_prefetched_raster(layers[next_index], None) == None]
+        if len(order) == 0:
+            return
+
+        prefetches = {}
+        for prefetch_index in sorted(set(order) | {next_index - 1 for next_index in order if next_index > 0}):
+            layer = layers[prefetch_index]
+            prefetch = _LayerPrefetch(layer)
+            geometry = self.geometry_cache.get(layer)
+            if prefetch_index not in order and geometry != None and geometry.revision == layer.revision:
+                # Only where the layer ends is read from it
+                prefetch.geometry = geometry
+            elif layer.is_loaded():
+                prefetch.geometry = _LayerGeometry(layer)
+            else:
+                prefetch.source_range = layer.source_range
+            prefetches[prefetch_index] = prefetch
+
+        self.prefetch_worker = _PrefetchWorker(order, prefetches, *self.get_prefetch_view())
+        self.prefetch_worker.layer_prefetched.connect(self.on_layer_prefetched)
+        self.prefetch_worker.finished.connect(self.on_prefetch_finished)
+        self.prefetch_worker.start(QThread.Priority.LowPriority)
+
+    def on_layer_prefetched(self, prefetch: _LayerPrefetch) -> None:
+        layer = prefetch.layer
+        if prefetch.revision != layer.revision or layer not in self.geometry_model.get_layers():
+            return
+
+        # A layer that was parsed ahead of time is loaded from the copy, the geometry refers to its rows. If the
+        # layer was loaded in the meantime only the bitmap is kept.
+        if prefetch.parsed_layer == None or not layer.is_loaded():
+            if prefetch.parsed_layer != None:
+                layer.load(prefetch.parsed_layer)
+
+            geometry = self.geometry_cache.get(layer)
+            if geometry == None or geometry.revision != layer.revision:
+                self.geometry_cache[layer] = prefetch.geometry
+                if len(self.geometry_cache) > self.GEOMETRY_CACHE_SIZE:
+                    self.geometry_cache.popitem(last=False)
+
+        if layer in self.prefetch_cache:
+            self.prefetch_cache_bytes -= self.prefetch_cache.pop(layer).raster.image.nbytes
+        self.prefetch_cache[layer] = prefetch
+        self.prefetch_cache_bytes += prefetch.raster.image.nbytes
+        while self.prefetch_cache_bytes > self.PREFETCH_MEMORY:
+            _, dropped = self.prefetch_cache.popitem(last=False)
+            self.prefetch_cache_bytes -= dropped.raster.image.nbytes
+
+    def on_prefetch_finished(self) -> None:
+        self.prefetch_worker = None
+        if self.prefetch_pending != None:
+            model, index = self.prefetch_pending
+            self.prefetch_pending = None
+            if model is self.geometry_model and self.preview_depth == None:
+                self.prefetch_layers(model, index)
+
+    def stop_prefetch(self) -> None:
+        self.prefetch_pending = None
+        if self.prefetch_worker != None:
+            self.prefetch_worker.requestInterruption()
+            self.prefetch_worker.wait()
@@ -0,0 +1,76 @@
+from __future__ import annotations
+import os
+import tempfile
+import unittest
+
+from GCodeModel import Model
+
+# Two layers, and a stray TIME_ELAPSED after the last one, which parse_gcode adds to that layer
+STRAY_TIME_ELAPSED = """;FLAVOR:Marlin
+;LAYER_COUNT:2
+;Layer height: 0.2
+M82
+G92 E0
+;LAYER:0
+;TYPE:WALL-OUTER
+G0 F3000 X10 Y10 Z0.2
+G1 X20 Y10 E0.5
+;TIME_ELAPSED:10
+;LAYER:1
+;TYPE:FILL
+G0 X10 Y20 Z0.4
+G1 X20 Y20 E1.0
+;TIME_ELAPSED:20
+M104 S0
+;TIME_ELAPSED:25
+M140 S0
+"""
+
+
+class TestLoadModes(unittest.TestCase):
+    file_name: str
+
+    def setUp(self) -> None:
+        handle, self.file_name = tempfile.mkstemp(suffix=".gcode")
+        with open(handle, "w") as file:
+            file.write(STRAY_TIME_ELAPSED)
+
+    def tearDown(self) -> None:
+        os.remove(self.file_name)
+
+    def get_commands(model: Model) -> list[list[str]]:
+        features = [model.feature_pre_print]
+        for layer in model.get_layers():
+            features += layer.get_features()
+        features.append(model.feature_post_print)
+        return [[command.command for command in feature.get_commands()] for feature in features]
+
+    def load_progressive(self) -> Model:
+        # A model yielded after another one replaces it, the layers are added by the caller
+        model = None
+        for yielded_model, layers, _ in Model.parse_gcode_progressive(self.file_name):
+            if yielded_model is not model and yielded_model != None:
+                model = yielded_model
+            for layer in layers:
+                model.add_layer(layer)
+        return model
+
+    def test_stray_time_elapsed_after_last_layer(self) -> None:
+        with open(self.file_name, "r") as file:
+            expected = TestLoadModes.get_commands(Model.parse_gcode(file))
+
+        lazy = Model.parse_gcode_lazy(self.file_name)
+        self.assertEqual(TestLoadModes.get_commands(lazy), expected)
+        if lazy.source_file != None:
+            lazy.source_file.close()
+
+        self.assertEqual(TestLoadModes.get_commands(Model.parse_gcode_parallel(self.file_name, 1)), expected)
+
+        progressive = self.load_progressive()
+        self.assertEqual(TestLoadModes.get_commands(progressive), expected)
+        if progressive.source_file != None:
+            progressive.source_file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()